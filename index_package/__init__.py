@@ -1,2 +1,3 @@
-from .service import Service, ServiceScanJob, QueryResult, PdfQueryItem, PageQueryItem, PagePDFFile, PageAnnoQueryItem, PageHighlightSegment
+from .service import Service, ServiceScanJob, QueryResult, QueryCursor, QueryPage, PdfQueryItem, PageQueryItem, PagePDFFile, PageAnnoQueryItem, PageHighlightSegment
+from .index import RRFRanking, QueryFilter
 from .progress_events import *
\ No newline at end of file
@@ -1,4 +1,10 @@
 from .index import Index
-from .fts5_db import FTS5DB
-from .vector_db import VectorDB, DistanceSpace
-from .types import IndexNode, IndexSegment, IndexNodeMatching, PageRelativeToPDF
\ No newline at end of file
+from .fts5_db import FTS5DB, FTS5Stats, FTS5StorageMigration
+from .fts5_maintenance import FTS5Maintenance
+from .vector_db import VectorDB, VectorQueryStats, EmbeddingBackend
+from .vector_store import VectorStore, ChromaVectorStore, DistanceSpace, VectorBackend, VectorQuantization
+from .flat_vector_store import FlatVectorStore
+from .types import IndexNode, IndexSegment, IndexNodeMatching, PageRelativeToPDF, RRFRanking, QueryFilter
+from .query_cache import QueryCache, QueryCacheStats
+from .embedding_cache import EmbeddingCache, EmbeddingCacheStats
+from .embedding_pool import EmbeddingPool
\ No newline at end of file
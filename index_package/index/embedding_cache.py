@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import json
+import hashlib
+import numpy as np
+
+from time import time
+from typing import Callable
+from threading import Lock
+from dataclasses import dataclass
+from sqlite3 import Cursor
+from numpy import ndarray
+from ..sqlite3_pool import register_table_creators, SQLite3Pool
+
+_MAX_VARIABLES_COUNT = 500
+
+# identifies embeddings of a model encoded by a backend in keys of caches.
+# "torch" is left out, so that keys stay as they were before there were backends.
+def embedding_model_key(model_id: str, backend: str) -> list[str]:
+  if backend == "torch":
+    return [model_id]
+  return [model_id, backend]
+
+@dataclass
+class EmbeddingCacheStats:
+  hits: int
+  misses: int
+  count: int
+
+  @property
+  def hit_rate(self) -> float:
+    if self.hits + self.misses == 0:
+      return 0.0
+    return self.hits / (self.hits + self.misses)
+
+# Thread safety
+# embeddings of segment texts, keyed by the digest of (model id, backend, text). identical texts, such as
+# headers, footers and shared annotations, are encoded once, and rebuilding index encodes nothing it has seen.
+# backends (to see EmbeddingBackend) encode slightly different embeddings, so that they never share entries.
+# the least recently used entries are dropped once there are more than max_count of them.
+class EmbeddingCache:
+  def __init__(self, db_path: str, embedding_model_id: str, max_count: int = 200000, embedding_backend: str = "torch"):
+    db = SQLite3Pool(format_name="embedding_cache", path=db_path)
+    self._db: SQLite3Pool = db.assert_format("embedding_cache")
+    self._model_key: list[str] = embedding_model_key(embedding_model_id, embedding_backend)
+    self._max_count: int = max_count
+    self._lock: Lock = Lock()
+    self._hits: int = 0
+    self._misses: int = 0
+    # rows count of table, so that least recently used rows are only deleted when over max_count
+    with self._db.connect() as (cursor, _):
+      cursor.execute("SELECT COUNT(*) FROM embeddings")
+      self._count: int = cursor.fetchone()[0]
+
+  @property
+  def stats(self) -> EmbeddingCacheStats:
+    with self._lock:
+      return EmbeddingCacheStats(
+        hits=self._hits,
+        misses=self._misses,
+        count=self._count,
+      )
+
+  # only texts that are not cached are passed to encode, each of them once.
+  # returns float32 array of shape (len(texts), dimension), in the order of texts.
+  def encode(self, texts: list[str], encode: Callable[[list[str]], ndarray]) -> ndarray:
+    digests = [self._digest(text) for text in texts]
+    digest2embedding = self._load(list(set(digests)))
+    used_digests = list(digest2embedding.keys())
+
+    missed_digests: dict[bytes, str] = {}
+    for digest, text in zip(digests, texts):
+      if digest not in digest2embedding:
+        missed_digests[digest] = text
+    missed_texts = list(missed_digests.values())
+
+    with self._lock:
+      self._hits += len(texts) - len(missed_texts)
+      self._misses += len(missed_texts)
+
+    embeddings = np.empty((0, 0), dtype=np.float32)
+    if len(missed_texts) > 0:
+      embeddings = np.asarray(encode(missed_texts), dtype=np.float32)
+      for digest, embedding in zip(missed_digests.keys(), embeddings):
+        digest2embedding[digest] = embedding
+    self._persist(list(missed_digests.keys()), embeddings, used_digests)
+
+    if len(texts) == 0:
+      return np.empty((0, 0), dtype=np.float32)
+    return np.stack([digest2embedding[digest] for digest in digests])
+
+  def _digest(self, text: str) -> bytes:
+    key = json.dumps([*self._model_key, text], ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).digest()
+
+  # digests are BLOB, which json_each can't carry, so that they are bound as variables of IN.
+  def _load(self, digests: list[bytes]) -> dict[bytes, ndarray]:
+    digest2embedding: dict[bytes, ndarray] = {}
+    with self._db.connect() as (cursor, _):
+      for offset in range(0, len(digests), _MAX_VARIABLES_COUNT):
+        chunk = digests[offset:offset + _MAX_VARIABLES_COUNT]
+        cursor.execute(
+          f"SELECT digest, value FROM embeddings WHERE digest IN ({', '.join('?' for _ in chunk)})",
+          chunk,
+        )
+        for digest, value in cursor.fetchall():
+          digest2embedding[digest] = np.frombuffer(value, dtype=np.float32)
+    return digest2embedding
+
+  # used_digests are of loaded embeddings, whose used_at is updated in the same transaction.
+  def _persist(self, digests: list[bytes], embeddings: ndarray, used_digests: list[bytes]):
+    if len(digests) == 0 and len(used_digests) == 0:
+      return
+
+    with self._db.connect() as (cursor, conn):
+      try:
+        cursor.execute("BEGIN TRANSACTION")
+        used_at = time()
+        cursor.executemany(
+          "UPDATE embeddings SET used_at = ? WHERE digest = ?",
+          [(used_at, digest) for digest in used_digests],
+        )
+        inserted_count: int = 0
+        for digest, embedding in zip(digests, embeddings):
+          # another thread may have inserted the same text meanwhile
+          cursor.execute(
+            "INSERT OR IGNORE INTO embeddings (digest, value, used_at) VALUES (?, ?, ?)",
+            (digest, embedding.tobytes(), used_at),
+          )
+          inserted_count += cursor.rowcount
+
+        with self._lock:
+          count = self._count + inserted_count
+          excess_count = max(0, count - self._max_count)
+          self._count = count - excess_count
+
+        if excess_count > 0:
+          cursor.execute(
+            "DELETE FROM embeddings WHERE digest IN (SELECT digest FROM embeddings ORDER BY used_at LIMIT ?)",
+            (excess_count,),
+          )
+        conn.commit()
+      except Exception as e:
+        conn.rollback()
+        raise e
+
+def _create_tables(cursor: Cursor):
+  cursor.execute("""
+    CREATE TABLE embeddings (
+      digest BLOB PRIMARY KEY,
+      value BLOB NOT NULL,
+      used_at REAL NOT NULL
+    )
+  """)
+  cursor.execute("""
+    CREATE INDEX idx_embeddings_used_at ON embeddings (used_at)
+  """)
+
+register_table_creators("embedding_cache", _create_tables)
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import math
+import queue
+import threading
+import numpy as np
+import multiprocessing as mp
+
+from typing import Any, Callable
+from dataclasses import dataclass, field
+from multiprocessing.shared_memory import SharedMemory
+from numpy import ndarray
+
+# creates the encode function in a worker process. it must be picklable, such as a module-level
+# function or a functools.partial of it.
+EncodeFactory = Callable[[], Callable[[list[str]], ndarray]]
+
+_MAX_CHUNK_SIZE = 64
+_POLL_INTERVAL = 1.0
+
+@dataclass
+class _Request:
+  chunks_count: int
+  done_count: int = 0
+  error: str | None = None
+  event: threading.Event = field(default_factory=threading.Event)
+
+# Thread safety
+# encodes texts in worker processes, each of which holds its own model, so that encoding of many
+# indexing threads is not serialized by the GIL. texts of a call are split into chunks, which are
+# sent to workers by a shared queue, and workers write embeddings into a shared memory block of the call.
+# only chunk ids and errors go back through the response queue.
+# workers are started by the first call of encode, or by warm_up. a worker dying later (such as killed
+# by OOM) fails the calls in progress, whose chunks may be lost with it, and is started again.
+class EmbeddingPool:
+  def __init__(self, create_encode: EncodeFactory, processes: int):
+    if processes <= 0:
+      raise ValueError(f"processes must be positive, but got {processes}")
+    self._create_encode: EncodeFactory = create_encode
+    self._processes_count: int = processes
+    self._context = mp.get_context("spawn")
+    self._start_lock: threading.Lock = threading.Lock()
+    self._requests_lock: threading.Lock = threading.Lock()
+    self._processes: list[Any] = []
+    self._tasks: Any = None
+    self._responses: Any = None
+    self._collector: threading.Thread | None = None
+    self._dimension: int = 0
+    self._next_request_id: int = 0
+    self._requests: dict[int, _Request] = {}
+    self._closed: bool = False
+
+  @property
+  def processes(self) -> int:
+    return self._processes_count
+
+  # starts workers and blocks until all of them have loaded model
+  def warm_up(self):
+    self._start()
+
+  # float32 array of shape (len(texts), dimension), in the order of texts
+  def encode(self, texts: list[str]) -> ndarray:
+    self._start()
+    if len(texts) == 0:
+      return np.empty((0, self._dimension), dtype=np.float32)
+
+    chunk_size = min(_MAX_CHUNK_SIZE, math.ceil(len(texts) / self._processes_count))
+    chunks = [(offset, texts[offset:offset + chunk_size]) for offset in range(0, len(texts), chunk_size)]
+    shared_memory = SharedMemory(create=True, size=len(texts) * self._dimension * 4)
+    try:
+      request = _Request(chunks_count=len(chunks))
+      with self._requests_lock:
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        self._requests[request_id] = request
+
+      try:
+        for offset, chunk in chunks:
+          self._tasks.put((request_id, shared_memory.name, offset, chunk))
+        self._wait(request)
+      finally:
+        with self._requests_lock:
+          self._requests.pop(request_id, None)
+
+      if request.error is not None:
+        raise RuntimeError(f"Embedding worker failed: {request.error}")
+
+      buffer = np.ndarray((len(texts), self._dimension), dtype=np.float32, buffer=shared_memory.buf)
+      embeddings = buffer.copy()
+      del buffer
+      return embeddings
+
+    finally:
+      shared_memory.close()
+      shared_memory.unlink()
+
+  def close(self):
+    with self._start_lock:
+      if self._closed:
+        return
+      self._closed = True
+      if len(self._processes) == 0:
+        return
+      for _ in self._processes:
+        self._tasks.put(None)
+      for process in self._processes:
+        process.join()
+      self._responses.put(None)
+      if self._collector is not None:
+        self._collector.join()
+
+  def _start(self):
+    with self._start_lock:
+      if self._closed:
+        raise RuntimeError("EmbeddingPool is closed")
+      if len(self._processes) > 0:
+        return
+
+      tasks = self._context.Queue()
+      responses = self._context.Queue()
+      processes: list[Any] = []
+      for _ in range(self._processes_count):
+        processes.append(self._start_process(tasks, responses))
+
+      # each worker reports the dimension of embeddings, once its model is loaded.
+      # a worker may also die without reporting (such as killed by OOM), which is checked while waiting.
+      try:
+        ready_count: int = 0
+        while ready_count < self._processes_count:
+          try:
+            kind, value = responses.get(timeout=_POLL_INTERVAL)
+          except queue.Empty:
+            _check_alive(processes)
+            continue
+          if kind == "error":
+            raise RuntimeError(f"Embedding worker failed to start: {value}")
+          self._dimension = value
+          ready_count += 1
+      except Exception as e:
+        for process in processes:
+          process.terminate()
+        raise e
+
+      self._tasks = tasks
+      self._responses = responses
+      self._processes = processes
+
+      self._collector = threading.Thread(target=self._collect, daemon=True)
+      self._collector.start()
+
+  def _start_process(self, tasks: Any, responses: Any) -> Any:
+    process = self._context.Process(
+      target=_work,
+      args=(self._create_encode, tasks, responses),
+      daemon=True,
+    )
+    process.start()
+    return process
+
+  # this function is running in daemon thread
+  def _collect(self):
+    while True:
+      response = self._responses.get()
+      if response is None:
+        break
+      request_id, error = response
+      if request_id in ("ready", "error"):
+        continue # reported by a restarted worker
+      with self._requests_lock:
+        request = self._requests.get(request_id, None)
+        if request is None:
+          continue
+        request.done_count += 1
+        if error is not None and request.error is None:
+          request.error = error
+        if request.done_count >= request.chunks_count:
+          request.event.set()
+
+  def _wait(self, request: _Request):
+    while not request.event.wait(_POLL_INTERVAL):
+      self._restart_dead_processes()
+
+  def _restart_dead_processes(self):
+    with self._start_lock:
+      if self._closed:
+        return
+      dead_indexes = [i for i, process in enumerate(self._processes) if not process.is_alive()]
+      if len(dead_indexes) == 0:
+        return
+
+      error = f"Embedding worker exited with code {self._processes[dead_indexes[0]].exitcode}"
+      with self._requests_lock:
+        for request in self._requests.values():
+          if request.error is None:
+            request.error = error
+          request.event.set()
+
+      for i in dead_indexes:
+        self._processes[i] = self._start_process(self._tasks, self._responses)
+
+def _check_alive(processes: list[Any]):
+  for process in processes:
+    if not process.is_alive():
+      raise RuntimeError(f"Embedding worker exited with code {process.exitcode}")
+
+# this function is running in worker process
+def _work(create_encode: EncodeFactory, tasks: Any, responses: Any):
+  try:
+    encode = create_encode()
+    responses.put(("ready", encode(["warm up"]).shape[1]))
+  except Exception as e:
+    responses.put(("error", repr(e)))
+    return
+
+  while True:
+    task = tasks.get()
+    if task is None:
+      break
+    request_id, shared_memory_name, offset, texts = task
+    try:
+      embeddings = encode(texts)
+      # workers share resource tracker with the pool's process, which unlinks the block
+      shared_memory = SharedMemory(name=shared_memory_name)
+      try:
+        buffer = np.ndarray(
+          (len(texts), embeddings.shape[1]),
+          dtype=np.float32,
+          buffer=shared_memory.buf,
+          offset=offset * embeddings.shape[1] * 4,
+        )
+        buffer[:] = embeddings
+        del buffer
+      finally:
+        shared_memory.close()
+      responses.put((request_id, None))
+    except Exception as e:
+      responses.put((request_id, repr(e)))
@@ -0,0 +1,572 @@
+from __future__ import annotations
+
+import os
+import json
+import numpy as np
+
+from typing import Callable
+from threading import Lock
+from sqlite3 import Cursor
+from numpy import ndarray
+from .types import NodesFilter
+from .vector_store import VectorStore, DistanceSpace, StoredSegment, VectorQuantization
+from ..sqlite3_pool import register_table_creators, SQLite3Pool
+
+# hnswlib is optional. without it, queries are always brute-force.
+try:
+  import hnswlib
+except ImportError:
+  hnswlib = None
+
+_INITIAL_CAPACITY = 1024
+_BRUTE_FORCE_CHUNK_SIZE = 16384
+_HNSW_M = 16
+_HNSW_EF_CONSTRUCTION = 200
+_HNSW_EF_SEARCH = 64
+
+# Thread safety
+# vectors are float32 rows of a memory-mapped file, and the slot (row) of each segment id is kept
+# in sqlite with its metadata. rows of removed segments are reused by segments added later.
+# queries are brute-force top-k with NumPy, until alive segments reach hnsw_threshold and hnswlib is
+# installed. then an HNSW graph is built over rows, which is saved when the store is closed and
+# rebuilt on next open if the store was written without being closed.
+# distances are the same as chroma's: squared l2, 1 - inner product, 1 - cosine similarity.
+# with quantization "float16" or "int8" (scaled per row), a quantized copy of rows is kept in another
+# memory-mapped file and scanned for limit * rerank_factor candidates, which are re-ranked with exact
+# distances from float32 rows. only the quantized file needs to stay in memory, and HNSW is never used.
+class FlatVectorStore(VectorStore):
+  def __init__(
+    self,
+    dir_path: str,
+    distance_space: DistanceSpace,
+    hnsw_threshold: int = 100000,
+    quantization: VectorQuantization = "none",
+    rerank_factor: int = 4,
+  ):
+    if quantization not in ("none", "float16", "int8"):
+      raise ValueError(f"Invalid quantization: {quantization}")
+
+    db = SQLite3Pool(
+      format_name="flat_vectors",
+      path=os.path.join(dir_path, "flat_vectors.sqlite3"),
+    )
+    self._db: SQLite3Pool = db.assert_format("flat_vectors")
+    self._vectors_path: str = os.path.join(dir_path, "flat_vectors.f32")
+    self._hnsw_path: str = os.path.join(dir_path, "flat_vectors.hnsw")
+    self._codes_path: str = os.path.join(dir_path, "flat_vectors.f16" if quantization == "float16" else "flat_vectors.i8")
+    self._scales_path: str = os.path.join(dir_path, "flat_vectors.i8.scales")
+    self._quantization: VectorQuantization = quantization
+    self._rerank_factor: int = max(1, rerank_factor)
+    self._distance_space: DistanceSpace = distance_space
+    self._hnsw_threshold: int = hnsw_threshold
+    self._lock: Lock = Lock()
+    self._dimension: int | None = None
+    self._writes: int = 0
+    self._vectors: np.memmap | None = None
+    self._codes: np.memmap | None = None
+    self._scales: np.memmap | None = None
+    self._ids: list[str | None] = []
+    self._slots: dict[str, int] = {}
+    # slots of segments of each node, so that queries restricted to nodes only scan their rows
+    self._node_slots: dict[str, list[int]] = {}
+    self._free_slots: list[int] = []
+    # arrays by slot, which may be longer than _ids. owners and types are coded as integers
+    # (-1 for None or removed slots), so that masks of NodesFilter are built by NumPy.
+    self._alive: ndarray = np.zeros(0, dtype=bool)
+    self._owner_codes: ndarray = np.zeros(0, dtype=np.int32)
+    self._type_codes: ndarray = np.zeros(0, dtype=np.int32)
+    self._codes_of_owners: dict[str, int] = {}
+    self._codes_of_types: dict[str, int] = {}
+    self._hnsw = None
+    self._load()
+
+  @property
+  def uses_hnsw(self) -> bool:
+    with self._lock:
+      return self._hnsw is not None
+
+  def count(self) -> int:
+    with self._lock:
+      return len(self._slots)
+
+  def add(self, ids: list[str], embeddings: ndarray, metadatas: list[dict], documents: list[str]) -> None:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(ids) == 0:
+      return
+
+    with self._lock:
+      if self._dimension is None:
+        self._dimension = embeddings.shape[1]
+        self._set_meta("dimension", self._dimension)
+      elif embeddings.shape[1] != self._dimension:
+        raise ValueError(f"Expected embeddings of dimension {self._dimension}, but got {embeddings.shape[1]}")
+
+      # adding an existing id replaces it
+      slots: list[int] = []
+      for id in ids:
+        slot = self._slots.get(id, None)
+        if slot is None:
+          if len(self._free_slots) > 0:
+            slot = self._free_slots.pop()
+          else:
+            slot = len(self._ids)
+            self._ids.append(None)
+        slots.append(slot)
+      self._ensure_labels_capacity(len(self._ids))
+
+      vectors = self._ensure_capacity(len(self._ids))
+      vectors[slots] = embeddings
+      vectors.flush()
+      self._write_codes(np.array(slots, dtype=np.int64), embeddings)
+
+      with self._db.connect() as (cursor, conn):
+        try:
+          cursor.execute("BEGIN TRANSACTION")
+          for id, slot, metadata in zip(ids, slots, metadatas):
+            cursor.execute(
+              "INSERT OR REPLACE INTO segments (slot, id, owner, type, metadata) VALUES (?, ?, ?, ?, ?)",
+              (slot, id, metadata.get("owner", None), metadata.get("type", None), json.dumps(metadata)),
+            )
+          self._writes += 1
+          self._set_meta("writes", self._writes, cursor)
+          conn.commit()
+        except Exception as e:
+          conn.rollback()
+          raise e
+
+      for id, slot, metadata in zip(ids, slots, metadatas):
+        if self._ids[slot] is None:
+          self._add_node_slot(id, slot)
+        self._ids[slot] = id
+        self._slots[id] = slot
+        self._set_labels(slot, metadata)
+
+      if self._hnsw is not None:
+        if self._hnsw.get_max_elements() < len(vectors):
+          self._hnsw.resize_index(len(vectors))
+        self._hnsw.add_items(embeddings, slots)
+      elif len(self._slots) >= self._hnsw_threshold:
+        self._build_hnsw()
+
+  def embeddings(self, ids: list[str]) -> list[ndarray]:
+    with self._lock:
+      embeddings: list[ndarray] = []
+      if self._vectors is None:
+        return embeddings
+      for id in ids:
+        slot = self._slots.get(id, None)
+        if slot is not None:
+          embeddings.append(np.array(self._vectors[slot]))
+      return embeddings
+
+  def metadatas(self, ids: list[str]) -> list[dict | None]:
+    with self._lock:
+      slots = [self._slots.get(id, None) for id in ids]
+    slot2metadata = self._load_metadatas([s for s in slots if s is not None])
+    return [None if s is None else slot2metadata.get(s, None) for s in slots]
+
+  def query(
+    self,
+    embedding: ndarray,
+    limit: int,
+    nodes_filter: NodesFilter | None,
+    node_ids: list[str] | None = None,
+  ) -> list[StoredSegment]:
+    query_vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    slots: list[int] = []
+    slot_distances: list[float] = []
+
+    with self._lock:
+      if self._vectors is None or limit <= 0:
+        return []
+      candidate_slots = self._candidate_slots(nodes_filter, node_ids)
+      if len(candidate_slots) == 0:
+        return []
+      limit = min(limit, len(candidate_slots))
+      use_hnsw = self._hnsw is not None and len(candidate_slots) >= self._hnsw_threshold
+
+      if use_hnsw:
+        filter: Callable[[int], bool] | None = None
+        if nodes_filter is not None or node_ids is not None:
+          mask = np.zeros(len(self._ids), dtype=bool)
+          mask[candidate_slots] = True
+          filter = lambda label: bool(mask[label])
+        self._hnsw.set_ef(max(_HNSW_EF_SEARCH, limit))
+        labels, distances = self._hnsw.knn_query(query_vector, k=limit, filter=filter)
+        slots = [int(s) for s in labels[0]]
+        slot_distances = [float(d) for d in distances[0]]
+
+    # rows are scanned without the lock, so that writes and other queries go on meanwhile.
+    # memory maps are only ever extended, and slots removed during the scan are dropped below.
+    if not use_hnsw:
+      if self._codes is not None:
+        candidates_limit = min(limit * self._rerank_factor, len(candidate_slots))
+        slots, _ = self._brute_force(query_vector, candidate_slots, candidates_limit, self._quantized_rows)
+        candidate_slots = np.array(slots, dtype=np.int64)
+      slots, slot_distances = self._brute_force(query_vector, candidate_slots, limit, self._full_rows)
+
+    with self._lock:
+      ids = [self._ids[s] for s in slots]
+
+    slot2metadata = self._load_metadatas(slots)
+    segments: list[StoredSegment] = []
+    for id, slot, distance in zip(ids, slots, slot_distances):
+      metadata = slot2metadata.get(slot, None)
+      if id is not None and metadata is not None:
+        segments.append((id, distance, metadata))
+    return segments
+
+  def update(self, ids: list[str], metadatas: list[dict]) -> None:
+    with self._lock:
+      with self._db.connect() as (cursor, conn):
+        try:
+          cursor.execute("BEGIN TRANSACTION")
+          for id, metadata in zip(ids, metadatas):
+            cursor.execute(
+              "UPDATE segments SET owner = ?, type = ?, metadata = ? WHERE id = ?",
+              (metadata.get("owner", None), metadata.get("type", None), json.dumps(metadata), id),
+            )
+          conn.commit()
+        except Exception as e:
+          conn.rollback()
+          raise e
+
+      for id, metadata in zip(ids, metadatas):
+        slot = self._slots.get(id, None)
+        if slot is not None:
+          self._set_labels(slot, metadata)
+
+  def delete(self, ids: list[str]) -> None:
+    with self._lock:
+      self._delete_slots([self._slots[id] for id in ids if id in self._slots])
+
+  def delete_nodes(self, node_ids: list[str]) -> None:
+    if len(node_ids) == 0:
+      return
+    with self._lock:
+      with self._db.connect() as (cursor, _):
+        cursor.execute(
+          "SELECT slot FROM segments WHERE json_extract(metadata, '$.node_id') IN (SELECT value FROM json_each(?))",
+          (json.dumps(node_ids),),
+        )
+        slots = [row[0] for row in cursor.fetchall()]
+      self._delete_slots(slots)
+
+  def list(self, limit: int, offset: int) -> tuple[list[str], list[dict]]:
+    with self._db.connect() as (cursor, _):
+      cursor.execute("SELECT id, metadata FROM segments ORDER BY slot LIMIT ? OFFSET ?", (limit, offset))
+      ids: list[str] = []
+      metadatas: list[dict] = []
+      for id, metadata in cursor.fetchall():
+        ids.append(id)
+        metadatas.append(json.loads(metadata))
+      return ids, metadatas
+
+  # saves HNSW graph, so that it needs not to be rebuilt when opened next time
+  def close(self):
+    with self._lock:
+      if self._hnsw is not None:
+        self._hnsw.save_index(self._hnsw_path)
+        self._set_meta("hnsw_writes", self._writes)
+      for memmap in (self._vectors, self._codes, self._scales):
+        if memmap is not None:
+          memmap.flush()
+
+  def _load(self):
+    with self._db.connect() as (cursor, conn):
+      # stores created before "node_id" was added to metadata have no such index
+      _create_node_id_index(cursor)
+      conn.commit()
+      meta = self._get_meta(cursor)
+      cursor.execute("SELECT slot, id, owner, type FROM segments ORDER BY slot")
+      rows = cursor.fetchall()
+
+    if "dimension" in meta:
+      self._dimension = int(meta["dimension"])
+    self._writes = int(meta.get("writes", 0))
+
+    slots_count = 0 if len(rows) == 0 else rows[-1][0] + 1
+    self._ids = [None] * slots_count
+    self._ensure_labels_capacity(slots_count)
+    for slot, id, owner, type in rows:
+      self._ids[slot] = id
+      self._slots[id] = slot
+      self._add_node_slot(id, slot)
+      self._set_labels(slot, {"owner": owner, "type": type})
+    self._free_slots = [s for s in range(slots_count - 1, -1, -1) if self._ids[s] is None]
+
+    if self._dimension is not None and os.path.exists(self._vectors_path):
+      row_size = self._dimension * 4
+      capacity = os.path.getsize(self._vectors_path) // row_size
+      if capacity > 0:
+        self._open_vectors(capacity)
+
+    # quantized rows are built again from float32 rows, if they were written with another quantization
+    if meta.get("quantization", "none") != self._quantization:
+      if self._codes is not None:
+        slots = np.array(sorted(self._slots.values()), dtype=np.int64)
+        for offset in range(0, len(slots), _BRUTE_FORCE_CHUNK_SIZE):
+          chunk = slots[offset:offset + _BRUTE_FORCE_CHUNK_SIZE]
+          self._write_codes(chunk, self._full_rows(chunk))
+      self._set_meta("quantization", self._quantization)
+
+    if self._quantization == "none" and len(self._slots) >= self._hnsw_threshold:
+      if int(meta.get("hnsw_writes", -1)) == self._writes and os.path.exists(self._hnsw_path) and hnswlib is not None:
+        self._hnsw = hnswlib.Index(space=self._distance_space, dim=self._dimension)
+        self._hnsw.load_index(self._hnsw_path, max_elements=len(self._vectors))
+      else:
+        self._build_hnsw()
+
+  def _ensure_capacity(self, slots_count: int) -> np.memmap:
+    assert self._dimension is not None
+    if self._vectors is not None and len(self._vectors) >= slots_count:
+      return self._vectors
+
+    capacity = _INITIAL_CAPACITY if self._vectors is None else len(self._vectors)
+    while capacity < slots_count:
+      capacity *= 2
+
+    for memmap in (self._vectors, self._codes, self._scales):
+      if memmap is not None:
+        memmap.flush()
+    self._open_vectors(capacity)
+    assert self._vectors is not None
+    return self._vectors
+
+  def _open_vectors(self, capacity: int):
+    assert self._dimension is not None
+    self._vectors = _open_memmap(self._vectors_path, np.float32, (capacity, self._dimension))
+    if self._quantization == "float16":
+      self._codes = _open_memmap(self._codes_path, np.float16, (capacity, self._dimension))
+    elif self._quantization == "int8":
+      self._codes = _open_memmap(self._codes_path, np.int8, (capacity, self._dimension))
+      self._scales = _open_memmap(self._scales_path, np.float32, (capacity,))
+
+  def _write_codes(self, slots: ndarray, embeddings: ndarray):
+    if self._codes is None:
+      return
+    if self._scales is None:
+      self._codes[slots] = embeddings.astype(np.float16)
+    else:
+      scales = np.max(np.abs(embeddings), axis=1) / 127.0
+      scales[scales == 0.0] = 1.0
+      self._codes[slots] = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+      self._scales[slots] = scales
+      self._scales.flush()
+    self._codes.flush()
+
+  def _full_rows(self, slots: ndarray) -> ndarray:
+    assert self._vectors is not None
+    return self._vectors[slots]
+
+  def _quantized_rows(self, slots: ndarray) -> ndarray:
+    assert self._codes is not None
+    rows = self._codes[slots].astype(np.float32)
+    if self._scales is not None:
+      rows *= self._scales[slots][:, None]
+    return rows
+
+  def _build_hnsw(self):
+    if hnswlib is None or self._vectors is None or self._quantization != "none":
+      return
+    hnsw = hnswlib.Index(space=self._distance_space, dim=self._dimension)
+    hnsw.init_index(max_elements=len(self._vectors), ef_construction=_HNSW_EF_CONSTRUCTION, M=_HNSW_M)
+    slots = np.array(sorted(self._slots.values()), dtype=np.int64)
+    for offset in range(0, len(slots), _BRUTE_FORCE_CHUNK_SIZE):
+      chunk = slots[offset:offset + _BRUTE_FORCE_CHUNK_SIZE]
+      hnsw.add_items(self._vectors[chunk], chunk)
+    self._hnsw = hnsw
+
+  def _ensure_labels_capacity(self, slots_count: int):
+    capacity = len(self._alive)
+    if capacity >= slots_count:
+      return
+    capacity = max(capacity, _INITIAL_CAPACITY)
+    while capacity < slots_count:
+      capacity *= 2
+    extra_count = capacity - len(self._alive)
+    self._alive = np.concatenate((self._alive, np.zeros(extra_count, dtype=bool)))
+    self._owner_codes = np.concatenate((self._owner_codes, np.full(extra_count, -1, dtype=np.int32)))
+    self._type_codes = np.concatenate((self._type_codes, np.full(extra_count, -1, dtype=np.int32)))
+
+  def _set_labels(self, slot: int, metadata: dict):
+    self._alive[slot] = True
+    self._owner_codes[slot] = _code_of(self._codes_of_owners, metadata.get("owner", None))
+    self._type_codes[slot] = _code_of(self._codes_of_types, metadata.get("type", None))
+
+  # ids of segments are "{node_id}/{index}"
+  def _add_node_slot(self, id: str, slot: int):
+    node_id = id.rsplit("/", 1)[0]
+    node_slots = self._node_slots.get(node_id, None)
+    if node_slots is None:
+      self._node_slots[node_id] = node_slots = []
+    node_slots.append(slot)
+
+  def _remove_node_slot(self, id: str, slot: int):
+    node_id = id.rsplit("/", 1)[0]
+    node_slots = self._node_slots[node_id]
+    node_slots.remove(slot)
+    if len(node_slots) == 0:
+      self._node_slots.pop(node_id)
+
+  # slots that may be found by query. with node_ids, only their slots are visited.
+  def _candidate_slots(self, nodes_filter: NodesFilter | None, node_ids: list[str] | None) -> ndarray:
+    if node_ids is None:
+      slots_count = len(self._ids)
+      if nodes_filter is None:
+        return np.flatnonzero(self._alive[:slots_count])
+      return np.flatnonzero(self._filter_mask(nodes_filter, slice(0, slots_count)))
+
+    candidate_slots = np.array(sorted(
+      slot
+      for node_id in set(node_ids)
+      for slot in self._node_slots.get(node_id, ())
+    ), dtype=np.int64)
+    if nodes_filter is not None:
+      candidate_slots = candidate_slots[self._filter_mask(nodes_filter, candidate_slots)]
+    return candidate_slots
+
+  # mask of alive slots satisfying NodesFilter, over the given slots
+  def _filter_mask(self, nodes_filter: NodesFilter, slots: ndarray | slice) -> ndarray:
+    mask = self._alive[slots].copy()
+    if nodes_filter.owners is not None:
+      mask &= _isin_codes(self._owner_codes[slots], self._codes_of_owners, nodes_filter.owners)
+    if nodes_filter.types is not None:
+      mask &= _isin_codes(self._type_codes[slots], self._codes_of_types, nodes_filter.types)
+    return mask
+
+  # rows are read in chunks, so that the whole file is never copied into memory at once.
+  def _brute_force(
+    self,
+    query_vector: ndarray,
+    slots: ndarray,
+    limit: int,
+    rows_of: Callable[[ndarray], ndarray],
+  ) -> tuple[list[int], list[float]]:
+    distances = np.empty(len(slots), dtype=np.float32)
+    query_norm = float(np.dot(query_vector, query_vector))
+
+    for offset in range(0, len(slots), _BRUTE_FORCE_CHUNK_SIZE):
+      chunk_slots = slots[offset:offset + _BRUTE_FORCE_CHUNK_SIZE]
+      rows = rows_of(chunk_slots)
+      products = rows @ query_vector
+      if self._distance_space == "l2":
+        chunk_distances = np.einsum("ij,ij->i", rows, rows) - 2.0 * products + query_norm
+      elif self._distance_space == "ip":
+        chunk_distances = 1.0 - products
+      else:
+        norms = np.sqrt(np.einsum("ij,ij->i", rows, rows) * query_norm)
+        chunk_distances = 1.0 - products / np.maximum(norms, 1e-30)
+      distances[offset:offset + len(chunk_slots)] = chunk_distances
+
+    if limit < len(distances):
+      top = np.argpartition(distances, limit - 1)[:limit]
+    else:
+      top = np.arange(len(distances))
+    top = top[np.argsort(distances[top], kind="stable")]
+
+    return [int(slots[i]) for i in top], [float(distances[i]) for i in top]
+
+  # caller holds the lock
+  def _delete_slots(self, slots: list[int]):
+    if len(slots) == 0:
+      return
+
+    with self._db.connect() as (cursor, conn):
+      try:
+        cursor.execute("BEGIN TRANSACTION")
+        cursor.execute(
+          "DELETE FROM segments WHERE slot IN (SELECT value FROM json_each(?))",
+          (json.dumps(slots),),
+        )
+        self._writes += 1
+        self._set_meta("writes", self._writes, cursor)
+        conn.commit()
+      except Exception as e:
+        conn.rollback()
+        raise e
+
+    for slot in slots:
+      id = self._ids[slot]
+      assert id is not None
+      self._slots.pop(id)
+      self._remove_node_slot(id, slot)
+      self._ids[slot] = None
+      self._alive[slot] = False
+      self._owner_codes[slot] = -1
+      self._type_codes[slot] = -1
+      self._free_slots.append(slot)
+      if self._hnsw is not None:
+        self._hnsw.mark_deleted(slot)
+
+  def _load_metadatas(self, slots: list[int]) -> dict[int, dict]:
+    slot2metadata: dict[int, dict] = {}
+    if len(slots) == 0:
+      return slot2metadata
+    with self._db.connect() as (cursor, _):
+      cursor.execute(
+        "SELECT slot, metadata FROM segments WHERE slot IN (SELECT value FROM json_each(?))",
+        (json.dumps(slots),),
+      )
+      for slot, metadata in cursor.fetchall():
+        slot2metadata[slot] = json.loads(metadata)
+    return slot2metadata
+
+  def _get_meta(self, cursor: Cursor) -> dict[str, str]:
+    cursor.execute("SELECT key, value FROM meta")
+    return dict(cursor.fetchall())
+
+  def _set_meta(self, key: str, value: int | str, cursor: Cursor | None = None):
+    if cursor is not None:
+      cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+      return
+    with self._db.connect() as (cursor, conn):
+      cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+      conn.commit()
+
+# codes are never released, so that a value keeps its code while the store is open
+def _code_of(codes: dict[str, int], value: str | None) -> int:
+  if value is None:
+    return -1
+  code = codes.get(value, None)
+  if code is None:
+    code = len(codes)
+    codes[value] = code
+  return code
+
+def _isin_codes(slot_codes: ndarray, codes: dict[str, int], values: tuple[str, ...]) -> ndarray:
+  value_codes = [codes[value] for value in values if value in codes]
+  return np.isin(slot_codes, np.array(value_codes, dtype=np.int32))
+
+# the file is extended to fit shape, and never shrunk
+def _open_memmap(path: str, dtype: type, shape: tuple[int, ...]) -> np.memmap:
+  size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+  with open(path, "ab") as file:
+    if file.tell() < size:
+      file.truncate(size)
+  return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+def _create_tables(cursor: Cursor):
+  cursor.execute("""
+    CREATE TABLE segments (
+      slot INTEGER PRIMARY KEY,
+      id TEXT NOT NULL UNIQUE,
+      owner TEXT,
+      type TEXT,
+      metadata TEXT NOT NULL
+    )
+  """)
+  _create_node_id_index(cursor)
+  cursor.execute("""
+    CREATE TABLE meta (
+      key TEXT PRIMARY KEY,
+      value TEXT NOT NULL
+    )
+  """)
+
+def _create_node_id_index(cursor: Cursor):
+  cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_segments_node_id ON segments (json_extract(metadata, '$.node_id'))
+  """)
+
+register_table_creators("flat_vectors", _create_tables)
@@ -1,138 +1,504 @@
+import os
 import re
 import json
+import zlib
+import struct
+import sqlite3
+import unicodedata
 
 from typing import Generator
-from sqlite3 import Cursor
-from .types import IndexNode, IndexSegment, IndexNodeMatching
+from threading import Lock, RLock, local
+from contextlib import contextmanager
+from dataclasses import dataclass
+from sqlite3 import Cursor, Connection
+from .query_syntax import split_query_syntax
+from .types import IndexNode, IndexSegment, IndexNodeMatching, NodesFilter
 from ..segmentation import Segment
 from ..sqlite3_pool import register_table_creators, SQLite3Pool
 
 _Segment = tuple[int, int, list[str]]
+_TokenOffsets = dict[str, list[int]]
 _INVALID_TOKENS = set(["", "NEAR", "AND", "OR", "NOT"])
-
+_MIN_PREFIX_LENGTH = 2
+
+# segments of node are packed as little-endian uint32 triples of (token_count, start, end).
+# version 0: segments are encoded as text, such as "12:0-340,9:340-610".
+# version 1: segments are packed.
+# version 2: nodes has column "document" for contentless storage.
+# version 3: nodes has column "offsets" for tokens.
+# version 4: fts5vocab table "contents_vocab" for document frequencies of terms.
+_SCHEMA_VERSION = 4
+_SEGMENT_STRUCT = struct.Struct("<III")
+
+# pragmas of the writer connection. WAL lets readers of other connections go on while writing,
+# and synchronous = NORMAL only syncs at checkpoints, which is still safe in WAL mode.
+# to see: https://www.sqlite.org/pragma.html
+_WRITER_PRAGMAS = (
+  "PRAGMA journal_mode = WAL",
+  "PRAGMA synchronous = NORMAL",
+  "PRAGMA cache_size = -16384",
+  "PRAGMA temp_store = MEMORY",
+)
+
+@dataclass
+class FTS5StorageMigration:
+  contentless: bool
+  size_before: int
+  size_after: int
+
+# expressions of FTS5 query, and tokens they are made of for analysis of segments.
+# a token matching any of prefixes is matched as the prefix ending with "*".
+@dataclass
+class _QueryTerms:
+  expressions: list[str]
+  tokens: set[str]
+  prefixes: set[str]
+  # expressions of common tokens are required by AND, but never select rows alone with OR
+  weak_expressions: set[str]
+
+  @property
+  def or_expressions(self) -> list[str]:
+    return [e for e in self.expressions if e not in self.weak_expressions]
+
+  @property
+  def keys_count(self) -> int:
+    return len(self.tokens) + len(self.prefixes)
+
+  def keys_of(self, token: str) -> list[str]:
+    keys: list[str] = []
+    if token in self.tokens:
+      keys.append(token)
+    for prefix in self.prefixes:
+      if token.startswith(prefix):
+        keys.append(f"{prefix}*")
+    return keys
+
+@dataclass
+class FTS5Stats:
+  levels_count: int
+  segments_count: int
+  # segments count of each level, from level 0. empty if unknown
+  level_segments: list[int]
+  index_size: int
+  file_size: int
+  free_size: int
+  # saved and removed nodes since this FTS5DB was opened
+  writes_count: int
+
+# max_df_ratio: plain tokens of query found in more than this ratio of nodes are common tokens.
+# they are dropped from query if drop_common_terms, otherwise they still narrow AND queries and count
+# in analysis, but OR queries never select rows by them. None means that no token is common.
+# contentless: FTS5 table keeps only its inverted index (content=''), and the tokens document of
+# each node is stored zlib-compressed in nodes. it is only decompressed for rows returned by queries,
+# and is also what FTS5 needs to delete a row from a contentless table. None keeps the storage the
+# database was written with (not contentless for a new one), and True or False converts it if needed.
+# all writes go through one long-lived writer connection. each write is committed at once,
+# unless its thread is in a batch, whose writes are committed when it exits (or by any flush).
 class FTS5DB:
-  def __init__(self, db_path: str):
+  def __init__(
+    self,
+    db_path: str,
+    contentless: bool | None = None,
+    max_df_ratio: float | None = None,
+    drop_common_terms: bool = False,
+  ):
     db = SQLite3Pool(
       format_name="fts5",
       path=db_path,
     )
     self._db: SQLite3Pool = db.assert_format("fts5")
+    self._migrate()
+    self._contentless: bool = False
+    self._max_df_ratio: float | None = max_df_ratio
+    self._drop_common_terms: bool = drop_common_terms
+    self._writes_lock: Lock = Lock()
+    self._writes_count: int = 0
+    self._writer_lock: RLock = RLock()
+    self._writer: Connection | None = None
+    # depth of batches is kept for each thread
+    self._batches: local = local()
+    self._storage_migration: FTS5StorageMigration | None = self._convert_storage(contentless)
+
+  # reports size of database file before and after storage was converted when opened, if it was.
+  @property
+  def storage_migration(self) -> FTS5StorageMigration | None:
+    return self._storage_migration
+
+  @property
+  def writes_count(self) -> int:
+    with self._writes_lock:
+      return self._writes_count
+
+  def stats(self) -> FTS5Stats:
+    with self._db.connect() as (cursor, _):
+      # rowid 10 of %_data is the structure record of FTS5 index.
+      # to see: https://www.sqlite.org/src/file?name=ext/fts5/fts5_index.c
+      cursor.execute("SELECT block FROM contents_data WHERE id = 10")
+      row = cursor.fetchone()
+      levels_count, segments_count, level_segments = 0, 0, []
+      if row is not None:
+        levels_count, segments_count, level_segments = _parse_structure_record(row[0])
+      cursor.execute("SELECT COALESCE(SUM(length(block)), 0) FROM contents_data")
+      index_size = cursor.fetchone()[0]
+      cursor.execute("PRAGMA page_size")
+      page_size = cursor.fetchone()[0]
+      cursor.execute("PRAGMA page_count")
+      page_count = cursor.fetchone()[0]
+      cursor.execute("PRAGMA freelist_count")
+      freelist_count = cursor.fetchone()[0]
+
+    return FTS5Stats(
+      levels_count=levels_count,
+      segments_count=segments_count,
+      level_segments=level_segments,
+      index_size=index_size,
+      file_size=page_size * page_count,
+      free_size=page_size * freelist_count,
+      writes_count=self.writes_count,
+    )
 
+  # merges about `pages` pages of b-tree segments. returns False if there is nothing to merge.
+  # to see: https://www.sqlite.org/fts5.html#the_merge_command
+  def merge(self, pages: int) -> bool:
+    with self._write() as (cursor, conn):
+      total_changes = conn.total_changes
+      cursor.execute("INSERT INTO contents (contents, rank) VALUES ('merge', ?)", (pages,))
+      return conn.total_changes - total_changes >= 2
+
+  # merges all segments into one. it may take long time on large database.
+  def optimize(self):
+    with self._write() as (cursor, _):
+      cursor.execute("INSERT INTO contents (contents) VALUES ('optimize')")
+
+  # to see: https://www.sqlite.org/fts5.html#the_automerge_configuration_option
+  def configure_merge(self, automerge: int | None = None, crisismerge: int | None = None, usermerge: int | None = None):
+    with self._write() as (cursor, _):
+      for name, value in (("automerge", automerge), ("crisismerge", crisismerge), ("usermerge", usermerge)):
+        if value is not None:
+          cursor.execute("INSERT INTO contents (contents, rank) VALUES (?, ?)", (name, value))
+
+  # the lock of writer is only held by each write and by flush, never by the batch itself, so that
+  # other threads go on writing while one is in a batch (such as parsing or embedding between writes).
+  # writes of all threads share the transaction of writer, which any flush commits. batches can be nested.
+  @contextmanager
+  def batch(self):
+    self._batches.depth = self._batch_depth + 1
+    try:
+      yield
+    finally:
+      self._batches.depth -= 1
+      if self._batches.depth == 0:
+        self.flush()
+
+  @property
+  def _batch_depth(self) -> int:
+    return getattr(self._batches, "depth", 0)
+
+  # commits writes of the current batch, so that they are visible to queries.
+  def flush(self):
+    with self._writer_lock:
+      if self._writer is not None and self._writer.in_transaction:
+        self._writer.execute("COMMIT")
+
+  def close(self):
+    with self._writer_lock:
+      self.flush()
+      if self._writer is not None:
+        self._writer.close()
+        self._writer = None
+
+  # each write is a savepoint, so that a failed write never rolls back other writes of its batch.
+  @contextmanager
+  def _write(self) -> Generator[tuple[Cursor, Connection], None, None]:
+    with self._writer_lock:
+      if self._writer is None:
+        self._writer = self._open_writer()
+      conn = self._writer
+      cursor = conn.cursor()
+      try:
+        if not conn.in_transaction:
+          cursor.execute("BEGIN")
+        cursor.execute("SAVEPOINT fts5_write")
+        try:
+          yield cursor, conn
+          cursor.execute("RELEASE fts5_write")
+        except Exception as e:
+          cursor.execute("ROLLBACK TO fts5_write")
+          cursor.execute("RELEASE fts5_write")
+          raise e
+        finally:
+          if self._batch_depth == 0:
+            self.flush()
+      finally:
+        cursor.close()
+
+  def _open_writer(self) -> Connection:
+    # transactions are controlled by _write and flush
+    conn = sqlite3.connect(self._db.path, isolation_level=None, check_same_thread=False)
+    for pragma in _WRITER_PRAGMAS:
+      conn.execute(pragma)
+    return conn
+
+  @property
+  def _document_field(self) -> str:
+    return "N.document" if self._contentless else "C.content"
+
+  # if limit is None, all matched nodes are yielded in the order of insertion.
+  # otherwise, nodes are yielded in the order of bm25, and only rows in the range of
+  # [offset, offset + limit) are read, decoded and analysed.
   def query(
     self,
     query_text: str,
     matching: IndexNodeMatching = IndexNodeMatching.Matched,
     is_or_condition: bool = False,
+    nodes_filter: NodesFilter | None = None,
+    limit: int | None = None,
+    offset: int = 0,
   ) -> Generator[IndexNode, None, None]:
 
-    query_tokens = self._split_tokens(query_text)
-    query_tokens_set = set(query_tokens)
+    terms = self._parse_query(query_text)
 
-    if len(query_tokens) == 0:
+    if len(terms.expressions) == 0:
       return
 
-    with self._db.connect() as (cursor, _):
-      query_with_and = " AND ".join(query_tokens)
-      if is_or_condition:
-        query_with_or = " OR ".join(query_tokens)
-        query = f"({query_with_or}) NOT ({query_with_and})"
-      else:
-        query = query_with_and
+    query_with_and = " AND ".join(terms.expressions)
+    if is_or_condition:
+      or_expressions = terms.or_expressions
+      if len(or_expressions) == 0:
+        return
+      query_with_or = " OR ".join(or_expressions)
+      query = f"({query_with_or}) NOT ({query_with_and})"
+    else:
+      query = query_with_and
+
+    query = f"\"content\": {query}"
+
+    if limit is not None:
+      yield from self._query_ranked_nodes(
+        query, terms, matching, nodes_filter, limit, offset,
+      )
+      return
 
-      query = f"\"content\": {query}"
-      fields = "N.node_id, C.content, N.metadata, N.segments"
-      sql = f"SELECT {fields} from contents C INNER JOIN nodes N ON C.rowid = N.content_id WHERE C.content MATCH ?"
-      cursor.execute(sql, (query,))
+    with self._db.connect() as (cursor, _):
+      fields = f"N.node_id, N.type, {self._document_field}, N.metadata, N.segments, N.offsets"
+      filter_sql, filter_params = self._filter_sql(nodes_filter)
+      sql = f"SELECT {fields} from contents C INNER JOIN nodes N ON C.rowid = N.content_id WHERE C.content MATCH ?{filter_sql}"
+      cursor.execute(sql, (query, *filter_params))
 
       while True:
         rows = cursor.fetchmany(size=25)
         if len(rows) == 0:
           break
         for row in rows:
-          node_id, content, metadata_json, encoded_segments = row
-          metadata: dict = json.loads(metadata_json)
-          type = metadata.get("type", "undefined")
-          segments, rank = self._analysis_segments(
-            query_tokens_set=query_tokens_set,
-            segments=self._decode_segment(content, encoded_segments),
-          )
+          node = self._row_to_node(row, terms, matching)
           # fts5 database maybe matches no keywords
-          if len(segments) > 0:
-            node = IndexNode(
-              id=node_id,
-              type=type,
-              matching=matching,
-              metadata=metadata,
-              fts5_rank=rank,
-              vector_distance=0.0,
-              segments=segments,
-            )
+          if node is not None:
+            yield node
+
+  # nodes matching any token, best bm25 first. only the top `limit` rows are read from database.
+  # a node is marked as Matched only if it contains every token (or prefix) of query.
+  def query_ranked(self, query_text: str, limit: int, nodes_filter: NodesFilter | None = None) -> list[IndexNode]:
+    terms = self._parse_query(query_text)
+    nodes: list[IndexNode] = []
+
+    or_expressions = terms.or_expressions
+    if len(or_expressions) == 0:
+      return nodes
+
+    query = " OR ".join(or_expressions)
+    query = f"\"content\": ({query})"
+
+    for node in self._query_ranked_nodes(
+      query, terms, IndexNodeMatching.MatchedPartial, nodes_filter, limit, 0,
+    ):
+      matched_keys_set: set[str] = set()
+      for segment in node.segments:
+        for token in segment.matched_tokens:
+          matched_keys_set.update(terms.keys_of(token))
+      if len(matched_keys_set) == terms.keys_count:
+        node.matching = IndexNodeMatching.Matched
+      nodes.append(node)
+
+    return nodes
+
+  # the first step only sorts rowids by bm25 inside SQLite, so that the large columns of rows
+  # out of range are never copied into the sorter. the second step reads the rows in range.
+  # rows that match no keywords after analysis are skipped and replaced by following rows.
+  def _query_ranked_nodes(
+    self,
+    query: str,
+    terms: _QueryTerms,
+    matching: IndexNodeMatching,
+    nodes_filter: NodesFilter | None,
+    limit: int,
+    offset: int,
+  ) -> Generator[IndexNode, None, None]:
+
+    if limit <= 0:
+      return
+
+    with self._db.connect() as (cursor, _):
+      filter_sql, filter_params = self._filter_sql(nodes_filter)
+      if filter_sql == "":
+        sql = "SELECT C.rowid FROM contents C WHERE C.content MATCH ? ORDER BY C.rank LIMIT ? OFFSET ?"
+      else:
+        sql = f"SELECT C.rowid FROM contents C INNER JOIN nodes N ON C.rowid = N.content_id WHERE C.content MATCH ?{filter_sql} ORDER BY C.rank LIMIT ? OFFSET ?"
+      if self._contentless:
+        row_sql = "SELECT N.node_id, N.type, N.document, N.metadata, N.segments, N.offsets FROM nodes N WHERE N.content_id = ?"
+      else:
+        row_sql = "SELECT N.node_id, N.type, C.content, N.metadata, N.segments, N.offsets FROM nodes N INNER JOIN contents C ON C.rowid = N.content_id WHERE N.content_id = ?"
+
+      yielded_count: int = 0
+      while yielded_count < limit:
+        rows_limit = limit - yielded_count
+        cursor.execute(sql, (query, *filter_params, rows_limit, offset))
+        content_ids = [row[0] for row in cursor.fetchall()]
+        offset += len(content_ids)
+
+        for content_id in content_ids:
+          cursor.execute(row_sql, (content_id,))
+          row = cursor.fetchone()
+          if row is None:
+            continue
+          node = self._row_to_node(row, terms, matching)
+          if node is not None:
+            yielded_count += 1
             yield node
 
-  def save(self, node_id: str, segments: list[Segment], metadata: dict):
+        if len(content_ids) < rows_limit:
+          break
+
+  # rows are filtered by SQLite before they are decoded and analysed in Python.
+  def _filter_sql(self, nodes_filter: NodesFilter | None) -> tuple[str, list]:
+    sql: str = ""
+    params: list = []
+    if nodes_filter is None:
+      return sql, params
+
+    if nodes_filter.types is not None:
+      sql += " AND N.type IN (SELECT value FROM json_each(?))"
+      params.append(json.dumps(nodes_filter.types))
+
+    if nodes_filter.owners is not None:
+      # owner is the part of node_id before the first "/"
+      sql += " AND substr(N.node_id, 1, instr(N.node_id || '/', '/') - 1) IN (SELECT value FROM json_each(?))"
+      params.append(json.dumps(nodes_filter.owners))
+
+    return sql, params
+
+  def _row_to_node(self, row: tuple, terms: _QueryTerms, matching: IndexNodeMatching) -> IndexNode | None:
+    node_id, type, content, metadata_json, encoded_segments, encoded_offsets = row
+    if isinstance(content, bytes):
+      content = zlib.decompress(content).decode("utf-8")
+    segments = self._decode_segment(content, encoded_segments)
+    segments, rank = self._analysis_segments(
+      terms=terms,
+      segments=segments,
+      offsets=None if encoded_offsets is None else _decode_offsets(encoded_offsets, segments),
+    )
+    if len(segments) == 0:
+      return None
+
+    # column type is NULL for nodes saved without it in metadata
+    if type is None:
+      type = json.loads(metadata_json).get("type", "undefined")
+
+    return IndexNode(
+      id=node_id,
+      type=type,
+      matching=matching,
+      metadata=metadata_json,
+      fts5_rank=rank,
+      vector_distance=0.0,
+      segments=segments,
+    )
+
+  # if text is given, offsets of tokens in text are recorded, so that highlights never search text again.
+  def save(self, node_id: str, segments: list[Segment], metadata: dict, text: str | None = None):
     encoded_segments, tokens = self._encode_segments(segments)
     if len(encoded_segments) == 0:
       return
 
-    with self._db.connect() as (cursor, conn):
-      try:
-        document = " ".join(tokens)
-        cursor.execute("BEGIN TRANSACTION")
-        cursor.execute("INSERT INTO contents (content) VALUES (?)", (document,))
-        content_id = cursor.lastrowid
-        type = metadata.get("type", None)
-        metadata_json = json.dumps(metadata)
-        cursor.execute(
-          "INSERT INTO nodes (node_id, type, metadata, segments, content_id) VALUES (?, ?, ?, ?, ?)",
-          (node_id, type, metadata_json, encoded_segments, content_id),
-        )
-        conn.commit()
-
-      except Exception as e:
-        conn.rollback()
-        raise e
+    encoded_offsets: bytes | None = None
+    if text is not None:
+      encoded_offsets = self._encode_offsets(text, segments)
+
+    with self._write() as (cursor, _):
+      document = " ".join(tokens)
+      cursor.execute("INSERT INTO contents (content) VALUES (?)", (document,))
+      content_id = cursor.lastrowid
+      type = metadata.get("type", None)
+      metadata_json = json.dumps(metadata)
+      compressed_document: bytes | None = None
+      if self._contentless:
+        compressed_document = zlib.compress(document.encode("utf-8"))
+      cursor.execute(
+        "INSERT INTO nodes (node_id, type, metadata, segments, content_id, document, offsets) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (node_id, type, metadata_json, encoded_segments, content_id, compressed_document, encoded_offsets),
+      )
+    self._increase_writes_count()
 
   def remove(self, node_id: str):
-    with self._db.connect() as (cursor, conn):
-      try:
-        cursor.execute("SELECT content_id FROM nodes WHERE node_id = ?", (node_id,))
-        row = cursor.fetchone()
-        if row is not None:
-          cursor.execute("BEGIN TRANSACTION")
-          content_id = row[0]
-          cursor.execute("DELETE FROM contents WHERE rowid = ?", (content_id,))
-          cursor.execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
-          conn.commit()
+    with self._write() as (cursor, _):
+      cursor.execute("SELECT content_id, document FROM nodes WHERE node_id = ?", (node_id,))
+      row = cursor.fetchone()
+      if row is None:
+        return
+      content_id, compressed_document = row
+      if compressed_document is None:
+        cursor.execute("DELETE FROM contents WHERE rowid = ?", (content_id,))
+      else:
+        # contentless table can only delete a row with the same document as inserted.
+        # to see: https://www.sqlite.org/fts5.html#the_delete_command
+        cursor.execute(
+          "INSERT INTO contents (contents, rowid, content) VALUES ('delete', ?, ?)",
+          (content_id, zlib.decompress(compressed_document).decode("utf-8")),
+        )
+      cursor.execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
+    self._increase_writes_count()
 
-      except Exception as e:
-        conn.rollback()
-        raise e
+  def _increase_writes_count(self):
+    with self._writes_lock:
+      self._writes_count += 1
 
   def _analysis_segments(
       self,
-      query_tokens_set: set[str],
-      segments: list[_Segment]) -> tuple[list[IndexSegment], float]:
+      terms: _QueryTerms,
+      segments: list[_Segment],
+      offsets: list[_TokenOffsets] | None = None) -> tuple[list[IndexSegment], float]:
 
-    query_tokens_len = len(query_tokens_set)
+    query_keys_len = terms.keys_count
     target_segments: list[IndexSegment] = []
-    match_count_list: list[bool] = [False for _ in range(query_tokens_len)]
+    match_count_list: list[bool] = [False for _ in range(query_keys_len)]
 
-    for start, end, tokens in segments:
+    for i, (start, end, tokens) in enumerate(segments):
       matched_tokens_set = set()
+      matched_keys_set = set()
       for token in tokens:
-        if token in query_tokens_set:
+        keys = terms.keys_of(token)
+        if len(keys) > 0:
           matched_tokens_set.add(token)
+          matched_keys_set.update(keys)
       matched_tokens = list(matched_tokens_set)
       matched_tokens.sort()
 
       if len(matched_tokens) > 0:
-        match_count_list[query_tokens_len - len(matched_tokens)] = True
+        highlights: list[tuple[int, int]] | None = None
+        if offsets is not None:
+          highlights = []
+          for token in matched_tokens:
+            for token_start in offsets[i].get(token, ()):
+              highlights.append((token_start, token_start + len(token)))
+          highlights.sort(key=lambda h: h[0])
+
+        match_count_list[query_keys_len - len(matched_keys_set)] = True
         target_segments.append(IndexSegment(
           start=start,
           end=end,
-          fts5_rank=-len(matched_tokens),
+          fts5_rank=-len(matched_keys_set),
           vector_distance=0.0,
-          matched_tokens=matched_tokens
+          matched_tokens=matched_tokens,
+          highlights=highlights,
         ))
 
     sum_rank = 0.0
@@ -145,38 +511,219 @@ class FTS5DB:
 
     return target_segments, rank
 
-  def _encode_segments(self, segments: list[Segment]) -> tuple[str, list[str]]:
-    encoded: list[str] = []
+  def _encode_segments(self, segments: list[Segment]) -> tuple[bytes, list[str]]:
+    encoded: list[int] = []
     tokens: list[str] = []
 
     for s in segments:
       segment_tokens = self._split_tokens(s.text.lower())
       if len(segment_tokens) == 0:
         continue
-      encoded.append(f"{len(segment_tokens)}:{s.start}-{s.end}")
+      encoded.extend((len(segment_tokens), s.start, s.end))
       for k in segment_tokens:
         tokens.append(k)
 
-    return ",".join(encoded), tokens
+    return struct.pack(f"<{len(encoded)}I", *encoded), tokens
 
-  def _decode_segment(self, content: str, segments: str) -> list[_Segment]:
+  # for each segment and each distinct token of it (in the order of first appearance), packed as
+  # uint32 of occurrences count followed by start offsets relative to segment start.
+  # text is searched the same way as highlights used to be searched when querying.
+  def _encode_offsets(self, text: str, segments: list[Segment]) -> bytes:
+    text = text.lower()
+    encoded: list[int] = []
+
+    for s in segments:
+      segment_tokens = self._split_tokens(s.text.lower())
+      if len(segment_tokens) == 0:
+        continue
+      for token in dict.fromkeys(segment_tokens):
+        token_starts: list[int] = []
+        finding_start = s.start
+        while finding_start < s.end:
+          index = text.find(token, finding_start, s.end)
+          if index == -1:
+            break
+          token_starts.append(index - s.start)
+          finding_start = index + len(token)
+        encoded.append(len(token_starts))
+        encoded.extend(token_starts)
+
+    return struct.pack(f"<{len(encoded)}I", *encoded)
+
+  def _decode_segment(self, content: str, segments: bytes) -> list[_Segment]:
     decoded: list[tuple[int, int, list[str]]] = []
     tokens = content.split(" ")
     offset: int = 0
 
-    for segment in segments.split(","):
-      parts = segment.split(":", 1)
-      token_count, position = parts
-      token_count = int(token_count)
-      start, end = position.split("-")
-      start = int(start)
-      end = int(end)
+    for token_count, start, end in _SEGMENT_STRUCT.iter_unpack(segments):
       segment_tokens = tokens[offset:offset + token_count]
       offset += token_count
       decoded.append((start, end, segment_tokens))
 
     return decoded
 
+  def _migrate(self):
+    with self._db.connect() as (cursor, conn):
+      cursor.execute("PRAGMA user_version")
+      version: int = cursor.fetchone()[0]
+      if version >= _SCHEMA_VERSION:
+        return
+      try:
+        cursor.execute("BEGIN TRANSACTION")
+        if version < 1:
+          self._migrate_text_segments(cursor)
+        if version < 2:
+          cursor.execute("ALTER TABLE nodes ADD COLUMN document BLOB")
+        if version < 3:
+          cursor.execute("ALTER TABLE nodes ADD COLUMN offsets BLOB")
+        if version < 4:
+          _create_vocab_table(cursor)
+        cursor.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        conn.commit()
+      except Exception as e:
+        conn.rollback()
+        raise e
+
+  def _convert_storage(self, contentless: bool | None) -> FTS5StorageMigration | None:
+    with self._db.connect() as (cursor, conn):
+      cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'contents'")
+      table_sql = cursor.fetchone()[0].replace(" ", "")
+      is_contentless = "content=''" in table_sql
+      if contentless is None:
+        contentless = is_contentless
+      self._contentless = contentless
+      # tables created before prefix indexes are rebuilt as well
+      has_prefix_index = "prefix=" in table_sql
+      if is_contentless == contentless and has_prefix_index:
+        return None
+
+      size_before = os.path.getsize(self._db.path)
+      try:
+        cursor.execute("BEGIN TRANSACTION")
+        cursor.execute("DROP TABLE IF EXISTS contents_converting")
+        _create_contents_table(cursor, "contents_converting", contentless)
+        cursor.execute("SELECT node_id, content_id FROM nodes")
+        for node_id, content_id in cursor.fetchall():
+          if is_contentless:
+            cursor.execute("SELECT document FROM nodes WHERE node_id = ?", (node_id,))
+            document = zlib.decompress(cursor.fetchone()[0]).decode("utf-8")
+          else:
+            cursor.execute("SELECT content FROM contents WHERE rowid = ?", (content_id,))
+            document = cursor.fetchone()[0]
+          compressed_document: bytes | None = None
+          if contentless:
+            compressed_document = zlib.compress(document.encode("utf-8"))
+          cursor.execute(
+            "INSERT INTO contents_converting (rowid, content) VALUES (?, ?)",
+            (content_id, document),
+          )
+          cursor.execute(
+            "UPDATE nodes SET document = ? WHERE node_id = ?",
+            (compressed_document, node_id),
+          )
+        cursor.execute("DROP TABLE contents")
+        cursor.execute("ALTER TABLE contents_converting RENAME TO contents")
+        conn.commit()
+      except Exception as e:
+        conn.rollback()
+        raise e
+
+      cursor.execute("VACUUM")
+
+    return FTS5StorageMigration(
+      contentless=contentless,
+      size_before=size_before,
+      size_after=os.path.getsize(self._db.path),
+    )
+
+  def _migrate_text_segments(self, cursor: Cursor):
+    cursor.execute("SELECT node_id, segments FROM nodes WHERE typeof(segments) = 'text'")
+    rows = cursor.fetchall()
+    for node_id, text_segments in rows:
+      encoded: list[int] = []
+      for segment in text_segments.split(","):
+        token_count, position = segment.split(":", 1)
+        start, end = position.split("-")
+        encoded.extend((int(token_count), int(start), int(end)))
+      cursor.execute(
+        "UPDATE nodes SET segments = ? WHERE node_id = ?",
+        (struct.pack(f"<{len(encoded)}I", *encoded), node_id),
+      )
+
+  # plain words are joined by AND (or OR), phrases and NEAR groups are kept as they are,
+  # and prefix terms use the prefix index. all of them are evaluated by SQLite.
+  def _parse_query(self, query_text: str) -> _QueryTerms:
+    plain_text, syntax_list = split_query_syntax(query_text)
+    terms = _QueryTerms(expressions=[], tokens=set(), prefixes=set(), weak_expressions=set())
+    plain_tokens = list(dict.fromkeys(self._split_tokens(plain_text)))
+    common_tokens = self._common_tokens(plain_tokens)
+
+    # a query made of common tokens only is kept as it is
+    if len(common_tokens) == len(plain_tokens) and len(syntax_list) == 0:
+      common_tokens = set()
+
+    for token in plain_tokens:
+      expression = _quote(token)
+      if token in common_tokens:
+        if self._drop_common_terms:
+          continue
+        terms.weak_expressions.add(expression)
+      terms.expressions.append(expression)
+      terms.tokens.add(token)
+
+    for syntax in syntax_list:
+      if syntax.kind == "near":
+        phrases: list[str] = []
+        for word in syntax.text.split(" "):
+          phrase = self._parse_phrase(word.rstrip("*"), word.endswith("*"), terms)
+          if phrase is not None:
+            phrases.append(phrase)
+        if len(phrases) == 1:
+          terms.expressions.append(phrases[0])
+        elif len(phrases) > 1:
+          terms.expressions.append(f"NEAR({' '.join(phrases)}, {syntax.distance})")
+      else:
+        phrase = self._parse_phrase(syntax.text, syntax.kind == "prefix", terms)
+        if phrase is not None:
+          terms.expressions.append(phrase)
+
+    return terms
+
+  # document frequencies are read from the fts5vocab table, which is computed from the index itself.
+  # the count of rows is kept by FTS5 in its averages record, so that nodes are never counted.
+  def _common_tokens(self, tokens: list[str]) -> set[str]:
+    common_tokens: set[str] = set()
+    if self._max_df_ratio is None or len(tokens) == 0:
+      return common_tokens
+
+    with self._db.connect() as (cursor, _):
+      cursor.execute("SELECT block FROM contents_data WHERE id = 1")
+      row = cursor.fetchone()
+      nodes_count = 0 if row is None else _parse_averages_record(row[0])
+      if nodes_count == 0:
+        return common_tokens
+
+      for token in tokens:
+        cursor.execute("SELECT doc FROM contents_vocab WHERE term = ?", (_vocab_term(token),))
+        row = cursor.fetchone()
+        if row is not None and row[0] / nodes_count > self._max_df_ratio:
+          common_tokens.add(token)
+
+    return common_tokens
+
+  def _parse_phrase(self, text: str, is_prefix: bool, terms: _QueryTerms) -> str | None:
+    tokens = self._split_tokens(text)
+    if len(tokens) == 0:
+      return None
+
+    if is_prefix and len(tokens[-1]) >= _MIN_PREFIX_LENGTH:
+      terms.tokens.update(tokens[:-1])
+      terms.prefixes.add(tokens[-1])
+      return f"{_quote(' '.join(tokens))}*"
+    else:
+      terms.tokens.update(tokens)
+      return _quote(" ".join(tokens))
+
   def _split_tokens(self, text: str) -> list[str]:
     text = re.sub(r"[-+:!\"'\{\},\.]", " ", text)
     text = re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f ]+", " ", text)
@@ -202,26 +749,110 @@ class FTS5DB:
         weights[i] /= sum_weight
     return weights
 
-def _create_tables(cursor: Cursor):
+# terms of fts5vocab are folded by tokenizer unicode61 with remove_diacritics 2.
+def _vocab_term(token: str) -> str:
+  decomposed = unicodedata.normalize("NFKD", token)
+  return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def _quote(text: str) -> str:
+  text = text.replace("\"", "\"\"")
+  return f"\"{text}\""
+
+def _decode_offsets(encoded: bytes, segments: list[_Segment]) -> list[_TokenOffsets]:
+  values = struct.unpack(f"<{len(encoded) // 4}I", encoded)
+  offsets: list[_TokenOffsets] = []
+  index: int = 0
+
+  for _, _, tokens in segments:
+    token_offsets: _TokenOffsets = {}
+    for token in dict.fromkeys(tokens):
+      count = values[index]
+      token_offsets[token] = list(values[index + 1:index + 1 + count])
+      index += 1 + count
+    offsets.append(token_offsets)
+
+  return offsets
+
+# rowid 1 of %_data is the averages record: count of rows, then count of tokens of each column.
+def _parse_averages_record(record: bytes) -> int:
+  rows_count, _ = _read_varint(record, 0)
+  return rows_count
+
+# returns (levels count, segments count, segments count of each level).
+# segments of each level are not listed for the structure record of contentless_delete tables.
+def _parse_structure_record(record: bytes) -> tuple[int, int, list[int]]:
+  offset: int = 4 # cookie
+
+  def read_varint() -> int:
+    nonlocal offset
+    value, offset = _read_varint(record, offset)
+    return value
+
+  is_v2 = record[4:8] == b"\xff\x00\x00\x01"
+  if is_v2:
+    offset += 4
+  levels_count = read_varint()
+  segments_count = read_varint()
+  read_varint() # write counter
+
+  level_segments: list[int] = []
+  if not is_v2:
+    for _ in range(levels_count):
+      read_varint() # segments being merged
+      level_segments_count = read_varint()
+      for _ in range(level_segments_count * 3):
+        read_varint() # segment id, first and last page
+      level_segments.append(level_segments_count)
+
+  return levels_count, segments_count, level_segments
+
+# returns (value, offset after it)
+def _read_varint(record: bytes, offset: int) -> tuple[int, int]:
+  value: int = 0
+  for i in range(9):
+    byte = record[offset]
+    offset += 1
+    if i == 8:
+      return (value << 8) | byte, offset
+    value = (value << 7) | (byte & 0x7F)
+    if byte & 0x80 == 0:
+      break
+  return value, offset
+
+def _create_contents_table(cursor: Cursor, name: str, contentless: bool):
   # unicode61 remove_diacritics 2 means: diacritics are correctly removed from all Latin characters.
   # to see: https://www.sqlite.org/fts5.html
-  cursor.execute("""
-    CREATE VIRTUAL TABLE contents USING fts5(
+  # prefix = '2 3' builds indexes for prefixes of 2 and 3 characters, so that `term*` is not a full scan.
+  content_option = "content = '',\n" if contentless else ""
+  cursor.execute(f"""
+    CREATE VIRTUAL TABLE {name} USING fts5(
       content,
+      {content_option}prefix = '2 3',
       tokenize = "unicode61 remove_diacritics 2"
     );
   """)
+
+# to see: https://www.sqlite.org/fts5.html#the_fts5vocab_virtual_table_module
+def _create_vocab_table(cursor: Cursor):
+  cursor.execute("CREATE VIRTUAL TABLE contents_vocab USING fts5vocab(contents, 'row')")
+
+def _create_tables(cursor: Cursor):
+  _create_contents_table(cursor, "contents", contentless=False)
+  _create_vocab_table(cursor)
   cursor.execute("""
     CREATE TABLE nodes (
       node_id TEXT PRIMARY KEY,
       type TEXT,
       metadata TEXT NOT NULL,
-      segments TEXT NOT NULL,
-      content_id INTEGER NOT NULL
+      segments BLOB NOT NULL,
+      content_id INTEGER NOT NULL,
+      document BLOB,
+      offsets BLOB
     )
   """)
   cursor.execute("""
     CREATE INDEX idx_nodes ON nodes (content_id)
   """)
+  cursor.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
 
 register_table_creators("fts5", _create_tables)
\ No newline at end of file
@@ -0,0 +1,54 @@
+from time import time
+from threading import Lock
+from .fts5_db import FTS5DB, FTS5Stats
+
+# Thread safety
+# b-tree segments of FTS5 fragment after lots of saving and removing. it merges them in small slices,
+# so that it can be called when the index is idle without blocking writers for long.
+class FTS5Maintenance:
+  def __init__(
+    self,
+    fts5_db: FTS5DB,
+    merge_pages: int = 64,
+    writes_threshold: int = 500,
+    max_segments: int = 16,
+  ):
+    self._fts5_db: FTS5DB = fts5_db
+    self._merge_pages: int = merge_pages
+    self._writes_threshold: int = writes_threshold
+    self._max_segments: int = max_segments
+    self._lock: Lock = Lock()
+    self._merged_writes_count: int = 0
+
+  @property
+  def stats(self) -> FTS5Stats:
+    return self._fts5_db.stats()
+
+  @property
+  def needs_merge(self) -> bool:
+    with self._lock:
+      writes_count = self._fts5_db.writes_count - self._merged_writes_count
+    if writes_count >= self._writes_threshold:
+      return True
+    return self._fts5_db.stats().segments_count > self._max_segments
+
+  # merges until nothing to merge or time_budget (in seconds) used up.
+  # returns True if fully merged.
+  def run_slice(self, time_budget: float) -> bool:
+    if not self.needs_merge:
+      return True
+
+    with self._lock:
+      writes_count = self._fts5_db.writes_count
+      deadline = time() + time_budget
+      while time() < deadline:
+        if not self._fts5_db.merge(self._merge_pages):
+          self._merged_writes_count = writes_count
+          return True
+      return False
+
+  def optimize(self):
+    with self._lock:
+      writes_count = self._fts5_db.writes_count
+      self._fts5_db.optimize()
+      self._merged_writes_count = writes_count
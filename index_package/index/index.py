@@ -3,15 +3,18 @@ from __future__ import annotations
 import os
 import io
 
+from threading import Lock
 from sqlite3 import Cursor
 from .fts5_db import FTS5DB
 from .vector_db import VectorDB
 from .index_db import IndexDB
-from .types import IndexNode, PageRelativeToPDF
+from .query_cache import QueryCache
+from .query_syntax import split_query_syntax, QuerySyntax
+from .types import IndexNode, PageRelativeToPDF, RRFRanking, QueryFilter, NodesFilter
 from ..parser import PdfParser, PdfMetadata, PdfPage
 from ..scanner import Scope, Event, EventKind, EventTarget
 from ..segmentation import Segment, Segmentation
-from ..utils import hash_sha512, ensure_parent_dir, is_empty_string, assert_continue, InterruptException
+from ..utils import hash_sha512, ensure_parent_dir, is_empty_string, assert_continue, InterruptException, LRUCache
 from ..sqlite3_pool import register_table_creators, SQLite3Pool
 from ..progress_events import (
   FileFormat,
@@ -32,16 +35,31 @@ class Index:
     segmentation: Segmentation,
     fts5_db: FTS5DB,
     vector_db: VectorDB,
+    results_cache_size: int = 16 * 1024 * 1024,
+    query_cache: QueryCache | None = None,
   ):
     self._scope: Scope = scope
     self._pdf_parser: PdfParser = pdf_parser
     self._segmentation: Segmentation = segmentation
-    self._index_db: IndexDB = IndexDB(fts5_db, vector_db)
+    self._query_cache: QueryCache | None = query_cache
+    self._index_db: IndexDB = IndexDB(fts5_db, vector_db, query_cache=query_cache)
     db = SQLite3Pool(
       format_name="index",
       path=ensure_parent_dir(os.path.join(index_dir_path, "index.sqlite3")),
     )
     self._db: SQLite3Pool = db.assert_format("index")
+    self._generation_lock: Lock = Lock()
+    self._generation: int = 0
+    self._results_cache: LRUCache[tuple, list[IndexNode]] = LRUCache(
+      max_size=results_cache_size,
+      sizeof=_sizeof_nodes,
+    )
+
+  # increases every time index may be changed. results of query are only valid in the same generation.
+  @property
+  def generation(self) -> int:
+    with self._generation_lock:
+      return self._generation
 
   def get_paths(self, file_hash: str) -> list[str]:
     with self._db.connect() as (cursor, _):
@@ -92,20 +110,108 @@ class Index:
     self,
     query_text: str,
     results_limit: int,
-    to_keywords: bool = True) -> tuple[list[IndexNode], list[str]]:
+    to_keywords: bool = True,
+    concurrent: bool = False,
+    ranking: RRFRanking | None = None,
+    query_filter: QueryFilter | None = None) -> tuple[list[IndexNode], list[str]]:
 
     if to_keywords:
-      keywords = self._segmentation.to_keywords(query_text)
+      # phrases, NEAR groups and prefix terms are passed to FTS5 without their stop words
+      plain_text, syntax_list = split_query_syntax(query_text)
+      if is_empty_string(plain_text):
+        keywords = []
+      else:
+        keywords = self._to_keywords(plain_text)
+      for syntax in syntax_list:
+        syntax = self._remove_stop_words(syntax)
+        if syntax is not None:
+          keywords.append(str(syntax))
       query_text = " ".join(keywords)
     else:
       keywords = [query_text]
 
     if is_empty_string(query_text):
-      query_nodes = []
+      return [], keywords
+
+    # concurrent only affects latency, so it is not a part of key
+    generation = self.generation
+    cache_key = (tuple(k.lower() for k in keywords), to_keywords, results_limit, ranking, query_filter)
+    query_nodes = self._results_cache.get(cache_key, generation)
+
+    if query_nodes is None:
+      nodes_filter = self._resolve_query_filter(query_filter)
+      if nodes_filter is not None and nodes_filter.owners is not None and len(nodes_filter.owners) == 0:
+        query_nodes = []
+      else:
+        query_nodes = self._index_db.query(
+          query_text, results_limit, concurrent, ranking,
+          nodes_filter=nodes_filter,
+        )
+      self._results_cache.put(cache_key, query_nodes, generation)
+
+    return list(query_nodes), keywords
+
+  def _to_keywords(self, text: str) -> list[str]:
+    if self._query_cache is None:
+      return self._segmentation.to_keywords(text)
     else:
-      query_nodes = self._index_db.query(query_text, results_limit)
+      return self._query_cache.keywords(text, self._segmentation.to_keywords)
+
+  # text of segments is indexed without stop words (see Segmentation), so that a phrase
+  # such as "state of the art" must be searched as "state art" to match.
+  # words with "*" of NEAR groups are prefixes, which are kept as they are.
+  def _remove_stop_words(self, syntax: QuerySyntax) -> QuerySyntax | None:
+    if syntax.kind == "prefix":
+      return syntax
+    words = syntax.text.split(" ")
+    prefix_words = [w for w in words if w.endswith("*")]
+    plain_text = " ".join(w for w in words if not w.endswith("*"))
+    keywords = [] if is_empty_string(plain_text) else self._to_keywords(plain_text)
+    keywords.extend(prefix_words)
+    if len(keywords) == 0:
+      return None
+    return QuerySyntax(
+      kind=syntax.kind,
+      text=" ".join(keywords),
+      distance=syntax.distance,
+    )
+
+  # scope and path are resolved into hashes of PDF files and their pages with index.sqlite3
+  def _resolve_query_filter(self, query_filter: QueryFilter | None) -> NodesFilter | None:
+    if query_filter is None:
+      return None
+    if query_filter.scope is None and query_filter.path_prefix is None:
+      return NodesFilter(types=query_filter.types)
+
+    with self._db.connect() as (cursor, _):
+      conditions: list[str] = []
+      params: list[str] = []
+
+      if query_filter.scope is not None:
+        conditions.append("scope = ?")
+        params.append(query_filter.scope)
+
+      if query_filter.path_prefix is not None:
+        path_prefix = query_filter.path_prefix.rstrip("/")
+        escaped_prefix = path_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions.append("(path = ? OR path LIKE ? ESCAPE '\\')")
+        params.append(path_prefix)
+        params.append(f"{escaped_prefix}/%")
+
+      owners: set[str] = set()
+      cursor.execute(f"SELECT DISTINCT hash FROM files WHERE {' AND '.join(conditions)}", params)
+      pdf_hashes = [row[0] for row in cursor.fetchall()]
+
+      for pdf_hash in pdf_hashes:
+        owners.add(pdf_hash)
+        cursor.execute("SELECT hash FROM pages WHERE pdf_hash = ?", (pdf_hash,))
+        for row in cursor.fetchall():
+          owners.add(row[0])
 
-    return query_nodes, keywords
+    return NodesFilter(
+      owners=tuple(sorted(owners)),
+      types=query_filter.types,
+    )
 
   def handle_event(self, event: Event, listener: ProgressEventListener):
     path = self._filter_and_get_abspath(event)
@@ -128,7 +234,7 @@ class Index:
       format=FileFormat.PDF,
       operation=operation,
     ))
-    with self._db.connect() as (cursor, conn):
+    with self._db.connect() as (cursor, conn), self._index_db.batch():
       try:
         cursor.execute("BEGIN TRANSACTION")
         new_hash, origin_id_hash = self._update_file_with_event(cursor, path, event)
@@ -156,6 +262,13 @@ class Index:
         conn.rollback()
         raise e
 
+      finally:
+        # FTS5 and vector databases may be changed even if the transaction is rolled back.
+        # they are flushed before queries can see the new generation.
+        self._index_db.flush()
+        with self._generation_lock:
+          self._generation += 1
+
   def _filter_and_get_abspath(self, event: Event) -> str | None:
     if event.target == EventTarget.Directory:
       return
@@ -252,7 +365,7 @@ class Index:
       page_hashes.append(row[0])
 
     cursor.execute("DELETE FROM pages WHERE pdf_hash = ?", (hash,))
-    self._index_db.remove(hash)
+    removed_node_ids: list[str] = [hash]
 
     for page_hash in page_hashes:
       cursor.execute("SELECT * FROM pages WHERE hash = ? LIMIT 1", (page_hash,))
@@ -261,10 +374,12 @@ class Index:
         if page is not None:
           for index, anno in enumerate(page.annotations):
             if anno.content is not None:
-              self._index_db.remove(f"{page.hash}/anno/{index}/content")
+              removed_node_ids.append(f"{page.hash}/anno/{index}/content")
             if anno.extracted_text is not None:
-              self._index_db.remove(f"{page.hash}/anno/{index}/extracted")
-          self._index_db.remove(page.hash)
+              removed_node_ids.append(f"{page.hash}/anno/{index}/extracted")
+          removed_node_ids.append(page.hash)
+
+    self._index_db.remove_nodes(removed_node_ids)
 
     self._pdf_parser.fire_file_removed(hash)
 
@@ -318,14 +433,24 @@ class _IndexContext:
       properties.copy()
       properties["type"] = type
 
-    self._index_db.save(id, segments, properties)
+    self._index_db.save(id, segments, properties, text)
     self._added_ids.append(id)
 
   def rollback(self):
-    for id in self._added_ids:
-      self._index_db.remove(id)
+    self._index_db.remove_nodes(self._added_ids)
     self._added_ids.clear()
 
+# roughly estimate memory of nodes, only counts what grows with content.
+def _sizeof_nodes(nodes: list[IndexNode]) -> int:
+  size: int = 64
+  for node in nodes:
+    size += 256 + len(node.id) + len(node.type)
+    for segment in node.segments:
+      size += 128
+      for token in segment.matched_tokens:
+        size += 56 + len(token)
+  return size
+
 def _create_tables(cursor: Cursor):
   cursor.execute("""
     CREATE TABLE files (
@@ -1,30 +1,72 @@
-from .types import IndexNode, IndexNodeMatching
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+
+from .types import IndexNode, IndexNodeMatching, RRFRanking, NodesFilter
 from .fts5_db import FTS5DB
 from .vector_db import VectorDB, Embedding
+from .query_cache import QueryCache
+from .query_syntax import strip_query_syntax
 from ..segmentation import Segment
 
 class IndexDB:
-  def __init__(self, fts5_db: FTS5DB, vector_db: VectorDB):
+  def __init__(
+    self,
+    fts5_db: FTS5DB,
+    vector_db: VectorDB,
+    query_workers: int = 3,
+    query_cache: QueryCache | None = None,
+  ):
     self._fts5_db: FTS5DB = fts5_db
     self._vector_db: VectorDB = vector_db
+    self._query_cache: QueryCache | None = query_cache
+    self._query_workers: int = query_workers
+    self._executor_lock: Lock = Lock()
+    self._executor: ThreadPoolExecutor | None = None
 
-  def save(self, node_id: str, segments: list[Segment], metadata: dict):
-    self._fts5_db.save(node_id, segments, metadata)
+  def save(self, node_id: str, segments: list[Segment], metadata: dict, text: str | None = None):
+    self._fts5_db.save(node_id, segments, metadata, text)
     self._vector_db.save(node_id, segments, metadata)
 
   def remove(self, node_id: str):
     self._fts5_db.remove(node_id)
     self._vector_db.remove(node_id)
 
-  def query(self, query: str, results_limit: int) -> list[IndexNode]:
+  def remove_nodes(self, node_ids: list[str]):
+    for node_id in node_ids:
+      self._fts5_db.remove(node_id)
+    self._vector_db.remove_nodes(node_ids)
+
+  # writes of FTS5 database in the block are committed together when it exits
+  def batch(self):
+    return self._fts5_db.batch()
+
+  def flush(self):
+    self._fts5_db.flush()
+
+  def query(
+    self,
+    query: str,
+    results_limit: int,
+    concurrent: bool = False,
+    ranking: RRFRanking | None = None,
+    nodes_filter: NodesFilter | None = None,
+  ) -> list[IndexNode]:
+
+    if ranking is not None:
+      return self._query_with_rrf(query, results_limit, ranking, concurrent, nodes_filter)
+    if concurrent:
+      return self._query_concurrently(query, results_limit, nodes_filter)
+
     matched_node_ids: set[str] = set()
     matched_nodes: list[IndexNode] = []
 
-    query_embedding = self._vector_db.encode_embedding(query)
+    query_embedding = self._encode_embedding(query)
     generator = self._fts5_db.query(
       query,
       matching=IndexNodeMatching.Matched,
       is_or_condition=False,
+      nodes_filter=nodes_filter,
+      limit=results_limit,
     )
     for node in generator:
       matched_node_ids.add(node.id)
@@ -38,6 +80,8 @@ class IndexDB:
       query,
       matching=IndexNodeMatching.MatchedPartial,
       is_or_condition=True,
+      nodes_filter=nodes_filter,
+      limit=results_limit - len(matched_nodes),
     )
     for node in generator:
       matched_node_ids.add(node.id)
@@ -53,6 +97,7 @@ class IndexDB:
       query_embedding=query_embedding,
       matching=IndexNodeMatching.Similarity,
       results_limit=results_limit,
+      nodes_filter=nodes_filter,
     )
     for node in nodes:
       if not node.id in matched_node_ids:
@@ -65,6 +110,152 @@ class IndexDB:
       similarity_nodes
     )
 
+  # encoding and the FTS5 tiers run at the same time on the executor and are merged with the same rules
+  # as the sequential query, so the result is identical. each FTS5 tier can never contribute more than
+  # results_limit nodes (best bm25 first), so that is all they fetch. the vector tier only runs once the
+  # FTS5 tiers come up short, since its result is thrown away otherwise.
+  def _query_concurrently(self, query: str, results_limit: int, nodes_filter: NodesFilter | None) -> list[IndexNode]:
+    executor = self._get_executor()
+    embedding_future: Future[Embedding] = executor.submit(
+      self._encode_embedding, query,
+    )
+    matched_future: Future[list[IndexNode]] = executor.submit(
+      self._collect_fts5_nodes, query, results_limit, IndexNodeMatching.Matched, nodes_filter,
+    )
+    part_matched_future: Future[list[IndexNode]] = executor.submit(
+      self._collect_fts5_nodes, query, results_limit, IndexNodeMatching.MatchedPartial, nodes_filter,
+    )
+    query_embedding = embedding_future.result()
+    matched_nodes = matched_future.result()
+
+    if len(matched_nodes) >= results_limit:
+      part_matched_future.cancel()
+      return self._do_closing_of_matched_nodes(query_embedding, matched_nodes)
+
+    self._do_closing_of_matched_nodes(query_embedding, matched_nodes)
+    part_matched_nodes = part_matched_future.result()
+    part_matched_nodes = part_matched_nodes[:results_limit - len(matched_nodes)]
+    self._do_closing_of_matched_nodes(query_embedding, part_matched_nodes)
+
+    if len(matched_nodes) + len(part_matched_nodes) >= results_limit:
+      return matched_nodes + part_matched_nodes
+
+    # reach here means both FTS5 tiers were exhausted, just like the sequential query.
+    matched_node_ids: set[str] = set(n.id for n in matched_nodes + part_matched_nodes)
+    similarity_nodes: list[IndexNode] = []
+    for node in self._vector_db.query(
+      query_embedding=query_embedding,
+      matching=IndexNodeMatching.Similarity,
+      results_limit=results_limit,
+      nodes_filter=nodes_filter,
+    ):
+      if not node.id in matched_node_ids:
+        similarity_nodes.append(node)
+    similarity_nodes.sort(key=self._sort_key)
+
+    return (
+      matched_nodes +
+      part_matched_nodes +
+      similarity_nodes
+    )
+
+  def _query_with_rrf(
+    self,
+    query: str,
+    results_limit: int,
+    ranking: RRFRanking,
+    concurrent: bool,
+    nodes_filter: NodesFilter | None,
+  ) -> list[IndexNode]:
+
+    candidates_limit = ranking.candidates_limit
+    if candidates_limit is None:
+      candidates_limit = results_limit
+
+    if concurrent:
+      executor = self._get_executor()
+      embedding_future: Future[Embedding] = executor.submit(
+        self._encode_embedding, query,
+      )
+      fts5_future: Future[list[IndexNode]] = executor.submit(
+        self._fts5_db.query_ranked, query, candidates_limit, nodes_filter,
+      )
+      query_embedding = embedding_future.result()
+      similarity_nodes = self._vector_db.query(
+        query_embedding=query_embedding,
+        matching=IndexNodeMatching.Similarity,
+        results_limit=candidates_limit,
+        nodes_filter=nodes_filter,
+      )
+      fts5_nodes = fts5_future.result()
+    else:
+      query_embedding = self._encode_embedding(query)
+      fts5_nodes = self._fts5_db.query_ranked(query, candidates_limit, nodes_filter)
+      similarity_nodes = self._vector_db.query(
+        query_embedding=query_embedding,
+        matching=IndexNodeMatching.Similarity,
+        results_limit=candidates_limit,
+        nodes_filter=nodes_filter,
+      )
+
+    scores: dict[str, float] = {}
+    id2node: dict[str, IndexNode] = {}
+
+    for rank, node in enumerate(fts5_nodes):
+      scores[node.id] = ranking.fts5_weight / (ranking.k + rank + 1)
+      id2node[node.id] = node
+
+    for rank, node in enumerate(similarity_nodes):
+      score = ranking.vector_weight / (ranking.k + rank + 1)
+      scores[node.id] = scores.get(node.id, 0.0) + score
+      matched_node = id2node.get(node.id, None)
+      if matched_node is None:
+        id2node[node.id] = node
+      else:
+        matched_node.vector_distance = node.vector_distance
+
+    node_ids = sorted(scores.keys(), key=lambda id: -scores[id])
+    nodes = [id2node[id] for id in node_ids[:results_limit]]
+
+    # only FTS5 nodes missed by vector side need their distances, and only for returned nodes.
+    similarity_ids = set(node.id for node in similarity_nodes)
+    self._do_closing_of_matched_nodes(
+      query_embedding,
+      [n for n in nodes if n.matching != IndexNodeMatching.Similarity and not n.id in similarity_ids],
+    )
+    return nodes
+
+  def _collect_fts5_nodes(
+    self,
+    query: str,
+    results_limit: int,
+    matching: IndexNodeMatching,
+    nodes_filter: NodesFilter | None,
+  ) -> list[IndexNode]:
+    generator = self._fts5_db.query(
+      query,
+      matching=matching,
+      is_or_condition=matching == IndexNodeMatching.MatchedPartial,
+      nodes_filter=nodes_filter,
+      limit=results_limit,
+    )
+    return list(generator)
+
+  def _encode_embedding(self, query: str) -> Embedding:
+    query = strip_query_syntax(query)
+    if self._query_cache is None:
+      return self._vector_db.encode_embedding(query)
+    return self._query_cache.embedding(query, self._vector_db.encode_embedding)
+
+  def _get_executor(self) -> ThreadPoolExecutor:
+    with self._executor_lock:
+      if self._executor is None:
+        self._executor = ThreadPoolExecutor(
+          max_workers=self._query_workers,
+          thread_name_prefix="index_db_query",
+        )
+      return self._executor
+
   def _do_closing_of_matched_nodes(self, query_embedding: Embedding, nodes: list[IndexNode]) -> list[IndexNode]:
     for node in nodes:
       segments: list[tuple[str, int]] = []
@@ -80,4 +271,4 @@ class IndexDB:
     return nodes
 
   def _sort_key(self, node: IndexNode) -> tuple[float, float]:
-    return (-node.fts5_rank, node.vector_distance)
\ No newline at end of file
+    return (-node.fts5_rank, node.vector_distance)
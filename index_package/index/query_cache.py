@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import json
+
+from array import array
+from time import time
+from threading import Lock
+from typing import Callable
+from dataclasses import dataclass
+from sqlite3 import Cursor
+from ..utils import LRUCache
+from ..sqlite3_pool import register_table_creators, SQLite3Pool
+from .embedding_cache import embedding_model_key
+
+_Embedding = list[float]
+
+@dataclass
+class QueryCacheStats:
+  keywords_hits: int
+  keywords_misses: int
+  embedding_hits: int
+  embedding_misses: int
+  memory_size: int
+
+  @property
+  def keywords_hit_rate(self) -> float:
+    return _hit_rate(self.keywords_hits, self.keywords_misses)
+
+  @property
+  def embedding_hit_rate(self) -> float:
+    return _hit_rate(self.embedding_hits, self.embedding_misses)
+
+# Thread safety
+# caches query text -> keywords (spaCy + langid) and keywords text -> embedding (model encoding).
+# both only depend on models, never on indexed content, so they are never invalidated by indexing.
+# if db_path is given, entries are persisted and survive restarts. entries loaded from disk count as hits.
+# persisted embeddings are of the model and its backend (to see EmbeddingBackend), while keywords are shared.
+class QueryCache:
+  def __init__(
+    self,
+    embedding_model_id: str,
+    max_size: int = 8 * 1024 * 1024,
+    db_path: str | None = None,
+    max_persisted_count: int = 50000,
+    embedding_backend: str = "torch",
+  ):
+    self._model_keys: dict[str, str] = {
+      "keywords": embedding_model_id,
+      "embeddings": ":".join(embedding_model_key(embedding_model_id, embedding_backend)),
+    }
+    self._max_persisted_count: int = max_persisted_count
+    self._keywords: LRUCache[str, list[str]] = LRUCache(
+      max_size=max_size // 4,
+      sizeof=_sizeof_keywords,
+    )
+    self._embeddings: LRUCache[str, _Embedding] = LRUCache(
+      max_size=max_size - max_size // 4,
+      sizeof=_sizeof_embedding,
+    )
+    self._db: SQLite3Pool | None = None
+    self._counts_lock: Lock = Lock()
+    # rows count of each table, so that oldest rows are only deleted when over the limit
+    self._persisted_counts: dict[str, int] = {}
+    self._disk_hits: dict[str, int] = {"keywords": 0, "embeddings": 0}
+
+    if db_path is not None:
+      db = SQLite3Pool(format_name="query_cache", path=db_path)
+      self._db = db.assert_format("query_cache")
+      with self._db.connect() as (cursor, _):
+        for table in ("keywords", "embeddings"):
+          cursor.execute(f"SELECT COUNT(*) FROM {table}")
+          self._persisted_counts[table] = cursor.fetchone()[0]
+
+  @property
+  def stats(self) -> QueryCacheStats:
+    with self._counts_lock:
+      keywords_disk_hits = self._disk_hits["keywords"]
+      embedding_disk_hits = self._disk_hits["embeddings"]
+    return QueryCacheStats(
+      keywords_hits=self._keywords.hits + keywords_disk_hits,
+      keywords_misses=self._keywords.misses - keywords_disk_hits,
+      embedding_hits=self._embeddings.hits + embedding_disk_hits,
+      embedding_misses=self._embeddings.misses - embedding_disk_hits,
+      memory_size=self._keywords.size + self._embeddings.size,
+    )
+
+  def keywords(self, text: str, to_keywords: Callable[[str], list[str]]) -> list[str]:
+    keywords = self._keywords.get(text)
+    if keywords is None:
+      keywords = self._load_keywords(text)
+      if keywords is None:
+        keywords = to_keywords(text)
+        self._persist("keywords", text, json.dumps(keywords, ensure_ascii=False))
+      self._keywords.put(text, keywords)
+    return list(keywords)
+
+  def embedding(self, text: str, encode: Callable[[str], _Embedding]) -> _Embedding:
+    embedding = self._embeddings.get(text)
+    if embedding is None:
+      embedding = self._load_embedding(text)
+      if embedding is None:
+        embedding = [float(v) for v in encode(text)]
+        self._persist("embeddings", text, array("f", embedding).tobytes())
+      self._embeddings.put(text, embedding)
+    return embedding
+
+  def _load_keywords(self, text: str) -> list[str] | None:
+    value = self._load("keywords", text)
+    if value is None:
+      return None
+    return json.loads(value)
+
+  def _load_embedding(self, text: str) -> _Embedding | None:
+    value = self._load("embeddings", text)
+    if value is None:
+      return None
+    embedding = array("f")
+    embedding.frombytes(value)
+    return embedding.tolist()
+
+  def _load(self, table: str, text: str) -> str | bytes | None:
+    if self._db is None:
+      return None
+    with self._db.connect() as (cursor, _):
+      cursor.execute(
+        f"SELECT value FROM {table} WHERE model_id = ? AND text = ?",
+        (self._model_keys[table], text),
+      )
+      row = cursor.fetchone()
+      if row is None:
+        return None
+    with self._counts_lock:
+      self._disk_hits[table] += 1
+    return row[0]
+
+  def _persist(self, table: str, text: str, value: str | bytes):
+    if self._db is None:
+      return
+    with self._db.connect() as (cursor, conn):
+      try:
+        cursor.execute("BEGIN TRANSACTION")
+        cursor.execute(
+          f"INSERT OR IGNORE INTO {table} (model_id, text, value, created_at) VALUES (?, ?, ?, ?)",
+          (self._model_keys[table], text, value, time()),
+        )
+        inserted_count = cursor.rowcount
+        with self._counts_lock:
+          count = self._persisted_counts[table] + inserted_count
+          excess_count = max(0, count - self._max_persisted_count)
+          self._persisted_counts[table] = count - excess_count
+
+        # oldest entries are dropped first once over the limit
+        if excess_count > 0:
+          cursor.execute(
+            f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY created_at LIMIT ?)",
+            (excess_count,),
+          )
+        conn.commit()
+      except Exception as e:
+        conn.rollback()
+        raise e
+
+def _hit_rate(hits: int, misses: int) -> float:
+  if hits + misses == 0:
+    return 0.0
+  return hits / (hits + misses)
+
+def _sizeof_keywords(keywords: list[str]) -> int:
+  return 56 + sum(56 + len(k) for k in keywords)
+
+def _sizeof_embedding(embedding: _Embedding) -> int:
+  return 56 + 32 * len(embedding)
+
+def _create_tables(cursor: Cursor):
+  for table, value_type in (("keywords", "TEXT"), ("embeddings", "BLOB")):
+    cursor.execute(f"""
+      CREATE TABLE {table} (
+        model_id TEXT NOT NULL,
+        text TEXT NOT NULL,
+        value {value_type} NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (model_id, text)
+      )
+    """)
+    cursor.execute(f"""
+      CREATE INDEX idx_{table}_created_at ON {table} (created_at)
+    """)
+
+register_table_creators("query_cache", _create_tables)
@@ -0,0 +1,74 @@
+import re
+
+from dataclasses import dataclass
+from typing import Literal
+
+QuerySyntaxKind = Literal["phrase", "near", "prefix"]
+
+_NEAR_DISTANCE = 10
+
+# NEAR groups, quoted phrases and prefix terms, such as `NEAR(dream wish, 5)`, `"free association"` and `transfer*`.
+# to see: https://www.sqlite.org/fts5.html#full_text_query_syntax
+_SYNTAX_PATTERN = re.compile(
+  r"NEAR\(([^()]*?)(?:,\s*(\d+))?\s*\)"
+  r"|\"([^\"]*)\""
+  r"|([^\s\"()*]+)\*"
+)
+
+@dataclass(frozen=True)
+class QuerySyntax:
+  kind: QuerySyntaxKind
+  # words inside, separated by spaces. words of NEAR group may end with "*"
+  text: str
+  distance: int = _NEAR_DISTANCE
+
+  def __str__(self) -> str:
+    if self.kind == "phrase":
+      return f"\"{self.text}\""
+    elif self.kind == "near":
+      return f"NEAR({self.text}, {self.distance})"
+    else:
+      return f"{self.text}*"
+
+# returns text without syntax, and syntax in the order of appearance.
+def split_query_syntax(text: str) -> tuple[str, list[QuerySyntax]]:
+  syntax_list: list[QuerySyntax] = []
+  plain_parts: list[str] = []
+  offset: int = 0
+
+  for match in _SYNTAX_PATTERN.finditer(text):
+    plain_parts.append(text[offset:match.start()])
+    offset = match.end()
+    near_text, distance, phrase_text, prefix_text = match.groups()
+    syntax: QuerySyntax | None = None
+
+    if near_text is not None:
+      words = " ".join(near_text.replace("\"", " ").split())
+      if words != "":
+        syntax = QuerySyntax(
+          kind="near",
+          text=words,
+          distance=_NEAR_DISTANCE if distance is None else int(distance),
+        )
+    elif phrase_text is not None:
+      words = " ".join(phrase_text.split())
+      if words != "":
+        syntax = QuerySyntax(kind="phrase", text=words)
+    elif prefix_text is not None:
+      syntax = QuerySyntax(kind="prefix", text=prefix_text)
+
+    if syntax is not None:
+      syntax_list.append(syntax)
+
+  plain_parts.append(text[offset:])
+  plain_text = " ".join(re.sub(r"[*()]", " ", "".join(plain_parts)).split())
+
+  return plain_text, syntax_list
+
+# words only, for encoding embedding of query.
+def strip_query_syntax(text: str) -> str:
+  plain_text, syntax_list = split_query_syntax(text)
+  words: list[str] = [plain_text] if plain_text != "" else []
+  for syntax in syntax_list:
+    words.append(syntax.text.replace("*", ""))
+  return " ".join(words)
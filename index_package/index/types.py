@@ -1,5 +1,8 @@
 from __future__ import annotations
-from dataclasses import dataclass
+
+import json
+
+from dataclasses import dataclass, field, InitVar
 from enum import Enum
 
 class IndexNodeMatching(Enum):
@@ -7,23 +10,72 @@ class IndexNodeMatching(Enum):
   MatchedPartial = "matched_partial"
   Similarity = "similarity"
 
-@dataclass
+# lots of them are built for each query, so that they have no __dict__.
+@dataclass(slots=True)
 class IndexNode:
   id: str
   type: str
   matching: IndexNodeMatching
-  metadata: dict
   fts5_rank: float
   vector_distance: float
   segments: list[IndexSegment]
+  # JSON text read from FTS5DB is also accepted, which is only decoded when metadata is accessed.
+  # it's the last field, since dataclass takes the property below as its default.
+  metadata: InitVar[dict | str]
+  _metadata: dict | str = field(init=False, repr=False, compare=False)
 
-@dataclass
+  def __post_init__(self, metadata: dict | str):
+    if isinstance(metadata, property):
+      raise TypeError("IndexNode() missing required argument: 'metadata'")
+    self._metadata = metadata
+
+  @property
+  def metadata(self) -> dict:
+    if isinstance(self._metadata, str):
+      self._metadata = json.loads(self._metadata)
+    return self._metadata
+
+  @metadata.setter
+  def metadata(self, metadata: dict):
+    self._metadata = metadata
+
+@dataclass(slots=True)
 class IndexSegment:
   start: int
   end: int
   fts5_rank: float
   vector_distance: float
   matched_tokens: list[str]
+  # offsets relative to start of segment, recorded when indexing. None if they were not recorded
+  highlights: list[tuple[int, int]] | None = None
+
+# all conditions must be satisfied. path_prefix is relative to scope, such as "/books".
+# a page shared by PDF files is kept if any of them satisfies scope and path_prefix.
+@dataclass(frozen=True)
+class QueryFilter:
+  scope: str | None = None
+  path_prefix: str | None = None
+  types: tuple[str, ...] | None = None
+
+# QueryFilter resolved by Index. owners are hashes of PDF files and pages,
+# and id of node is always started with its owner.
+@dataclass(frozen=True)
+class NodesFilter:
+  owners: tuple[str, ...] | None = None
+  types: tuple[str, ...] | None = None
+
+def node_owner(node_id: str) -> str:
+  return node_id.split("/", 1)[0]
+
+# Reciprocal Rank Fusion: score = weight / (k + rank) summed over FTS5 (bm25) and vector ranks.
+# each side only fetches its top `candidates_limit` (default to results_limit) items.
+# to see: https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
+@dataclass(frozen=True)
+class RRFRanking:
+  fts5_weight: float = 1.0
+  vector_weight: float = 1.0
+  k: int = 60
+  candidates_limit: int | None = None
 
 @dataclass
 class PageRelativeToPDF:
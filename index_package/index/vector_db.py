@@ -1,26 +1,92 @@
+import os
 import re
+import json
+import math
+import time
 import torch
+import functools
+import importlib.util
 
 from typing import cast, Callable, Literal
-from numpy import ndarray, array
+from threading import Lock
+from dataclasses import dataclass
+import numpy as np
+
+from numpy import ndarray, array, empty, float32
 from sentence_transformers import SentenceTransformer
-from chromadb import PersistentClient
-from chromadb.api import ClientAPI
-from chromadb.api.types import ID, EmbeddingFunction, IncludeEnum, Documents, Embedding, Embeddings, Document, Metadata
+from chromadb.api.types import ID, EmbeddingFunction, Documents, Embedding, Embeddings, Document
 from chromadb.utils import distance_functions
 
 from ..segmentation import Segment
-from .types import IndexNode, IndexSegment, IndexNodeMatching
+from ..utils import ensure_dir
+from .types import IndexNode, IndexSegment, IndexNodeMatching, NodesFilter, node_owner
+from .vector_store import VectorStore, ChromaVectorStore, StoredSegment, DistanceSpace, VectorBackend, VectorQuantization
+from .flat_vector_store import FlatVectorStore
+from .embedding_cache import EmbeddingCache
+from .embedding_pool import EmbeddingPool
 
 _DistanceFunction = Callable[[distance_functions.Vector, distance_functions.Vector], float]
-DistanceSpace = Literal["l2", "ip", "cosine"]
 
+# "torch" runs the model as it is, on GPU if available. "int8" quantizes linear layers dynamically and
+# runs on CPU. "onnx" runs the model with ONNX Runtime on CPU, which needs sentence-transformers >= 3.2
+# and onnxruntime to be installed.
+EmbeddingBackend = Literal["torch", "int8", "onnx"]
+
+# version 1: metadata of segments has "owner" (to see node_owner)
+# version 2: metadata of segments has "node_id"
+# version 3: centroids of nodes are stored, while coarse_factor > 0 (recorded as "centroids" of version file)
+_VERSION = 3
+_MIGRATION_BATCH_SIZE = 200
+
+# length of text is used as the cost of encoding it, as SentenceTransformer does when sorting texts.
+# texts longer than max_seq_length are truncated by model, so their cost is capped.
+# models without max_seq_length (None) never truncate, so the cost is the whole length.
+_CHARS_PER_TOKEN = 4
+
+# rounds of segment queries made by VectorDB.query. queries which got enough distinct nodes in the
+# first round take 1 round, and budget_stops counts queries stopped by over-fetch budget.
+@dataclass
+class VectorQueryStats:
+  queries: int
+  rounds: int
+  max_rounds: int
+  budget_stops: int
+
+  @property
+  def mean_rounds(self) -> float:
+    if self.queries == 0:
+      return 0.0
+    return self.rounds / self.queries
+
+# backend "chroma" keeps segments in a chroma collection, and "flat" keeps them in a FlatVectorStore,
+# which is in-process and memory-mapped (and can be quantized). embeddings of saved segments are reused from embedding_cache.
+# with embedding_processes > 0, texts are encoded by an EmbeddingPool of that many processes, instead of
+# threads of this process. embedding_threads is then the count of torch threads of each process.
+# embedding_load_model, if given, loads the model instead of embedding_model_id, which still keys cached
+# embeddings. with embedding_processes > 0, it must be picklable, such as a module-level function.
+# with coarse_factor > 0, the centroid of segments of each node is kept in another store, and query first
+# finds results_limit * coarse_factor nodes by their centroids, then ranks all segments of those nodes
+# exactly, so that a few nodes with many segments can't take all results. centroids are built again
+# when it is opened with coarse_factor > 0 after nodes were saved without.
+# otherwise, query over-fetches segments with a growing limit until they belong to results_limit distinct
+# nodes, all segments are found, or overfetch_max_results segments are reached. overfetch_timeout (seconds)
+# is off by default, since results stopped by time depend on load and would be kept by the results cache.
 class VectorDB:
   def __init__(
     self,
     index_dir_path: str,
     embedding_model_id: str,
     distance_space: DistanceSpace,
+    backend: VectorBackend = "chroma",
+    embedding_cache: EmbeddingCache | None = None,
+    quantization: VectorQuantization = "none",
+    embedding_backend: EmbeddingBackend = "torch",
+    embedding_threads: int | None = None,
+    embedding_processes: int = 0,
+    embedding_load_model: Callable[[], SentenceTransformer] | None = None,
+    coarse_factor: int = 0,
+    overfetch_max_results: int = 1000,
+    overfetch_timeout: float | None = None,
   ):
     if distance_space == "l2":
       self._distance_fn: _DistanceFunction = distance_functions.l2
@@ -31,16 +97,82 @@ class VectorDB:
     else:
       raise ValueError(f"Invalid distance space: {distance_space}")
 
-    chromadb: ClientAPI = PersistentClient(path=index_dir_path)
-    self._embedding_encode: _EmbeddingFunction = _EmbeddingFunction(embedding_model_id)
-    self._db = chromadb.get_or_create_collection(
-      name="nodes",
-      embedding_function=self._embedding_encode,
-      metadata={"hnsw:space": distance_space},
+    self._distance_space: DistanceSpace = distance_space
+    self._coarse_factor: int = coarse_factor
+    self._overfetch_max_results: int = overfetch_max_results
+    self._overfetch_timeout: float | None = overfetch_timeout
+    self._stats_lock: Lock = Lock()
+    self._stats: VectorQueryStats = VectorQueryStats(queries=0, rounds=0, max_rounds=0, budget_stops=0)
+    self._embedding_encode: _EmbeddingFunction = _EmbeddingFunction(
+      model_id=embedding_model_id,
+      backend=embedding_backend,
+      threads=embedding_threads,
+      load_model=embedding_load_model,
     )
+    self._embedding_cache: EmbeddingCache | None = embedding_cache
+    self._embedding_pool: EmbeddingPool | None = None
+    self._encode: Callable[[list[str]], ndarray] = self._embedding_encode.encode
+
+    if embedding_processes > 0:
+      if embedding_threads is None:
+        embedding_threads = max(1, (os.cpu_count() or 1) // embedding_processes)
+      self._embedding_pool = EmbeddingPool(
+        processes=embedding_processes,
+        create_encode=functools.partial(
+          _create_embedding_encode,
+          model_id=embedding_model_id,
+          backend=embedding_backend,
+          threads=embedding_threads,
+          load_model=embedding_load_model,
+        ),
+      )
+      self._encode = self._embedding_pool.encode
+
+    if backend == "chroma":
+      if quantization != "none":
+        raise ValueError(f"Quantization {quantization} is not supported by backend chroma")
+      self._db: VectorStore = ChromaVectorStore(index_dir_path, distance_space, self._embedding_encode)
+    elif backend == "flat":
+      self._db: VectorStore = FlatVectorStore(index_dir_path, distance_space, quantization=quantization)
+    else:
+      raise ValueError(f"Invalid backend: {backend}")
+
+    self._centroids: VectorStore | None = None
+    if coarse_factor > 0 and backend == "chroma":
+      self._centroids = ChromaVectorStore(
+        index_dir_path, distance_space, self._embedding_encode,
+        collection_name="centroids",
+      )
+    elif coarse_factor > 0 and backend == "flat":
+      self._centroids = FlatVectorStore(
+        ensure_dir(os.path.join(index_dir_path, "centroids")), distance_space,
+        quantization=quantization,
+      )
+
+    self._migrate(os.path.join(index_dir_path, "vector_db_version.json"))
+
+  @property
+  def stats(self) -> VectorQueryStats:
+    with self._stats_lock:
+      return VectorQueryStats(**self._stats.__dict__)
+
+  # loads model and runs it once, so that the first query doesn't pay for it
+  def warm_up(self):
+    if self._embedding_pool is None:
+      self._embedding_encode.warm_up()
+    else:
+      self._embedding_pool.warm_up()
 
   def encode_embedding(self, text: str) -> Embedding:
-    return self._embedding_encode([text])[0]
+    return self._encode([text])[0].tolist()
+
+  # closes stores and stops processes of embedding pool
+  def close(self):
+    self._db.close()
+    if self._centroids is not None:
+      self._centroids.close()
+    if self._embedding_pool is not None:
+      self._embedding_pool.close()
 
   # segment is a tuple of (node_id, index)
   def distances(self, query_embedding: Embedding, segments: list[tuple[str, int]]) -> list[float]:
@@ -48,12 +180,11 @@ class VectorDB:
     for node_id, index in segments:
       ids.append(f"{node_id}/{index}")
 
-    query_np_array = array(query_embedding)
-    result = self._db.get(ids=ids, include=[IncludeEnum.embeddings])
+    query_np_array = array(query_embedding, dtype=float32)
     distances: list[float] = []
 
-    for embedding in cast(list[Embedding], result["embeddings"]):
-      distance = self._distance_fn(query_np_array, array(embedding))
+    for embedding in self._db.embeddings(ids):
+      distance = self._distance_fn(query_np_array, embedding)
       distances.append(distance)
 
     return distances
@@ -63,26 +194,96 @@ class VectorDB:
     query_embedding: Embedding,
     results_limit: int,
     matching: IndexNodeMatching = IndexNodeMatching.Similarity,
+    nodes_filter: NodesFilter | None = None,
   ) -> list[IndexNode]:
-    result = self._db.query(
-      query_embeddings=query_embedding,
-      n_results=results_limit,
-      include=[IncludeEnum.metadatas, IncludeEnum.distances],
+    if nodes_filter is not None and (
+      (nodes_filter.owners is not None and len(nodes_filter.owners) == 0) or
+      (nodes_filter.types is not None and len(nodes_filter.types) == 0)
+    ):
+      return []
+
+    embedding = array(query_embedding, dtype=float32)
+
+    if self._coarse_factor > 0:
+      nodes = self._query_coarse_to_fine(embedding, results_limit, matching, nodes_filter)
+    else:
+      nodes = self._query_overfetching(embedding, results_limit, matching, nodes_filter)
+
+    return nodes[:results_limit]
+
+  def _query_coarse_to_fine(
+    self,
+    embedding: ndarray,
+    results_limit: int,
+    matching: IndexNodeMatching,
+    nodes_filter: NodesFilter | None,
+  ) -> list[IndexNode]:
+    assert self._centroids is not None
+    centroids = self._centroids.query(embedding, results_limit * self._coarse_factor, nodes_filter)
+    self._record_rounds(1, False)
+    if len(centroids) == 0:
+      return []
+
+    stored_segments = self._db.query(
+      embedding=embedding,
+      limit=sum(metadata.get("seg_len", 1) for _, _, metadata in centroids),
+      nodes_filter=nodes_filter,
+      node_ids=[metadata["node_id"] for _, _, metadata in centroids],
     )
-    ids = cast(list[list[ID]], result["ids"])[0]
-    metadatas = cast(list[list[dict]], result["metadatas"])[0]
-    distances = cast(list[list[float]], result["distances"])[0]
+    return self._to_nodes(stored_segments, matching)
+
+  # the next limit is estimated by segments per node of the last round, and at least doubled
+  def _query_overfetching(
+    self,
+    embedding: ndarray,
+    results_limit: int,
+    matching: IndexNodeMatching,
+    nodes_filter: NodesFilter | None,
+  ) -> list[IndexNode]:
+    begin_at = time.perf_counter()
+    limit: int = results_limit
+    rounds: int = 0
+
+    while True:
+      rounds += 1
+      stored_segments = self._db.query(embedding=embedding, limit=limit, nodes_filter=nodes_filter)
+      nodes = self._to_nodes(stored_segments, matching)
+
+      if len(nodes) >= results_limit or len(stored_segments) < limit:
+        self._record_rounds(rounds, False)
+        return nodes
+      if limit >= self._overfetch_max_results or (
+        self._overfetch_timeout is not None and
+        time.perf_counter() - begin_at >= self._overfetch_timeout
+      ):
+        self._record_rounds(rounds, True)
+        return nodes
+
+      limit = min(
+        self._overfetch_max_results,
+        max(limit * 2, math.ceil(limit * results_limit / max(1, len(nodes)))),
+      )
+
+  def _record_rounds(self, rounds: int, budget_stopped: bool):
+    with self._stats_lock:
+      self._stats.queries += 1
+      self._stats.rounds += rounds
+      self._stats.max_rounds = max(self._stats.max_rounds, rounds)
+      if budget_stopped:
+        self._stats.budget_stops += 1
+
+  def _to_nodes(self, stored_segments: list[StoredSegment], matching: IndexNodeMatching) -> list[IndexNode]:
     node2segments: dict[str, list[tuple[float, int, int, dict]]] = {}
 
-    for i in range(len(ids)):
-      matches = re.match(r"(.*)/([^/]*)$", ids[i])
+    for id, distance, metadata in stored_segments:
+      matches = re.match(r"(.*)/([^/]*)$", id)
       if matches is None:
-        raise ValueError(f"Invalid ID: {ids[i]}")
+        raise ValueError(f"Invalid ID: {id}")
       node_id = matches.group(1)
-      metadata: dict[str, any] = metadatas[i]
-      distance = distances[i]
       start = metadata.pop("seg_start")
       end = metadata.pop("seg_end")
+      metadata.pop("owner", None)
+      metadata.pop("node_id", None)
       segments = node2segments.get(node_id, None)
       if segments is None:
         node2segments[node_id] = segments = []
@@ -124,12 +325,14 @@ class VectorDB:
   def save(self, node_id: str, segments: list[Segment], metadata: dict):
     ids: list[ID] = []
     documents: list[Document] = []
-    metadatas: list[Metadata] = []
+    metadatas: list[dict] = []
 
     for i, segment in enumerate(segments):
       segment_metadata = metadata.copy()
       segment_metadata["seg_start"] = segment.start
       segment_metadata["seg_end"] = segment.end
+      segment_metadata["owner"] = node_owner(node_id)
+      segment_metadata["node_id"] = node_id
       if i == 0:
         segment_metadata["seg_len"] = len(segments)
 
@@ -137,42 +340,262 @@ class VectorDB:
       documents.append(segment.text)
       metadatas.append(segment_metadata)
 
+    embeddings = self._encode_documents(documents)
     self._db.add(
       ids=ids,
-      documents=documents,
+      embeddings=embeddings,
       metadatas=metadatas,
+      documents=documents,
     )
+    if self._centroids is not None and len(ids) > 0:
+      self._centroids.add(
+        ids=[f"{node_id}/centroid"],
+        embeddings=self._centroid(embeddings)[None, :],
+        metadatas=[{
+          **metadata,
+          "owner": node_owner(node_id),
+          "node_id": node_id,
+          "seg_len": len(segments),
+        }],
+        documents=[""],
+      )
 
   def remove(self, node_id: str):
-    result = self._db.get(
-      ids=f"{node_id}/0",
-      include=[IncludeEnum.metadatas],
-    )
-    metadatas = result.get("metadatas")
-    if metadatas is None or len(metadatas) == 0:
-      # segments may be empty, but user maybe don't know it.
-      return
+    self.remove_nodes([node_id])
+
+  # segments of all nodes are deleted by a single call of store
+  def remove_nodes(self, node_ids: list[str]):
+    self._db.delete_nodes(node_ids)
+    if self._centroids is not None:
+      self._centroids.delete_nodes(node_ids)
+
+  def _encode_documents(self, documents: list[str]) -> ndarray:
+    if self._embedding_cache is None:
+      return self._encode(documents)
+    return self._embedding_cache.encode(documents, self._encode)
+
+  # version is recorded in a file next to chroma's, because chroma doesn't allow to modify
+  # "hnsw:space" of collection metadata. migrations are idempotent, so an interrupted one just runs again.
+  def _migrate(self, version_path: str):
+    version: int = 0
+    has_centroids: bool = False
+    if os.path.exists(version_path):
+      with open(version_path, "r", encoding="utf-8") as file:
+        version_json = json.load(file)
+      version = version_json["version"]
+      # version 3 always stored centroids before they were optional
+      has_centroids = version_json.get("centroids", version >= 3)
+    elif self._db.count() == 0:
+      version = _VERSION
+      has_centroids = True
 
-    segments_len = cast(int, metadatas[0].get("seg_len", 1))
-    group_size: int = 45
+    if version < 1:
+      self._backfill_metadata(lambda id, _: {"owner": node_owner(id)})
+    if version < 2:
+      self._backfill_metadata(lambda id, _: {"node_id": id})
+    if self._centroids is not None and not has_centroids:
+      # centroids of nodes removed meanwhile may be left, so that they are all built again
+      self._clear_store(self._centroids)
+      self._backfill_centroids(self._centroids)
 
-    for offset in range(0, segments_len, group_size):
-      ids_len = min(group_size, segments_len - offset)
-      ids = [f"{node_id}/{offset + i}" for i in range(ids_len)]
-      self._db.delete(ids=ids)
+    with open(version_path, "w", encoding="utf-8") as file:
+      json.dump({ "version": _VERSION, "centroids": self._centroids is not None }, file)
 
+  def _backfill_metadata(self, to_metadata: Callable[[str, dict], dict]):
+    offset: int = 0
+    while True:
+      ids, metadatas = self._db.list(limit=_MIGRATION_BATCH_SIZE, offset=offset)
+      if len(ids) == 0:
+        break
+      updated_ids: list[ID] = []
+      updated_metadatas: list[dict] = []
+      for id, metadata in zip(ids, metadatas):
+        segment_id = cast(re.Match, re.match(r"(.*)/([^/]*)$", id))
+        added_metadata = to_metadata(segment_id.group(1), metadata)
+        if any(metadata.get(k, None) != v for k, v in added_metadata.items()):
+          updated_ids.append(id)
+          updated_metadatas.append({**metadata, **added_metadata})
+      if len(updated_ids) > 0:
+        self._db.update(ids=updated_ids, metadatas=updated_metadatas)
+      offset += len(ids)
+
+  def _clear_store(self, store: VectorStore):
+    while True:
+      ids, _ = store.list(limit=_MIGRATION_BATCH_SIZE, offset=0)
+      if len(ids) == 0:
+        break
+      store.delete(ids)
+
+  # segments of a node may be listed in any order, so their ids are collected before embeddings are read
+  def _backfill_centroids(self, centroids_store: VectorStore):
+    node2ids: dict[str, list[str]] = {}
+    node2metadata: dict[str, dict] = {}
+    offset: int = 0
+    while True:
+      ids, metadatas = self._db.list(limit=_MIGRATION_BATCH_SIZE, offset=offset)
+      if len(ids) == 0:
+        break
+      for id, metadata in zip(ids, metadatas):
+        node_id = metadata["node_id"]
+        segment_ids = node2ids.get(node_id, None)
+        if segment_ids is None:
+          node2ids[node_id] = segment_ids = []
+          node2metadata[node_id] = {
+            k: v for k, v in metadata.items()
+            if k not in ("seg_start", "seg_end", "seg_len")
+          }
+        segment_ids.append(id)
+      offset += len(ids)
+
+    node_ids = list(node2ids.keys())
+    for offset in range(0, len(node_ids), _MIGRATION_BATCH_SIZE):
+      batch_node_ids = node_ids[offset:offset + _MIGRATION_BATCH_SIZE]
+      centroids: list[ndarray] = []
+      for node_id in batch_node_ids:
+        embeddings = self._db.embeddings(node2ids[node_id])
+        centroids.append(self._centroid(np.stack(embeddings)))
+      centroids_store.add(
+        ids=[f"{node_id}/centroid" for node_id in batch_node_ids],
+        embeddings=np.stack(centroids),
+        metadatas=[
+          {**node2metadata[node_id], "seg_len": len(node2ids[node_id])}
+          for node_id in batch_node_ids
+        ],
+        documents=["" for _ in batch_node_ids],
+      )
+
+  # vectors are normalized before averaged for cosine distance, so that long vectors don't dominate
+  def _centroid(self, embeddings: ndarray) -> ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if self._distance_space == "cosine":
+      norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+      embeddings = embeddings / np.maximum(norms, 1e-30)
+    return embeddings.mean(axis=0)
+
+# texts are sorted by length and split into batches, so that texts of a batch are padded to similar
+# lengths. a batch has at most max_batch_size texts, and its padded size (texts count × longest text)
+# is at most max_batch_chars, so that a batch of long texts never takes too much memory.
+# threads limits intra-op threads of torch (for the whole process), so that they don't compete with
+# workers of TasksPool. None keeps torch's default, which is the count of cores.
 class _EmbeddingFunction(EmbeddingFunction):
-  def __init__(self, model_id: str):
+  def __init__(
+    self,
+    model_id: str,
+    max_batch_size: int = 32,
+    max_batch_chars: int = 32 * 2048,
+    backend: EmbeddingBackend = "torch",
+    threads: int | None = None,
+    load_model: Callable[[], SentenceTransformer] | None = None,
+  ):
+    if backend not in ("torch", "int8", "onnx"):
+      raise ValueError(f"Invalid embedding backend: {backend}")
     self._model_id: str = model_id
+    self._max_batch_size: int = max_batch_size
+    self._max_batch_chars: int = max_batch_chars
+    self._backend: EmbeddingBackend = backend
+    self._threads: int | None = threads
+    self._load: Callable[[], SentenceTransformer] = self._load_model if load_model is None else load_model
+    self._model_lock: Lock = Lock()
     self._model: SentenceTransformer | None = None
 
   def __call__(self, input: Documents) -> Embeddings:
-    if self._model is None:
-      self._model = SentenceTransformer(
-        model_name_or_path=self._model_id,
-        device="cuda" if torch.cuda.is_available() else "cpu",
+    return self.encode(input).tolist()
+
+  # float32 array of shape (len(texts), dimension), in the order of texts
+  def encode(self, texts: list[str]) -> ndarray:
+    model = self._get_model()
+    max_seq_length: int | None = model.max_seq_length
+    if max_seq_length is None:
+      lengths = [len(text) for text in texts]
+    else:
+      lengths = [min(len(text), max_seq_length * _CHARS_PER_TOKEN) for text in texts]
+    result: ndarray | None = None
+
+    for batch in _length_sorted_batches(lengths, self._max_batch_size, self._max_batch_chars):
+      embeddings = model.encode(
+        [texts[i] for i in batch],
+        batch_size=len(batch),
+        convert_to_numpy=True,
       )
-    result = self._model.encode(input)
-    if not isinstance(result, ndarray):
-      raise ValueError("Model output is not a numpy array")
-    return result.tolist()
\ No newline at end of file
+      if not isinstance(embeddings, ndarray):
+        raise ValueError("Model output is not a numpy array")
+      if result is None:
+        result = empty((len(texts), embeddings.shape[1]), dtype=float32)
+      result[batch] = embeddings
+
+    if result is None:
+      return empty((0, model.get_sentence_embedding_dimension() or 0), dtype=float32)
+    return result
+
+  def warm_up(self):
+    self.encode(["warm up"])
+
+  def _get_model(self) -> SentenceTransformer:
+    with self._model_lock:
+      if self._model is None:
+        self._model = self._load()
+      return self._model
+
+  def _load_model(self) -> SentenceTransformer:
+    if self._threads is not None:
+      torch.set_num_threads(self._threads)
+
+    if self._backend == "onnx":
+      # sentence-transformers doesn't raise ImportError for them, so that they are checked first
+      for module_name in ("onnxruntime", "optimum"):
+        if importlib.util.find_spec(module_name) is None:
+          raise ValueError(f"Embedding backend onnx needs {module_name} to be installed")
+      try:
+        return SentenceTransformer(
+          model_name_or_path=self._model_id,
+          device="cpu",
+          backend="onnx",
+        )
+      except TypeError as e:
+        raise ValueError("Embedding backend onnx needs sentence-transformers >= 3.2") from e
+      except ImportError as e:
+        raise ValueError(f"Embedding backend onnx failed to import: {e}") from e
+
+    if self._backend == "int8":
+      model = SentenceTransformer(model_name_or_path=self._model_id, device="cpu")
+      model.eval()
+      return cast(SentenceTransformer, torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8,
+      ))
+
+    return SentenceTransformer(
+      model_name_or_path=self._model_id,
+      device="cuda" if torch.cuda.is_available() else "cpu",
+    )
+
+# runs in worker processes of EmbeddingPool
+def _create_embedding_encode(
+  model_id: str,
+  backend: EmbeddingBackend,
+  threads: int | None,
+  load_model: Callable[[], SentenceTransformer] | None,
+) -> Callable[[list[str]], ndarray]:
+  return _EmbeddingFunction(model_id=model_id, backend=backend, threads=threads, load_model=load_model).encode
+
+# returns indexes of each batch. lengths are visited from the longest, so the first text
+# of a batch decides its padded length.
+def _length_sorted_batches(lengths: list[int], max_batch_size: int, max_batch_chars: int) -> list[list[int]]:
+  batches: list[list[int]] = []
+  batch: list[int] = []
+  batch_length: int = 0
+
+  for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+    if len(batch) > 0 and (
+      len(batch) >= max_batch_size or
+      (len(batch) + 1) * batch_length > max_batch_chars
+    ):
+      batches.append(batch)
+      batch = []
+    if len(batch) == 0:
+      batch_length = max(1, lengths[i])
+    batch.append(i)
+
+  if len(batch) > 0:
+    batches.append(batch)
+
+  return batches
\ No newline at end of file
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import cast, Literal, Sequence
+from numpy import ndarray, array, float32
+from chromadb import PersistentClient
+from chromadb.api import ClientAPI
+from chromadb.api.types import ID, EmbeddingFunction, IncludeEnum, Metadata, Where
+
+from .types import NodesFilter
+
+DistanceSpace = Literal["l2", "ip", "cosine"]
+VectorBackend = Literal["chroma", "flat"]
+VectorQuantization = Literal["none", "float16", "int8"]
+
+# (segment id, distance, metadata) of a segment found by query
+StoredSegment = tuple[str, float, dict]
+
+# chroma turns each item of "$in" into an SQL variable, so that long lists are queried in chunks
+_MAX_WHERE_IN_SIZE = 500
+
+# stores embeddings of segments, whose ids are "{node_id}/{index}".
+# metadata of segments has "owner" and "type", so that queries can be filtered by NodesFilter,
+# and "node_id", so that all segments of nodes can be deleted at once.
+class VectorStore(ABC):
+
+  @abstractmethod
+  def count(self) -> int:
+    pass
+
+  # embeddings is a float32 array of shape (len(ids), dimension)
+  @abstractmethod
+  def add(self, ids: list[str], embeddings: ndarray, metadatas: list[dict], documents: list[str]) -> None:
+    pass
+
+  # rows are in the order of ids. ids that are not found are skipped.
+  @abstractmethod
+  def embeddings(self, ids: list[str]) -> list[ndarray]:
+    pass
+
+  # None for ids that are not found
+  @abstractmethod
+  def metadatas(self, ids: list[str]) -> list[dict | None]:
+    pass
+
+  # nearest segments first. node_ids restricts segments to those whose "node_id" is one of them.
+  @abstractmethod
+  def query(
+    self,
+    embedding: ndarray,
+    limit: int,
+    nodes_filter: NodesFilter | None,
+    node_ids: list[str] | None = None,
+  ) -> list[StoredSegment]:
+    pass
+
+  @abstractmethod
+  def update(self, ids: list[str], metadatas: list[dict]) -> None:
+    pass
+
+  @abstractmethod
+  def delete(self, ids: list[str]) -> None:
+    pass
+
+  # deletes segments whose "node_id" is one of node_ids
+  @abstractmethod
+  def delete_nodes(self, node_ids: list[str]) -> None:
+    pass
+
+  # pages through all segments in a stable order, returns (ids, metadatas)
+  @abstractmethod
+  def list(self, limit: int, offset: int) -> tuple[list[str], list[dict]]:
+    pass
+
+  # stores that keep state in memory save it here
+  def close(self) -> None:
+    pass
+
+class ChromaVectorStore(VectorStore):
+  def __init__(
+    self,
+    dir_path: str,
+    distance_space: DistanceSpace,
+    embedding_function: EmbeddingFunction,
+    collection_name: str = "nodes",
+  ):
+    chromadb: ClientAPI = PersistentClient(path=dir_path)
+    self._db = chromadb.get_or_create_collection(
+      name=collection_name,
+      embedding_function=embedding_function,
+      metadata={"hnsw:space": distance_space},
+    )
+
+  def count(self) -> int:
+    return self._db.count()
+
+  def add(self, ids: list[str], embeddings: ndarray, metadatas: list[dict], documents: list[str]) -> None:
+    self._db.add(
+      ids=ids,
+      embeddings=embeddings.tolist(),
+      metadatas=cast(list[Metadata], metadatas),
+      documents=documents,
+    )
+
+  def embeddings(self, ids: list[str]) -> list[ndarray]:
+    result = self._db.get(ids=ids, include=[IncludeEnum.embeddings])
+    # chroma doesn't keep the order of ids
+    id2embedding: dict[ID, ndarray] = {}
+    for id, embedding in zip(result["ids"], cast(list, result["embeddings"])):
+      id2embedding[id] = array(embedding, dtype=float32)
+    return [id2embedding[id] for id in ids if id in id2embedding]
+
+  def metadatas(self, ids: list[str]) -> list[dict | None]:
+    result = self._db.get(ids=ids, include=[IncludeEnum.metadatas])
+    id2metadata: dict[ID, dict] = {}
+    for id, metadata in zip(result["ids"], cast(list, result["metadatas"])):
+      id2metadata[id] = dict(metadata or {})
+    return [id2metadata.get(id, None) for id in ids]
+
+  def query(
+    self,
+    embedding: ndarray,
+    limit: int,
+    nodes_filter: NodesFilter | None,
+    node_ids: list[str] | None = None,
+  ) -> list[StoredSegment]:
+    owners = None if nodes_filter is None else nodes_filter.owners
+    owners_chunks = [None] if owners is None else _chunks(owners)
+    node_ids_chunks = [None] if node_ids is None else _chunks(node_ids)
+    if len(owners_chunks) == 1 and len(node_ids_chunks) == 1:
+      return self._query(embedding, limit, nodes_filter, node_ids)
+
+    # owners resolved from a broad scope or path, or nodes of a coarse query, can be many more than
+    # segments found. each chunk finds its own nearest segments and they are merged.
+    segments: list[StoredSegment] = []
+    for owners_chunk in owners_chunks:
+      chunk_filter = nodes_filter
+      if owners_chunk is not None and nodes_filter is not None:
+        chunk_filter = NodesFilter(owners=tuple(owners_chunk), types=nodes_filter.types)
+      for node_ids_chunk in node_ids_chunks:
+        segments.extend(self._query(
+          embedding, limit,
+          nodes_filter=chunk_filter,
+          node_ids=None if node_ids_chunk is None else list(node_ids_chunk),
+        ))
+    segments.sort(key=lambda segment: segment[1])
+    return segments[:limit]
+
+  def _query(
+    self,
+    embedding: ndarray,
+    limit: int,
+    nodes_filter: NodesFilter | None,
+    node_ids: list[str] | None,
+  ) -> list[StoredSegment]:
+    result = self._db.query(
+      query_embeddings=[embedding.tolist()],
+      n_results=limit,
+      where=self._where(nodes_filter, node_ids),
+      include=[IncludeEnum.metadatas, IncludeEnum.distances],
+    )
+    ids = cast(list[list[ID]], result["ids"])[0]
+    metadatas = cast(list[list[dict]], result["metadatas"])[0]
+    distances = cast(list[list[float]], result["distances"])[0]
+    return list(zip(ids, distances, metadatas))
+
+  def update(self, ids: list[str], metadatas: list[dict]) -> None:
+    self._db.update(ids=ids, metadatas=cast(list[Metadata], metadatas))
+
+  def delete(self, ids: list[str]) -> None:
+    self._db.delete(ids=ids)
+
+  def delete_nodes(self, node_ids: list[str]) -> None:
+    for offset in range(0, len(node_ids), _MAX_WHERE_IN_SIZE):
+      self._db.delete(where={"node_id": {"$in": node_ids[offset:offset + _MAX_WHERE_IN_SIZE]}})
+
+  def list(self, limit: int, offset: int) -> tuple[list[str], list[dict]]:
+    result = self._db.get(
+      limit=limit,
+      offset=offset,
+      include=[IncludeEnum.metadatas],
+    )
+    metadatas = [dict(m or {}) for m in cast(list, result["metadatas"])]
+    return result["ids"], metadatas
+
+  def _where(self, nodes_filter: NodesFilter | None, node_ids: list[str] | None) -> Where | None:
+    conditions: list[Where] = []
+    if nodes_filter is not None and nodes_filter.types is not None:
+      conditions.append({"type": {"$in": list(nodes_filter.types)}})
+    if nodes_filter is not None and nodes_filter.owners is not None:
+      conditions.append({"owner": {"$in": list(nodes_filter.owners)}})
+    if node_ids is not None:
+      conditions.append({"node_id": {"$in": node_ids}})
+
+    if len(conditions) == 0:
+      return None
+    elif len(conditions) == 1:
+      return conditions[0]
+    else:
+      return {"$and": conditions}
+
+def _chunks(items: Sequence[str]) -> list[Sequence[str]]:
+  return [items[offset:offset + _MAX_WHERE_IN_SIZE] for offset in range(0, len(items), _MAX_WHERE_IN_SIZE)]
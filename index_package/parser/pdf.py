@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import io
 import os
 import json
 import shutil
+import tempfile
 import pikepdf
 
 from typing import cast, Callable
@@ -11,7 +13,7 @@ from dataclasses import dataclass
 
 from .pdf_extractor import extract_metadata_with_pdf, PdfExtractor, Annotation
 from ..progress_events import PDFFileProgressEvent, PDFFileStep, ProgressEventListener
-from ..utils import hash_sha512, assert_continue, TempFolderHub, InterruptException
+from ..utils import hash_sha512_bytes, assert_continue, InterruptException
 from ..sqlite3_pool import register_table_creators, SQLite3Pool
 
 @dataclass
@@ -71,7 +73,6 @@ class PdfParser:
   def __init__(
     self,
     cache_dir_path: str,
-    temp_dir_path: str,
     listeners: PdfParserListeners = PdfParserListeners(),
   ) -> None:
     db = SQLite3Pool(
@@ -84,7 +85,6 @@ class PdfParser:
     self._pages_path: str = os.path.abspath(
       os.path.join(cache_dir_path, "pages"),
     )
-    self._temp_folders: TempFolderHub = TempFolderHub(temp_dir_path)
     self._extractor: PdfExtractor = PdfExtractor(self._pages_path)
     self._listeners: PdfParserListeners = listeners
 
@@ -260,42 +260,48 @@ class PdfParser:
         self._extractor.remove_page(page_hash)
         self._listeners.on_page_removed(page_hash)
 
+  # each page is saved into memory and hashed there. the file of a page is named by its hash,
+  # so it's only written when it isn't cached yet, into a temporary file which is then renamed,
+  # so that a page file is never seen half written.
   def _extract_page_hashes(self, file_path: str) -> list[str]:
     page_hashes: list[str] = []
 
-    with self._temp_folders.create() as folder:
-      folder_path = folder.path
-      pages_count: int = 0
-
-      # https://pikepdf.readthedocs.io/en/latest/
-      with pikepdf.Pdf.open(file_path) as pdf_file:
-        for i, page in enumerate(pdf_file.pages):
-          page_file = pikepdf.Pdf.new()
-          page_file.pages.append(page)
-          page_file_path = os.path.join(folder_path, f"{i}.pdf")
-          page_file.save(
-            page_file_path,
-            # make sure hash of file never changes
-            deterministic_id=True,
-          )
-        pages_count = len(pdf_file.pages)
-
-      for i in range(pages_count):
-        page_file_path = os.path.join(folder_path, f"{i}.pdf")
-        page_hash = hash_sha512(page_file_path)
+    # https://pikepdf.readthedocs.io/en/latest/
+    with pikepdf.Pdf.open(file_path) as pdf_file:
+      for page in pdf_file.pages:
+        page_file = pikepdf.Pdf.new()
+        page_file.pages.append(page)
+        buffer = io.BytesIO()
+        page_file.save(
+          buffer,
+          # make sure hash of file never changes
+          deterministic_id=True,
+        )
+        page_data = buffer.getbuffer()
+        page_hash = hash_sha512_bytes(page_data)
         page_hashes.append(page_hash)
         target_page_path = os.path.join(self._pages_path, f"{page_hash}.pdf")
 
-        if os.path.exists(target_page_path):
-          if os.path.isdir(target_page_path):
-            shutil.rmtree(target_page_path)
-          else:
-            os.remove(target_page_path)
+        if os.path.isdir(target_page_path):
+          shutil.rmtree(target_page_path)
+        if not os.path.exists(target_page_path):
+          self._write_page_file(target_page_path, page_data)
 
-        shutil.move(page_file_path, target_page_path)
+        page_data.release()
 
     return page_hashes
 
+  def _write_page_file(self, target_page_path: str, page_data: memoryview):
+    file_descriptor, temp_path = tempfile.mkstemp(dir=self._pages_path, suffix=".pdf.tmp")
+    try:
+      with os.fdopen(file_descriptor, "wb") as file:
+        file.write(page_data)
+      os.replace(temp_path, target_page_path)
+    except BaseException as e:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise e
+
   def _pdf_id(self, cursor: Cursor, hash: str) -> int | None:
     cursor.execute("SELECT id FROM pdfs WHERE hash = ? LIMIT 1", (hash,))
     row = cursor.fetchone()
@@ -1,4 +1,5 @@
 from .trimmer import *
 
 from .service import Service, QueryResult
+from .query_session import QueryCursor, QueryPage
 from .scan_job import ServiceScanJob
\ No newline at end of file
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import uuid
+
+from copy import deepcopy
+from time import time
+from threading import Lock
+from dataclasses import dataclass
+from .trimmer import trim_nodes, QueryItem, PageQueryItem
+from ..index import Index, RRFRanking, QueryFilter
+from ..parser import PdfParser
+
+# carries everything needed to recompute the page, so it is still valid after its session expired.
+@dataclass(frozen=True)
+class QueryCursor:
+  session_id: str
+  text: str
+  offset: int
+  page_size: int
+  ranking: RRFRanking | None
+  query_filter: QueryFilter | None
+
+@dataclass
+class QueryPage:
+  items: list[QueryItem]
+  keywords: list[str]
+  next_cursor: QueryCursor | None
+
+# Thread safety
+class QuerySessions:
+  def __init__(self, index: Index, pdf_parser: PdfParser, ttl: float, max_sessions: int):
+    self._index: Index = index
+    self._pdf_parser: PdfParser = pdf_parser
+    self._ttl: float = ttl
+    self._max_sessions: int = max_sessions
+    self._lock: Lock = Lock()
+    self._sessions: dict[str, _QuerySession] = {}
+
+  def first_page(
+    self,
+    text: str,
+    page_size: int,
+    ranking: RRFRanking | None,
+    query_filter: QueryFilter | None,
+  ) -> QueryPage:
+    cursor = QueryCursor(
+      session_id="",
+      text=text,
+      offset=0,
+      page_size=page_size,
+      ranking=ranking,
+      query_filter=query_filter,
+    )
+    return self.page(cursor)
+
+  def page(self, cursor: QueryCursor) -> QueryPage:
+    session = self._session(cursor)
+    with session.lock:
+      items = session.items(cursor.offset + cursor.page_size)
+      next_cursor: QueryCursor | None = None
+      if len(items) > cursor.offset + cursor.page_size or not session.is_exhausted:
+        next_cursor = QueryCursor(
+          session_id=session.id,
+          text=cursor.text,
+          offset=cursor.offset + cursor.page_size,
+          page_size=cursor.page_size,
+          ranking=cursor.ranking,
+          query_filter=cursor.query_filter,
+        )
+      # annotations trimmed by later pages are attached to page items of the session,
+      # so that items returned must not share them.
+      return QueryPage(
+        items=deepcopy(items[cursor.offset:cursor.offset + cursor.page_size]),
+        keywords=list(session.keywords),
+        next_cursor=next_cursor,
+      )
+
+  # expired or missing sessions (and sessions of stale index) are replaced by new ones
+  # that recompute from the beginning.
+  def _session(self, cursor: QueryCursor) -> _QuerySession:
+    now = time()
+    generation = self._index.generation
+
+    with self._lock:
+      for session_id, session in list(self._sessions.items()):
+        if session.expires_at < now:
+          self._sessions.pop(session_id)
+
+      session = self._sessions.get(cursor.session_id, None)
+      if session is not None and session.generation != generation:
+        self._sessions.pop(session.id)
+        session = None
+
+      if session is None:
+        while len(self._sessions) >= self._max_sessions:
+          oldest_id = min(self._sessions.keys(), key=lambda id: self._sessions[id].expires_at)
+          self._sessions.pop(oldest_id)
+        session = _QuerySession(
+          index=self._index,
+          pdf_parser=self._pdf_parser,
+          text=cursor.text,
+          ranking=cursor.ranking,
+          query_filter=cursor.query_filter,
+          generation=generation,
+          nodes_limit=cursor.offset + cursor.page_size,
+        )
+        self._sessions[session.id] = session
+
+      session.expires_at = now + self._ttl
+      return session
+
+class _QuerySession:
+  def __init__(
+    self,
+    index: Index,
+    pdf_parser: PdfParser,
+    text: str,
+    ranking: RRFRanking | None,
+    query_filter: QueryFilter | None,
+    generation: int,
+    nodes_limit: int,
+  ):
+    self.id: str = uuid.uuid4().hex
+    self.lock: Lock = Lock()
+    self.generation: int = generation
+    self.expires_at: float = 0.0
+    self.keywords: list[str] = []
+    self.is_exhausted: bool = False
+    self._index: Index = index
+    self._pdf_parser: PdfParser = pdf_parser
+    self._text: str = text
+    self._ranking: RRFRanking | None = ranking
+    self._query_filter: QueryFilter | None = query_filter
+    self._nodes_limit: int = max(1, nodes_limit)
+    self._did_fetch: bool = False
+    self._node_ids: set[str] = set()
+    self._items: list[QueryItem] = []
+    self._page_items_dict: dict[str, PageQueryItem] = {}
+
+  # fetches (at least) `count` items. the limit of nodes grows geometrically, and only nodes that have
+  # not been seen are trimmed, so reading page after page costs O(n) trimming rather than O(pages²).
+  # one more item than `count` is fetched to know whether there is a next page.
+  def items(self, count: int) -> list[QueryItem]:
+    while len(self._items) <= count and not self.is_exhausted:
+      if self._did_fetch:
+        self._nodes_limit *= 2
+      self._nodes_limit = max(self._nodes_limit, count + 1)
+      nodes, keywords = self._index.query(
+        self._text, self._nodes_limit,
+        ranking=self._ranking,
+        query_filter=self._query_filter,
+      )
+      self._did_fetch = True
+      self.keywords = keywords
+
+      new_nodes = [n for n in nodes if not n.id in self._node_ids]
+      if len(new_nodes) == 0:
+        self.is_exhausted = True
+        break
+
+      for node in new_nodes:
+        self._node_ids.add(node.id)
+
+      self._items.extend(trim_nodes(
+        self._index, self._pdf_parser, new_nodes,
+        page_items_dict=self._page_items_dict,
+      ))
+
+    return self._items
@@ -12,10 +12,12 @@ class ServiceScanJob:
     max_workers: int,
     progress_event_listener: ProgressEventListener,
     handle_event: Callable[[Event], None],
+    on_completed: Callable[[], None] | None = None,
   ):
     self._scanner: Scanner = scanner
     self._listener: ProgressEventListener = progress_event_listener
     self._handle_event: Callable[[Event], None] = handle_event
+    self._on_completed: Callable[[], None] | None = on_completed
     self._interrupter_lock: threading.Lock = threading.Lock()
     self._did_interrupted: bool = False
     self._pool: TasksPool[int] = TasksPool[int](
@@ -45,6 +47,8 @@ class ServiceScanJob:
     elif state == TasksPoolResultState.Interrupted:
       return False
     else:
+      if self._on_completed is not None:
+        self._on_completed()
       return True
 
   # could be called in another thread safely
@@ -1,14 +1,16 @@
 import os
 
+from copy import deepcopy
 from dataclasses import dataclass
 from .scan_job import ServiceScanJob
-from .trimmer import trim_nodes, QueryItem
+from .trimmer import trim_nodes, QueryItem, PageQueryItem
+from .query_session import QuerySessions, QueryCursor, QueryPage
 from ..scanner import Scanner
-from ..index import Index, VectorDB, FTS5DB
+from ..index import Index, VectorDB, VectorQueryStats, VectorBackend, EmbeddingBackend, VectorQuantization, FTS5DB, FTS5Maintenance, FTS5Stats, RRFRanking, QueryFilter, QueryCache, QueryCacheStats, EmbeddingCache, EmbeddingCacheStats
 from ..parser import PdfParser
 from ..segmentation.segmentation import Segmentation
 from ..progress_events import ProgressEventListener
-from ..utils import ensure_dir, ensure_parent_dir
+from ..utils import ensure_dir, ensure_parent_dir, LRUCache
 
 
 @dataclass
@@ -21,6 +23,19 @@ class Service:
     self,
     workspace_path: str,
     embedding_model_id: str,
+    results_cache_size: int = 32 * 1024 * 1024,
+    persist_query_cache: bool = False,
+    query_session_ttl: float = 300.0,
+    contentless_fts5: bool | None = None,
+    fts5_max_df_ratio: float | None = None,
+    vector_backend: VectorBackend = "chroma",
+    vector_quantization: VectorQuantization = "none",
+    embedding_cache_max_count: int = 200000,
+    embedding_backend: EmbeddingBackend = "torch",
+    embedding_threads: int | None = None,
+    preload_embedding_model: bool = True,
+    embedding_processes: int = 0,
+    vector_coarse_factor: int = 0,
   ):
     index_dir_path: str = ensure_dir(
       os.path.abspath(os.path.join(workspace_path, "vector_db")),
@@ -34,31 +49,128 @@ class Service:
         cache_dir_path=ensure_dir(
           os.path.abspath(os.path.join(workspace_path, "parser", "pdf_cache")),
         ),
-        temp_dir_path=ensure_dir(
-          os.path.abspath(os.path.join(workspace_path, "temp")),
-        ),
       )
+    self._query_cache: QueryCache = QueryCache(
+      embedding_model_id=embedding_model_id,
+      embedding_backend=embedding_backend,
+      db_path=ensure_parent_dir(
+        os.path.abspath(os.path.join(workspace_path, "query_cache.sqlite3"))
+      ) if persist_query_cache else None,
+    )
+    self._embedding_cache: EmbeddingCache = EmbeddingCache(
+      embedding_model_id=embedding_model_id,
+      embedding_backend=embedding_backend,
+      max_count=embedding_cache_max_count,
+      db_path=ensure_parent_dir(
+        os.path.abspath(os.path.join(workspace_path, "embedding_cache.sqlite3"))
+      ),
+    )
+    fts5_db = FTS5DB(
+      db_path=ensure_parent_dir(
+        os.path.abspath(os.path.join(workspace_path, "index_fts5.sqlite3"))
+      ),
+      contentless=contentless_fts5,
+      max_df_ratio=fts5_max_df_ratio,
+    )
+    self._fts5_db: FTS5DB = fts5_db
+    self._fts5_maintenance: FTS5Maintenance = FTS5Maintenance(fts5_db)
+    self._vector_db: VectorDB = VectorDB(
+      embedding_model_id=embedding_model_id,
+      distance_space="l2",
+      index_dir_path=index_dir_path,
+      backend=vector_backend,
+      quantization=vector_quantization,
+      embedding_cache=self._embedding_cache,
+      embedding_backend=embedding_backend,
+      embedding_threads=embedding_threads,
+      embedding_processes=embedding_processes,
+      coarse_factor=vector_coarse_factor,
+    )
+    if preload_embedding_model:
+      self._vector_db.warm_up()
+
     self._index: Index = Index(
       scope=self._scanner.scope,
       index_dir_path=index_dir_path,
       segmentation=Segmentation(),
       pdf_parser=self._pdf_parser,
-      vector_db=VectorDB(
-        embedding_model_id=embedding_model_id,
-        distance_space="l2",
-        index_dir_path=index_dir_path,
-      ),
-      fts5_db=FTS5DB(
-        db_path=ensure_parent_dir(
-          os.path.abspath(os.path.join(workspace_path, "index_fts5.sqlite3"))
-        ),
-      ),
+      query_cache=self._query_cache,
+      vector_db=self._vector_db,
+      fts5_db=fts5_db,
+    )
+    self._results_cache: LRUCache[tuple, QueryResult] = LRUCache(
+      max_size=results_cache_size,
+      sizeof=_sizeof_query_result,
+    )
+    self._query_sessions: QuerySessions = QuerySessions(
+      index=self._index,
+      pdf_parser=self._pdf_parser,
+      ttl=query_session_ttl,
+      max_sessions=64,
     )
 
-  def query(self, text: str, results_limit: int) -> QueryResult:
-    nodes, keywords = self._index.query(text, results_limit)
-    trimmed_nodes = trim_nodes(self._index, self._pdf_parser, nodes)
-    return QueryResult(trimmed_nodes, keywords)
+  @property
+  def query_cache_stats(self) -> QueryCacheStats:
+    return self._query_cache.stats
+
+  @property
+  def embedding_cache_stats(self) -> EmbeddingCacheStats:
+    return self._embedding_cache.stats
+
+  @property
+  def vector_query_stats(self) -> VectorQueryStats:
+    return self._vector_db.stats
+
+  def query(
+    self,
+    text: str,
+    results_limit: int,
+    concurrent: bool = False,
+    ranking: RRFRanking | None = None,
+    query_filter: QueryFilter | None = None,
+  ) -> QueryResult:
+    # generation must be read before querying, so that a result racing with indexing is never reused.
+    generation = self._index.generation
+    cache_key = (" ".join(text.split()), results_limit, ranking, query_filter)
+    result = self._results_cache.get(cache_key, generation)
+
+    if result is None:
+      nodes, keywords = self._index.query(
+        text, results_limit,
+        concurrent=concurrent,
+        ranking=ranking,
+        query_filter=query_filter,
+      )
+      trimmed_nodes = trim_nodes(self._index, self._pdf_parser, nodes)
+      result = QueryResult(trimmed_nodes, keywords)
+      self._results_cache.put(cache_key, result, generation)
+
+    # items are mutable, so that callers get copies and the cached result is never changed by them
+    return deepcopy(result)
+
+  # use `next_cursor` of returned page with `query_next_page` to read following pages.
+  def query_first_page(
+    self,
+    text: str,
+    page_size: int,
+    ranking: RRFRanking | None = None,
+    query_filter: QueryFilter | None = None,
+  ) -> QueryPage:
+    return self._query_sessions.first_page(text, page_size, ranking, query_filter)
+
+  def query_next_page(self, cursor: QueryCursor) -> QueryPage:
+    return self._query_sessions.page(cursor)
+
+  @property
+  def fts5_stats(self) -> FTS5Stats:
+    return self._fts5_maintenance.stats
+
+  # call it when idle. returns True if FTS5 index is fully merged.
+  def maintain_fts5(self, time_budget: float = 0.5) -> bool:
+    return self._fts5_maintenance.run_slice(time_budget)
+
+  def optimize_fts5(self):
+    self._fts5_maintenance.optimize()
 
   def page_content(self, pdf_hash: str, page_index: int) -> str:
     pdf = self._pdf_parser.pdf_or_none(pdf_hash)
@@ -75,6 +187,12 @@ class Service:
     path = os.path.abspath(path)
     return path
 
+  # call it when the service is no longer used. FTS5 writes are committed, state of vector stores
+  # is saved and processes of embedding are stopped.
+  def close(self):
+    self._vector_db.close()
+    self._fts5_db.close()
+
   def scan_job(self, max_workers: int = 1, progress_event_listener: ProgressEventListener | None = None) -> ServiceScanJob:
     if progress_event_listener is None:
       progress_event_listener = lambda _: None
@@ -84,4 +202,18 @@ class Service:
       progress_event_listener=progress_event_listener,
       scanner=self._scanner,
       handle_event=lambda event: self._index.handle_event(event, progress_event_listener),
-    )
\ No newline at end of file
+      on_completed=lambda: self._fts5_maintenance.run_slice(time_budget=1.0),
+    )
+
+# roughly estimate memory of result, texts of pages take the most of it.
+def _sizeof_query_result(result: QueryResult) -> int:
+  size: int = 64
+  for keyword in result.keywords:
+    size += 56 + len(keyword)
+  for item in result.items:
+    size += 256
+    if isinstance(item, PageQueryItem):
+      size += len(item.content) + 128 * len(item.segments)
+      for anno in item.annotations:
+        size += 128 + len(anno.content) + 128 * len(anno.segments)
+  return size
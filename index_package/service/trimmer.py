@@ -42,8 +42,15 @@ class PageHighlightSegment:
   main: bool
   highlights: list[tuple[int, int]]
 
-def trim_nodes(index: Index, pdf_parser: PdfParser, nodes: list[IndexNode]) -> list[QueryItem]:
-  page_items_dict: dict[str, PageQueryItem] = {}
+# page_items_dict can be shared between calls, so that annotations are attached to page items trimmed before.
+def trim_nodes(
+  index: Index,
+  pdf_parser: PdfParser,
+  nodes: list[IndexNode],
+  page_items_dict: dict[str, PageQueryItem] | None = None) -> list[QueryItem]:
+
+  if page_items_dict is None:
+    page_items_dict = {}
   result_items: list[QueryItem] = []
 
   for node in nodes:
@@ -60,9 +67,8 @@ def trim_nodes(index: Index, pdf_parser: PdfParser, nodes: list[IndexNode]) -> l
       if page_item is not None:
         result_items.append(page_item)
 
-  for page_item in result_items:
-    if isinstance(page_item, PageQueryItem):
-      page_item.annotations.sort(key=lambda item: item.index)
+  for page_item in page_items_dict.values():
+    page_item.annotations.sort(key=lambda item: item.index)
 
   return result_items
 
@@ -122,7 +128,7 @@ def _trim_page_and_child_type(
   return page_item
 
 def _mark_highlights(content: str, segments: list[IndexSegment], ignore_empty_segments: bool) -> list[PageHighlightSegment]:
-  content = content.lower()
+  lower_content: str | None = None
   min_rank: tuple[float, float] = (float("inf"), float("inf"))
   highlight_segments: list[PageHighlightSegment] = []
 
@@ -140,9 +146,15 @@ def _mark_highlights(content: str, segments: list[IndexSegment], ignore_empty_se
     start = segment.start
     end = segment.end
     highlights: list[tuple[int, int]] = []
-    for token in segment.matched_tokens:
-      for highlight in _search_highlights(token, start, end, content):
-        highlights.append(highlight)
+    if segment.highlights is not None:
+      highlights.extend(segment.highlights)
+    else:
+      # nodes indexed before offsets were recorded
+      if lower_content is None:
+        lower_content = content.lower()
+      for token in segment.matched_tokens:
+        for highlight in _search_highlights(token, start, end, lower_content):
+          highlights.append(highlight)
 
     if not ignore_empty_segments or len(highlights) > 0:
       highlights.sort(key=lambda h: h[0])
@@ -1,5 +1,5 @@
-from .temp_folder import *
 from .tasks_pool import *
 from .hash import *
 from .dir_path import *
-from .string import *
\ No newline at end of file
+from .string import *
+from .lru_cache import *
@@ -7,7 +7,12 @@ def hash_sha512(file_path, chunk_size: int = 4096) -> str:
     while chunk := file.read(chunk_size):
       sha512_hash.update(chunk)
 
-  bytes = sha512_hash.digest()
-  base64_data = base64.urlsafe_b64encode(bytes)
+  return _encode_digest(sha512_hash.digest())
 
+# the same as hash_sha512 of a file with this content
+def hash_sha512_bytes(data: bytes | memoryview) -> str:
+  return _encode_digest(hashlib.sha512(data).digest())
+
+def _encode_digest(digest: bytes) -> str:
+  base64_data = base64.urlsafe_b64encode(digest)
   return base64_data.decode()
\ No newline at end of file
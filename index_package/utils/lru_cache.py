@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+from threading import Lock
+from collections import OrderedDict
+from typing import Generic, Hashable, TypeVar, Callable
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+# Thread safety
+# values are bounded by the sum of `sizeof(value)`, not by count.
+# each value is stored with the generation it was computed at, and a value of other generation
+# is treated as missing, so callers never get a value computed before their data changed.
+class LRUCache(Generic[K, V]):
+  def __init__(self, max_size: int, sizeof: Callable[[V], int]):
+    self._max_size: int = max_size
+    self._sizeof: Callable[[V], int] = sizeof
+    self._lock: Lock = Lock()
+    self._size: int = 0
+    self._hits: int = 0
+    self._misses: int = 0
+    self._entries: OrderedDict[K, tuple[V, int, int]] = OrderedDict()
+
+  @property
+  def size(self) -> int:
+    with self._lock:
+      return self._size
+
+  @property
+  def hits(self) -> int:
+    with self._lock:
+      return self._hits
+
+  @property
+  def misses(self) -> int:
+    with self._lock:
+      return self._misses
+
+  def __len__(self) -> int:
+    with self._lock:
+      return len(self._entries)
+
+  def get(self, key: K, generation: int = 0) -> V | None:
+    with self._lock:
+      entry = self._entries.get(key, None)
+      if entry is None:
+        self._misses += 1
+        return None
+      value, value_generation, value_size = entry
+      if value_generation != generation:
+        self._entries.pop(key)
+        self._size -= value_size
+        self._misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self._hits += 1
+      return value
+
+  def put(self, key: K, value: V, generation: int = 0):
+    value_size = self._sizeof(value)
+    if value_size > self._max_size:
+      return
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._size -= entry[2]
+      self._entries[key] = (value, generation, value_size)
+      self._size += value_size
+      while self._size > self._max_size:
+        _, (_, _, evicted_size) = self._entries.popitem(last=False)
+        self._size -= evicted_size
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
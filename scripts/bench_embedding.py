@@ -0,0 +1,65 @@
+# compares embedding backends and torch thread counts on the same synthetic corpus: time to load
+# model, latency of the first encode and throughput of encoding.
+#   python scripts/bench_embedding.py --model shibing624/text2vec-base-chinese --backends torch int8 onnx --threads 1 4 8
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, "..", "..")))
+
+# pylint: disable=wrong-import-position
+from index_package.index.vector_db import _EmbeddingFunction
+
+_WORDS = (
+  "the transference in the here and now are the core of the analytic work "
+  "which technique of analysis is appropriate free association fundamental rule"
+).split(" ")
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--model", type=str, default="shibing624/text2vec-base-chinese")
+  parser.add_argument("--backends", type=str, nargs="+", default=["torch", "int8", "onnx"])
+  # 0 keeps torch's default. torch threads are set for the whole process, so put 0 first.
+  parser.add_argument("--threads", type=int, nargs="+", default=[0])
+  parser.add_argument("--count", type=int, default=512)
+  parser.add_argument("--words", type=int, default=80)
+  args = parser.parse_args()
+
+  rng = random.Random(0)
+  texts = [
+    " ".join(rng.choice(_WORDS) for _ in range(rng.randint(args.words // 4, args.words)))
+    for _ in range(args.count)
+  ]
+  print(f"{'backend':<8} {'threads':>8} {'load (s)':>10} {'first (ms)':>11} {'texts/s':>10}")
+  for backend in args.backends:
+    for threads in args.threads:
+      threads_label = str(threads) if threads > 0 else "default"
+      encode = _EmbeddingFunction(
+        model_id=args.model,
+        backend=backend,
+        threads=None if threads <= 0 else threads,
+      )
+      try:
+        begin = time.perf_counter()
+        encode.warm_up()
+        load_seconds = time.perf_counter() - begin
+      except (ImportError, ValueError) as e:
+        print(f"{backend:<8} {threads_label:>8} skipped: {e}")
+        continue
+
+      begin = time.perf_counter()
+      encode.encode(texts[:1])
+      first_seconds = time.perf_counter() - begin
+
+      begin = time.perf_counter()
+      encode.encode(texts)
+      throughput = len(texts) / (time.perf_counter() - begin)
+      print(
+        f"{backend:<8} {threads_label:>8} {load_seconds:>10.2f} "
+        f"{first_seconds * 1000:>11.1f} {throughput:>10.1f}"
+      )
+
+if __name__ == "__main__":
+  main()
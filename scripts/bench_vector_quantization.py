@@ -0,0 +1,102 @@
+# compares quantizations of FlatVectorStore on the same random corpus: bytes of rows scanned by queries,
+# query latency and recall@k against exact search, for each re-rank factor.
+#   python scripts/bench_vector_quantization.py --count 100000 --dimension 768 --rerank-factors 1 2 4 8
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, "..", "..")))
+
+# pylint: disable=wrong-import-position
+from index_package.index import FlatVectorStore
+
+_ADD_BATCH_SIZE = 1000
+
+# files holding rows that queries scan, by quantization. float32 rows are only read to re-rank.
+_SCANNED_FILES = {
+  "none": ("flat_vectors.f32",),
+  "float16": ("flat_vectors.f16",),
+  "int8": ("flat_vectors.i8", "flat_vectors.i8.scales"),
+}
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--count", type=int, default=20000)
+  parser.add_argument("--dimension", type=int, default=768)
+  parser.add_argument("--clusters", type=int, default=200)
+  parser.add_argument("--queries", type=int, default=200)
+  parser.add_argument("--limit", type=int, default=10)
+  parser.add_argument("--rerank-factors", type=int, nargs="+", default=[1, 2, 4, 8])
+  args = parser.parse_args()
+
+  # clustered vectors have close neighbors, as embeddings of similar texts do
+  rng = np.random.default_rng(0)
+  centers = rng.standard_normal((args.clusters, args.dimension), dtype=np.float32)
+  vectors = centers[rng.integers(0, args.clusters, args.count)]
+  vectors += 0.3 * rng.standard_normal((args.count, args.dimension), dtype=np.float32)
+  queries = vectors[rng.integers(0, args.count, args.queries)]
+  queries = queries + 0.3 * rng.standard_normal(queries.shape, dtype=np.float32)
+  exact = _exact_top_k(vectors, queries, args.limit)
+
+  dir_path = tempfile.mkdtemp(prefix="bench_vector_quantization_")
+  try:
+    _add(FlatVectorStore(dir_path, distance_space="l2", hnsw_threshold=args.count + 1), vectors)
+    print(f"{'quantization':<13} {'rerank':>6} {'scanned (MB)':>13} {'p50 (ms)':>10} {'p95 (ms)':>10} {'recall':>8}")
+    for quantization in ("none", "float16", "int8"):
+      for rerank_factor in args.rerank_factors if quantization != "none" else [1]:
+        store = FlatVectorStore(
+          dir_path,
+          distance_space="l2",
+          hnsw_threshold=args.count + 1,
+          quantization=quantization,
+          rerank_factor=rerank_factor,
+        )
+        latencies, recall = _query(store, queries, exact, args.limit)
+        scanned_size = sum(os.path.getsize(os.path.join(dir_path, name)) for name in _SCANNED_FILES[quantization])
+        print(
+          f"{quantization:<13} {rerank_factor:>6} {scanned_size / 1024 / 1024:>13.1f} "
+          f"{np.percentile(latencies, 50) * 1000:>10.2f} "
+          f"{np.percentile(latencies, 95) * 1000:>10.2f} "
+          f"{recall:>8.3f}"
+        )
+        store.close()
+  finally:
+    shutil.rmtree(dir_path, ignore_errors=True)
+
+def _add(store: FlatVectorStore, vectors: np.ndarray):
+  for offset in range(0, len(vectors), _ADD_BATCH_SIZE):
+    batch = vectors[offset:offset + _ADD_BATCH_SIZE]
+    ids = [f"node{offset + i}/0" for i in range(len(batch))]
+    store.add(
+      ids=ids,
+      embeddings=batch,
+      metadatas=[{"owner": f"node{offset + i}", "type": "pdf.page"} for i in range(len(batch))],
+      documents=["" for _ in ids],
+    )
+  store.close()
+
+def _query(store: FlatVectorStore, queries: np.ndarray, exact: list[set[str]], limit: int) -> tuple[list[float], float]:
+  latencies: list[float] = []
+  found_count: int = 0
+  for query, expected_ids in zip(queries, exact):
+    begin = time.perf_counter()
+    segments = store.query(query, limit, None)
+    latencies.append(time.perf_counter() - begin)
+    found_count += len(expected_ids.intersection(id for id, _, _ in segments))
+  return latencies, found_count / (len(queries) * limit)
+
+def _exact_top_k(vectors: np.ndarray, queries: np.ndarray, limit: int) -> list[set[str]]:
+  norms = np.einsum("ij,ij->i", vectors, vectors)
+  exact: list[set[str]] = []
+  for query in queries:
+    distances = norms - 2.0 * (vectors @ query)
+    top = np.argpartition(distances, limit - 1)[:limit]
+    exact.append({f"node{i}/0" for i in top})
+  return exact
+
+if __name__ == "__main__":
+  main()
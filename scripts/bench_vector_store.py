@@ -0,0 +1,104 @@
+# compares vector stores on the same random corpus: time to add, query latency and recall@k
+# against exact brute-force search.
+#   python scripts/bench_vector_store.py --count 100000 --dimension 768
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from chromadb.api.types import EmbeddingFunction, Documents, Embeddings
+
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, "..", "..")))
+
+# pylint: disable=wrong-import-position
+from index_package.index import VectorStore, ChromaVectorStore, FlatVectorStore
+
+_ADD_BATCH_SIZE = 1000
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--count", type=int, default=20000)
+  parser.add_argument("--dimension", type=int, default=768)
+  parser.add_argument("--queries", type=int, default=200)
+  parser.add_argument("--limit", type=int, default=10)
+  parser.add_argument("--hnsw-threshold", type=int, default=100000)
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  vectors = rng.standard_normal((args.count, args.dimension), dtype=np.float32)
+  queries = rng.standard_normal((args.queries, args.dimension), dtype=np.float32)
+  exact = _exact_top_k(vectors, queries, args.limit)
+
+  dir_path = tempfile.mkdtemp(prefix="bench_vector_store_")
+  try:
+    stores: list[tuple[str, VectorStore]] = [
+      ("flat", FlatVectorStore(
+        _ensure_dir(dir_path, "flat"),
+        distance_space="l2",
+        hnsw_threshold=args.hnsw_threshold,
+      )),
+      ("chroma", ChromaVectorStore(
+        _ensure_dir(dir_path, "chroma"),
+        distance_space="l2",
+        embedding_function=_NoEmbeddingFunction(),
+      )),
+    ]
+    print(f"{'store':<8} {'add (s)':>10} {'p50 (ms)':>10} {'p95 (ms)':>10} {'recall':>8}")
+    for name, store in stores:
+      add_seconds = _add(store, vectors)
+      latencies, recall = _query(store, queries, exact, args.limit)
+      print(
+        f"{name:<8} {add_seconds:>10.2f} "
+        f"{np.percentile(latencies, 50) * 1000:>10.2f} "
+        f"{np.percentile(latencies, 95) * 1000:>10.2f} "
+        f"{recall:>8.3f}"
+      )
+  finally:
+    shutil.rmtree(dir_path, ignore_errors=True)
+
+def _add(store: VectorStore, vectors: np.ndarray) -> float:
+  begin = time.perf_counter()
+  for offset in range(0, len(vectors), _ADD_BATCH_SIZE):
+    batch = vectors[offset:offset + _ADD_BATCH_SIZE]
+    ids = [f"node{offset + i}/0" for i in range(len(batch))]
+    store.add(
+      ids=ids,
+      embeddings=batch,
+      metadatas=[{"owner": f"node{offset + i}", "type": "pdf.page"} for i in range(len(batch))],
+      documents=["" for _ in ids],
+    )
+  return time.perf_counter() - begin
+
+def _query(store: VectorStore, queries: np.ndarray, exact: list[set[str]], limit: int) -> tuple[list[float], float]:
+  latencies: list[float] = []
+  found_count: int = 0
+  for query, expected_ids in zip(queries, exact):
+    begin = time.perf_counter()
+    segments = store.query(query, limit, None)
+    latencies.append(time.perf_counter() - begin)
+    found_count += len(expected_ids.intersection(id for id, _, _ in segments))
+  return latencies, found_count / (len(queries) * limit)
+
+def _exact_top_k(vectors: np.ndarray, queries: np.ndarray, limit: int) -> list[set[str]]:
+  norms = np.einsum("ij,ij->i", vectors, vectors)
+  exact: list[set[str]] = []
+  for query in queries:
+    distances = norms - 2.0 * (vectors @ query)
+    top = np.argpartition(distances, limit - 1)[:limit]
+    exact.append({f"node{i}/0" for i in top})
+  return exact
+
+def _ensure_dir(dir_path: str, name: str) -> str:
+  path = os.path.join(dir_path, name)
+  os.makedirs(path, exist_ok=True)
+  return path
+
+class _NoEmbeddingFunction(EmbeddingFunction):
+  def __call__(self, input: Documents) -> Embeddings:
+    raise RuntimeError("embeddings are always given by the benchmark")
+
+if __name__ == "__main__":
+  main()
@@ -1,11 +1,17 @@
 import os
+import numpy
+import importlib.util
+import sqlite3
 import unittest
+import threading
 
 from index_package.parser import PdfParser
 from index_package.scanner import Scope, Event, EventKind, EventTarget
 from index_package.segmentation import Segment, Segmentation
-from index_package.index import Index, IndexNode, VectorDB, FTS5DB, IndexNodeMatching
+from index_package.index import Index, IndexNode, VectorDB, FlatVectorStore, FTS5DB, FTS5Maintenance, IndexNodeMatching, RRFRanking, QueryCache, EmbeddingCache, EmbeddingPool
 from index_package.index.index_db import IndexDB
+from index_package.index.vector_db import _EmbeddingFunction, _length_sorted_batches
+from index_package.index.types import NodesFilter
 from tests.utils import get_temp_path
 
 class TestIndex(unittest.TestCase):
@@ -66,6 +72,24 @@ class TestIndex(unittest.TestCase):
       [(0, 100), (100, 250)],
     )
 
+    ranked_ids = [n.id for n in db.query("Transference", limit=10)]
+    self.assertEqual(sorted(ranked_ids), ["id1", "id2"])
+    self.assertEqual(
+      [n.id for n in db.query("Transference", limit=1)] +
+      [n.id for n in db.query("Transference", limit=1, offset=1)],
+      ranked_ids,
+    )
+    self.assertEqual([n.id for n in db.query("Transference", limit=10, offset=2)], [])
+
+    self.assertEqual(
+      [(n.id, n.matching) for n in db.query_ranked("Transference analysis", limit=10)],
+      [("id2", IndexNodeMatching.Matched), ("id1", IndexNodeMatching.MatchedPartial)],
+    )
+    self.assertEqual(
+      [n.id for n in db.query_ranked("Transference analysis", limit=1)],
+      ["id2"],
+    )
+
     db.remove("id2")
     nodes = []
     for node in db.query("Transference analysis"):
@@ -73,6 +97,334 @@ class TestIndex(unittest.TestCase):
 
     self.assertEqual(len(nodes), 0)
 
+  def test_fts5_contentless(self):
+    db_path = os.path.abspath(os.path.join(get_temp_path("index-database/fts5_contentless"), "db.sqlite3"))
+    db = FTS5DB(db_path=db_path)
+    self.assertIsNone(db.storage_migration)
+
+    for node_id, text in (
+      ("id1", "the transference in the here and now are the core of the analytic work."),
+      ("id2", "which the technique of analysis of the transference is appropriate"),
+    ):
+      db.save(node_id, [Segment(start=0, end=100, text=text)], metadata={})
+
+    db = FTS5DB(db_path=db_path, contentless=True)
+    migration = db.storage_migration
+    self.assertIsNotNone(migration)
+    self.assertTrue(migration.contentless)
+    self.assertEqual([n.id for n in db.query("transference analysis")], ["id2"])
+
+    db.save("id3", [Segment(start=0, end=100, text="transference analysis")], metadata={})
+    db.remove("id2")
+    self.assertEqual(
+      [(n.id, n.segments[0].matched_tokens) for n in db.query("transference analysis", limit=10)],
+      [("id3", ["analysis", "transference"])],
+    )
+
+    # opened without asking for a storage, it is kept as it is
+    db = FTS5DB(db_path=db_path)
+    self.assertIsNone(db.storage_migration)
+    self.assertEqual(sorted(n.id for n in db.query("transference")), ["id1", "id3"])
+    db.save("id4", [Segment(start=0, end=100, text="transference")], metadata={})
+    db.remove("id4")
+
+    db = FTS5DB(db_path=db_path, contentless=False)
+    self.assertFalse(db.storage_migration.contentless)
+    self.assertEqual(sorted(n.id for n in db.query("transference")), ["id1", "id3"])
+
+  def test_fts5_highlights(self):
+    db = FTS5DB(
+      db_path=os.path.abspath(os.path.join(get_temp_path("index-database/fts5_highlights"), "db.sqlite3")),
+    )
+    text = "Intro. The Transference, and transference again."
+    db.save("id1", [
+      Segment(start=0, end=6, text=text[0:6]),
+      Segment(start=7, end=len(text), text=text[7:]),
+    ], metadata={}, text=text)
+    db.save("id2", [Segment(start=0, end=12, text="transference")], metadata={})
+
+    nodes = {n.id: n for n in db.query("transference", limit=10)}
+    segment = nodes["id1"].segments[0]
+    self.assertEqual((segment.start, segment.end), (7, len(text)))
+    self.assertEqual(segment.highlights, [(4, 16), (22, 34)])
+    self.assertIsNone(nodes["id2"].segments[0].highlights)
+
+  def test_fts5_query_syntax(self):
+    db = FTS5DB(
+      db_path=os.path.abspath(os.path.join(get_temp_path("index-database/fts5_syntax"), "db.sqlite3")),
+    )
+    for node_id, text in (
+      ("id1", "the transference in the here and now are the core of the analytic work."),
+      ("id2", "which the technique of analysis of the transference is appropriate"),
+      ("id3", "free association is the fundamental rule of analysis"),
+    ):
+      db.save(node_id, [Segment(start=0, end=100, text=text)], metadata={})
+
+    def query(text: str) -> list[str]:
+      return sorted(n.id for n in db.query(text))
+
+    self.assertEqual(query("transfer"), [])
+    self.assertEqual(query("transfer*"), ["id1", "id2"])
+    self.assertEqual(query("analy*"), ["id1", "id2", "id3"])
+    self.assertEqual(query("\"analytic work\""), ["id1"])
+    self.assertEqual(query("\"work analytic\""), [])
+    self.assertEqual(query("NEAR(technique transference, 5)"), ["id2"])
+    self.assertEqual(query("NEAR(technique transference, 1)"), [])
+    self.assertEqual(query("rule \"free association\""), ["id3"])
+
+    nodes = list(db.query("transfer* core"))
+    self.assertEqual([n.id for n in nodes], ["id1"])
+    self.assertEqual(nodes[0].segments[0].matched_tokens, ["core", "transference"])
+    self.assertEqual(
+      sorted((n.id, n.matching) for n in db.query_ranked("transfer* here", 10)),
+      [("id1", IndexNodeMatching.Matched), ("id2", IndexNodeMatching.MatchedPartial)],
+    )
+
+  def test_fts5_common_terms(self):
+    db_path = os.path.abspath(os.path.join(get_temp_path("index-database/fts5_common_terms"), "db.sqlite3"))
+    texts = [
+      "the transference in the here and now",
+      "the technique of analysis",
+      "the fundamental rule of analysis",
+      "free association",
+    ]
+    db = FTS5DB(db_path=db_path)
+    for i, text in enumerate(texts):
+      db.save(f"id{i}", [Segment(start=0, end=100, text=text)], metadata={})
+
+    def query(db: FTS5DB, text: str, is_or_condition: bool) -> list[str]:
+      return sorted(n.id for n in db.query(text, is_or_condition=is_or_condition))
+
+    self.assertEqual(query(db, "the analysis", True), ["id0"])
+
+    db = FTS5DB(db_path=db_path, max_df_ratio=0.5)
+    self.assertEqual(query(db, "the analysis", False), ["id1", "id2"])
+    self.assertEqual(query(db, "the transference analysis", True), ["id0", "id1", "id2"])
+    self.assertEqual(query(db, "the analysis", True), [])
+    self.assertEqual(query(db, "the", False), ["id0", "id1", "id2"])
+
+    db = FTS5DB(db_path=db_path, max_df_ratio=0.5, drop_common_terms=True)
+    self.assertEqual(query(db, "the free", False), ["id3"])
+
+    db = FTS5DB(db_path=db_path, contentless=True, max_df_ratio=0.5, drop_common_terms=True)
+    self.assertEqual(query(db, "the free", False), ["id3"])
+
+    # count of nodes follows saves and removes of the same FTS5DB
+    for i in range(4):
+      db.save(f"free{i}", [Segment(start=0, end=100, text="free speech")], metadata={})
+    self.assertEqual(query(db, "the free", False), ["id0", "id1", "id2"])
+    for i in range(4):
+      db.remove(f"free{i}")
+    self.assertEqual(query(db, "the free", False), ["id3"])
+
+  def test_fts5_batch(self):
+    db = FTS5DB(
+      db_path=os.path.abspath(os.path.join(get_temp_path("index-database/fts5_batch"), "db.sqlite3")),
+    )
+    with db.batch():
+      db.save("id1", [Segment(start=0, end=100, text="the transference")], metadata={})
+      with self.assertRaises(sqlite3.IntegrityError):
+        db.save("id1", [Segment(start=0, end=100, text="the analysis")], metadata={})
+      db.save("id2", [Segment(start=0, end=100, text="transference analysis")], metadata={})
+      self.assertEqual(list(db.query("transference")), [])
+
+    self.assertEqual(sorted(n.id for n in db.query("transference")), ["id1", "id2"])
+    self.assertEqual([n.id for n in db.query("analysis")], ["id2"])
+
+    # a batch never blocks writes of other threads
+    saved = threading.Event()
+    def save_in_thread():
+      db.save("id4", [Segment(start=0, end=100, text="free association")], metadata={})
+      saved.set()
+
+    with db.batch():
+      db.save("id3", [Segment(start=0, end=100, text="analytic work")], metadata={})
+      thread = threading.Thread(target=save_in_thread)
+      thread.start()
+      self.assertTrue(saved.wait(timeout=5.0))
+      thread.join()
+      db.save("id5", [Segment(start=0, end=100, text="analytic rule")], metadata={})
+
+    self.assertEqual(sorted(n.id for n in db.query("analytic")), ["id3", "id5"])
+    self.assertEqual([n.id for n in db.query("association")], ["id4"])
+
+    db.remove("id1")
+    self.assertEqual([n.id for n in db.query("transference")], ["id2"])
+
+  def test_fts5_maintenance(self):
+    db = FTS5DB(
+      db_path=os.path.abspath(os.path.join(get_temp_path("index-database/fts5_maintenance"), "db.sqlite3")),
+    )
+    db.configure_merge(automerge=0)
+    maintenance = FTS5Maintenance(db, merge_pages=16, writes_threshold=10)
+
+    for i in range(12):
+      db.save(f"id{i}", [Segment(start=0, end=10, text=f"word{i} common text")], metadata={})
+
+    stats = maintenance.stats
+    self.assertEqual(stats.writes_count, 12)
+    self.assertGreater(stats.segments_count, 1)
+    self.assertTrue(maintenance.needs_merge)
+    self.assertTrue(maintenance.run_slice(time_budget=10.0))
+    self.assertLess(maintenance.stats.segments_count, stats.segments_count)
+    self.assertFalse(maintenance.needs_merge)
+
+    db.save("id12", [Segment(start=0, end=10, text="word12 common text")], metadata={})
+    maintenance.optimize()
+    self.assertEqual(maintenance.stats.segments_count, 1)
+    self.assertEqual(len(list(db.query("common"))), 13)
+
+  def test_fts5_migrate_text_segments(self):
+    db_path = os.path.abspath(os.path.join(get_temp_path("index-database/fts5_migration"), "db.sqlite3"))
+    with sqlite3.connect(db_path) as conn:
+      conn.execute("CREATE VIRTUAL TABLE contents USING fts5(content, tokenize = \"unicode61 remove_diacritics 2\")")
+      conn.execute("CREATE TABLE nodes (node_id TEXT PRIMARY KEY, type TEXT, metadata TEXT NOT NULL, segments TEXT NOT NULL, content_id INTEGER NOT NULL)")
+      conn.execute("INSERT INTO contents (rowid, content) VALUES (1, 'transference analysis the here')")
+      conn.execute("INSERT INTO nodes VALUES ('id1', NULL, '{}', '2:0-100,2:100-250', 1)")
+      conn.commit()
+    conn.close()
+
+    db = FTS5DB(db_path=db_path)
+    nodes = list(db.query("here"))
+    self.assertEqual(
+      [(s.start, s.end, s.matched_tokens) for s in nodes[0].segments],
+      [(100, 250, ["here"])],
+    )
+
+  def test_fts5_query_with_filter(self):
+    db = FTS5DB(
+      db_path=os.path.abspath(os.path.join(get_temp_path("index-database/fts5_filter"), "db.sqlite3")),
+    )
+    text = "the transference in the here and now are the core of the analytic work."
+    for node_id, type in (
+      ("page1", "pdf.page"),
+      ("page1/anno/0/content", "pdf.page.anno.content"),
+      ("page2", "pdf.page"),
+    ):
+      db.save(
+        node_id=node_id,
+        segments=[Segment(start=0, end=100, text=text)],
+        metadata={"type": type},
+      )
+
+    def query(nodes_filter: NodesFilter) -> list[str]:
+      return sorted(n.id for n in db.query("transference", nodes_filter=nodes_filter))
+
+    self.assertEqual(query(NodesFilter()), ["page1", "page1/anno/0/content", "page2"])
+    self.assertEqual(query(NodesFilter(types=("pdf.page",))), ["page1", "page2"])
+    self.assertEqual(query(NodesFilter(owners=("page1",))), ["page1", "page1/anno/0/content"])
+    self.assertEqual(query(NodesFilter(owners=("page1",), types=("pdf.page",))), ["page1"])
+    self.assertEqual(query(NodesFilter(owners=())), [])
+
+    node = next(db.query("transference", nodes_filter=NodesFilter(owners=("page2",))))
+    self.assertEqual(node.type, "pdf.page")
+    self.assertEqual(node.metadata, {"type": "pdf.page"})
+    self.assertEqual(
+      [n.id for n in db.query_ranked("transference", 10, NodesFilter(owners=("page2",)))],
+      ["page2"],
+    )
+
+  def test_fts5_query_skipped_rows(self):
+    db = FTS5DB(
+      db_path=os.path.abspath(os.path.join(get_temp_path("index-database/fts5_skipped_rows"), "db.sqlite3")),
+    )
+    # FTS5 matches "cafe" in "café", but analysis doesn't, so that those rows are skipped
+    # and the following rows are read by another page.
+    for i in range(5):
+      db.save(node_id=f"latte{i}", segments=[Segment(start=0, end=100, text="café latte")], metadata={})
+    db.save(node_id="mocha", segments=[Segment(start=0, end=100, text="cafe mocha")], metadata={})
+
+    self.assertEqual([n.id for n in db.query("cafe", limit=2)], ["mocha"])
+    self.assertEqual([n.id for n in db.query_ranked("cafe", 2)], ["mocha"])
+
+  def test_query_cache(self):
+    db_path = os.path.abspath(os.path.join(get_temp_path("index-database/query_cache"), "db.sqlite3"))
+    encoded_texts: list[str] = []
+
+    def encode(text: str) -> list[float]:
+      encoded_texts.append(text)
+      return [float(len(text)), 0.5]
+
+    cache = QueryCache(embedding_model_id="model", db_path=db_path)
+    self.assertEqual(cache.embedding("foo bar", encode), [7.0, 0.5])
+    self.assertEqual(cache.embedding("foo bar", encode), [7.0, 0.5])
+    self.assertEqual(cache.keywords("the foo bar", lambda t: t.split(" ")[1:]), ["foo", "bar"])
+    self.assertEqual(encoded_texts, ["foo bar"])
+    self.assertEqual(cache.stats.embedding_hits, 1)
+    self.assertEqual(cache.stats.embedding_misses, 1)
+    self.assertGreater(cache.stats.memory_size, 0)
+
+    # reload from disk
+    cache = QueryCache(embedding_model_id="model", db_path=db_path)
+    self.assertEqual(cache.embedding("foo bar", encode), [7.0, 0.5])
+    self.assertEqual(cache.keywords("the foo bar", lambda _: []), ["foo", "bar"])
+    self.assertEqual(encoded_texts, ["foo bar"])
+    self.assertEqual((cache.stats.embedding_hits, cache.stats.embedding_misses), (1, 0))
+    self.assertEqual((cache.stats.keywords_hits, cache.stats.keywords_misses), (1, 0))
+
+    # embeddings of another model are never reused
+    cache = QueryCache(embedding_model_id="another_model", db_path=db_path)
+    cache.embedding("foo bar", encode)
+    self.assertEqual(encoded_texts, ["foo bar", "foo bar"])
+
+    # nor those of another backend, but keywords are
+    cache = QueryCache(embedding_model_id="model", db_path=db_path, embedding_backend="int8")
+    cache.embedding("foo bar", encode)
+    self.assertEqual(cache.keywords("the foo bar", lambda _: []), ["foo", "bar"])
+    self.assertEqual(encoded_texts, ["foo bar", "foo bar", "foo bar"])
+
+    # oldest entries are dropped once over the limit
+    cache = QueryCache(embedding_model_id="model", db_path=db_path, max_persisted_count=2)
+    cache.embedding("foo", encode)
+    cache.embedding("bar", encode)
+    cache = QueryCache(embedding_model_id="model", db_path=db_path, max_persisted_count=2)
+    cache.embedding("bar", encode)
+    cache.embedding("foo bar", encode)
+    self.assertEqual(encoded_texts, ["foo bar", "foo bar", "foo bar", "foo", "bar", "foo bar"])
+
+  def test_embedding_cache(self):
+    db_path = os.path.abspath(os.path.join(get_temp_path("index-database/embedding_cache"), "db.sqlite3"))
+    encoded_texts: list[str] = []
+
+    def encode(texts: list[str]) -> numpy.ndarray:
+      encoded_texts.extend(texts)
+      return numpy.array([[float(len(text)), 0.5] for text in texts], dtype=numpy.float32)
+
+    cache = EmbeddingCache(db_path=db_path, embedding_model_id="model", max_count=3)
+    embeddings = cache.encode(["header", "foo", "header"], encode)
+    self.assertEqual(embeddings.tolist(), [[6.0, 0.5], [3.0, 0.5], [6.0, 0.5]])
+    self.assertEqual(encoded_texts, ["header", "foo"])
+
+    embeddings = cache.encode(["foo", "bar"], encode)
+    self.assertEqual(embeddings.tolist(), [[3.0, 0.5], [3.0, 0.5]])
+    self.assertEqual(encoded_texts, ["header", "foo", "bar"])
+    self.assertEqual(cache.stats.hits, 2)
+    self.assertEqual(cache.stats.misses, 3)
+    self.assertEqual(cache.stats.count, 3)
+
+    # "header" is the least recently used one
+    cache = EmbeddingCache(db_path=db_path, embedding_model_id="model", max_count=3)
+    cache.encode(["hello"], encode)
+    cache.encode(["foo", "bar", "header"], encode)
+    self.assertEqual(encoded_texts, ["header", "foo", "bar", "hello", "header"])
+    self.assertEqual(cache.stats.count, 3)
+
+    # embeddings of another backend are never reused
+    cache = EmbeddingCache(db_path=db_path, embedding_model_id="model", max_count=3, embedding_backend="onnx")
+    cache.encode(["header"], encode)
+    self.assertEqual(encoded_texts, ["header", "foo", "bar", "hello", "header", "header"])
+
+    # more texts than variables of a query are all found again
+    db_path = os.path.abspath(os.path.join(get_temp_path("index-database/embedding_cache_many"), "db.sqlite3"))
+    cache = EmbeddingCache(db_path=db_path, embedding_model_id="model", max_count=1000)
+    texts = [f"text {i}" for i in range(600)]
+    cache.encode(texts, encode)
+    encoded_texts.clear()
+    cache = EmbeddingCache(db_path=db_path, embedding_model_id="model", max_count=1000)
+    self.assertEqual(cache.encode(texts, encode).shape, (600, 2))
+    self.assertEqual(encoded_texts, [])
+    self.assertEqual(cache.stats.count, 600)
+
   def test_vector_query(self):
     db = VectorDB(
       distance_space="l2",
@@ -102,6 +454,286 @@ class TestIndex(unittest.TestCase):
     node = nodes[0]
     self.assertEqual(node.id, "index/db/id1")
 
+    # segments are over-fetched until they belong to enough distinct nodes
+    nodes = db.query(query_embedding, results_limit=2)
+    self.assertEqual([n.id for n in nodes], ["index/db/id1", "index/db/id2"])
+    self.assertEqual(db.stats.queries, 2)
+    self.assertGreaterEqual(db.stats.rounds, 2)
+
+  def test_vector_query_coarse(self):
+    db = VectorDB(
+      distance_space="l2",
+      index_dir_path=get_temp_path("index-database/vector_coarse"),
+      embedding_model_id="shibing624/text2vec-base-chinese",
+      backend="flat",
+      coarse_factor=1,
+    )
+    db.save(
+      node_id="index/db/id1",
+      segments=[
+        Segment(start=0, end=100, text="the transference in the here and now."),
+        Segment(start=100, end=200, text="the transference is the core of the analytic work."),
+        Segment(start=200, end=300, text="transference interpretations of the analyst."),
+      ],
+      metadata={"type": "pdf.page"},
+    )
+    db.save(
+      node_id="index/db/id2",
+      segments=[Segment(start=0, end=100, text="I am of the opinion that the range of settings.")],
+      metadata={"type": "pdf.page"},
+    )
+    query_embedding = db.encode_embedding("the transference in the here and now")
+    nodes = db.query(query_embedding, results_limit=2)
+    self.assertEqual([n.id for n in nodes], ["index/db/id1", "index/db/id2"])
+    self.assertEqual([(s.start, s.end) for s in nodes[0].segments][0], (0, 100))
+    self.assertEqual(len(nodes[0].segments), 3)
+
+    db.remove_nodes(["index/db/id1", "index/db/id2"])
+    self.assertEqual(db.query(query_embedding, results_limit=2), [])
+
+  def test_vector_query_overfetch_budget(self):
+    def create_db(name: str, **kwargs) -> VectorDB:
+      db = VectorDB(
+        distance_space="l2",
+        index_dir_path=get_temp_path(f"index-database/vector_overfetch_{name}"),
+        embedding_model_id="fake",
+        backend="flat",
+        embedding_load_model=lambda: _FakeModel(128),
+        **kwargs,
+      )
+      db.save(
+        node_id="index/db/id1",
+        segments=[Segment(start=i * 100, end=(i + 1) * 100, text="x" * (10 + i)) for i in range(3)],
+        metadata={"type": "pdf.page"},
+      )
+      db.save(
+        node_id="index/db/id2",
+        segments=[Segment(start=0, end=100, text="x" * 30)],
+        metadata={"type": "pdf.page"},
+      )
+      return db
+
+    # by default, over-fetching is only bounded by size, so that results don't depend on load
+    db = create_db("default")
+    query_embedding = db.encode_embedding("x" * 10)
+    self.assertEqual([n.id for n in db.query(query_embedding, results_limit=2)], ["index/db/id1", "index/db/id2"])
+    self.assertEqual((db.stats.rounds, db.stats.budget_stops), (2, 0))
+    db.close()
+
+    for name, kwargs in (("size", {"overfetch_max_results": 2}), ("timeout", {"overfetch_timeout": 0.0})):
+      db = create_db(name, **kwargs)
+      self.assertEqual([n.id for n in db.query(query_embedding, results_limit=2)], ["index/db/id1"])
+      self.assertEqual((db.stats.rounds, db.stats.budget_stops), (1, 1))
+      db.close()
+
+  def test_embedding_batches(self):
+    lengths = [10, 500, 20, 480, 5]
+    self.assertEqual(_length_sorted_batches(lengths, 2, 1000), [[1, 3], [2, 0], [4]])
+    self.assertEqual(_length_sorted_batches(lengths, 2, 900), [[1], [3], [2, 0], [4]])
+    self.assertEqual(_length_sorted_batches(lengths, 8, 100), [[1], [3], [2, 0, 4]])
+    self.assertEqual(_length_sorted_batches([], 8, 100), [])
+
+  def test_embedding_batches_of_model(self):
+    # lengths of texts in each batch. texts are capped at 4 chars per token of max_seq_length
+    for max_seq_length, expected_batches in ((None, [[30], [10, 5]]), (2, [[10, 30, 5]])):
+      model = _FakeModel(max_seq_length)
+      encode = _EmbeddingFunction(
+        model_id="fake",
+        max_batch_size=8,
+        max_batch_chars=40,
+        load_model=lambda model=model: model,
+      )
+      texts = ["x" * 10, "x" * 30, "x" * 5]
+      self.assertEqual(encode.encode(texts).tolist(), [[float(len(text)), 0.5] for text in texts])
+      self.assertEqual(model.batches, expected_batches)
+
+  def test_embedding_backends(self):
+    with self.assertRaises(ValueError):
+      _EmbeddingFunction(model_id="fake", backend="tensorflow") # type: ignore
+
+    # model is loaded once, and run once by each warm_up
+    loaded_models: list[_FakeModel] = []
+
+    def load_model() -> _FakeModel:
+      loaded_models.append(_FakeModel(128))
+      return loaded_models[-1]
+
+    encode = _EmbeddingFunction(model_id="fake", load_model=load_model)
+    encode.warm_up()
+    encode.warm_up()
+    self.assertEqual(len(loaded_models), 1)
+    self.assertEqual(len(loaded_models[0].batches), 2)
+
+    if importlib.util.find_spec("onnxruntime") is None:
+      with self.assertRaises(ValueError):
+        _EmbeddingFunction(model_id="fake", backend="onnx").warm_up()
+
+  def test_embedding_pool(self):
+    pool = EmbeddingPool(create_encode=_create_fake_encode, processes=2)
+    try:
+      texts = ["x" * i for i in range(150)]
+      self.assertEqual(pool.encode(texts).tolist(), [[float(len(text)), 0.5] for text in texts])
+      self.assertEqual(pool.encode([]).shape, (0, 2))
+    finally:
+      pool.close()
+
+    # a worker dying later fails the call in progress only, and is started again
+    pool = EmbeddingPool(create_encode=_create_exiting_encode, processes=2)
+    try:
+      pool.warm_up()
+      for _ in range(2):
+        with self.assertRaises(RuntimeError):
+          pool.encode(["exit"])
+      texts = ["x" * i for i in range(10)]
+      self.assertEqual(pool.encode(texts).tolist(), [[float(len(text)), 0.5] for text in texts])
+    finally:
+      pool.close()
+
+    # a worker dying before its model is loaded fails warm_up, instead of hanging it
+    pool = EmbeddingPool(create_encode=_create_dying_encode, processes=2)
+    with self.assertRaises(RuntimeError):
+      pool.warm_up()
+
+  def test_flat_vector_store(self):
+    dir_path = get_temp_path("index-database/flat_vector")
+    store = FlatVectorStore(dir_path, distance_space="l2")
+    store.add(
+      ids=["page1/0", "page1/1", "page2/0", "page2/anno/0/content/0"],
+      embeddings=numpy.array([[0.0, 0.0], [1.0, 0.0], [0.0, 2.0], [3.0, 3.0]], dtype=numpy.float32),
+      metadatas=[
+        {"owner": "page1", "type": "pdf.page"},
+        {"owner": "page1", "type": "pdf.page"},
+        {"owner": "page2", "type": "pdf.page"},
+        {"owner": "page2", "type": "pdf.page.anno.content"},
+      ],
+      documents=["", "", "", ""],
+    )
+    query = numpy.array([1.0, 0.5], dtype=numpy.float32)
+
+    self.assertEqual(
+      [(id, distance) for id, distance, _ in store.query(query, 3, None)],
+      [("page1/1", 0.25), ("page1/0", 1.25), ("page2/0", 3.25)],
+    )
+    self.assertEqual(
+      [id for id, _, _ in store.query(query, 10, NodesFilter(owners=("page2",)))],
+      ["page2/0", "page2/anno/0/content/0"],
+    )
+    self.assertEqual(
+      [id for id, _, _ in store.query(query, 10, NodesFilter(types=("pdf.page.anno.content",)))],
+      ["page2/anno/0/content/0"],
+    )
+
+    store.delete(["page1/1"])
+    store.add(
+      ids=["page3/0"],
+      embeddings=numpy.array([[1.0, 1.0]], dtype=numpy.float32),
+      metadatas=[{"owner": "page3", "type": "pdf.page"}],
+      documents=[""],
+    )
+    store = FlatVectorStore(dir_path, distance_space="l2")
+    self.assertEqual(store.count(), 4)
+    self.assertEqual(
+      [(id, metadata["owner"]) for id, _, metadata in store.query(query, 2, None)],
+      [("page3/0", "page3"), ("page1/0", "page1")],
+    )
+    self.assertEqual(store.metadatas(["page1/1", "page3/0"]), [None, {"owner": "page3", "type": "pdf.page"}])
+    self.assertEqual([e.tolist() for e in store.embeddings(["page3/0"])], [[1.0, 1.0]])
+    self.assertEqual(
+      [id for id, _, _ in store.query(query, 10, NodesFilter(owners=("page3", "page9"), types=("pdf.page",)))],
+      ["page3/0"],
+    )
+    self.assertEqual(store.query(query, 10, NodesFilter(owners=("page9",))), [])
+
+    store.update(["page3/0"], [{"owner": "page4", "type": "pdf.page"}])
+    self.assertEqual(store.query(query, 10, NodesFilter(owners=("page3",))), [])
+    self.assertEqual([id for id, _, _ in store.query(query, 10, NodesFilter(owners=("page4",)))], ["page3/0"])
+
+  def test_flat_vector_store_delete_nodes(self):
+    store = FlatVectorStore(get_temp_path("index-database/flat_vector_delete_nodes"), distance_space="l2")
+    ids = ["page1/0", "page1/1", "page1/anno/0/content/0", "page2/0"]
+    store.add(
+      ids=ids,
+      embeddings=numpy.array([[0.0, 0.0], [1.0, 0.0], [0.0, 2.0], [3.0, 3.0]], dtype=numpy.float32),
+      metadatas=[{"owner": "page1", "node_id": id.rsplit("/", 1)[0]} for id in ids],
+      documents=["", "", "", ""],
+    )
+    store.delete_nodes(["page1", "page2"])
+    self.assertEqual(store.list(10, 0)[0], ["page1/anno/0/content/0"])
+    store.delete_nodes(["page1/anno/0/content"])
+    self.assertEqual(store.count(), 0)
+
+  def test_flat_vector_store_node_ids(self):
+    store = FlatVectorStore(get_temp_path("index-database/flat_vector_node_ids"), distance_space="l2")
+    store.add(
+      ids=["page1/0", "page1/1", "page2/0", "page2/anno/0/content/0"],
+      embeddings=numpy.array([[0.0, 0.0], [1.0, 0.0], [0.0, 2.0], [3.0, 3.0]], dtype=numpy.float32),
+      metadatas=[
+        {"owner": "page1", "type": "pdf.page"},
+        {"owner": "page1", "type": "pdf.page"},
+        {"owner": "page2", "type": "pdf.page"},
+        {"owner": "page2", "type": "pdf.page.anno.content"},
+      ],
+      documents=["", "", "", ""],
+    )
+    query = numpy.array([1.0, 0.5], dtype=numpy.float32)
+    self.assertEqual(
+      [id for id, _, _ in store.query(query, 10, None, node_ids=["page2", "page2/anno/0/content"])],
+      ["page2/0", "page2/anno/0/content/0"],
+    )
+    self.assertEqual(
+      [id for id, _, _ in store.query(query, 10, NodesFilter(types=("pdf.page",)), node_ids=["page1", "page2"])],
+      ["page1/1", "page1/0", "page2/0"],
+    )
+
+    # slots freed by deletion are reused by other nodes
+    store.delete(["page1/0", "page1/1"])
+    self.assertEqual(store.query(query, 10, None, node_ids=["page1"]), [])
+    store.add(
+      ids=["page3/0"],
+      embeddings=numpy.array([[1.0, 1.0]], dtype=numpy.float32),
+      metadatas=[{"owner": "page3", "type": "pdf.page"}],
+      documents=[""],
+    )
+    self.assertEqual(
+      [id for id, _, _ in store.query(query, 10, None, node_ids=["page1", "page3"])],
+      ["page3/0"],
+    )
+    store.close()
+    store = FlatVectorStore(get_temp_path("index-database/flat_vector_node_ids"), distance_space="l2")
+    self.assertEqual(
+      [id for id, _, _ in store.query(query, 10, None, node_ids=["page3", "page2"])],
+      ["page3/0", "page2/0"],
+    )
+
+  def test_flat_vector_store_quantization(self):
+    dir_path = get_temp_path("index-database/flat_vector_quantization")
+    rng = numpy.random.default_rng(0)
+    embeddings = rng.standard_normal((300, 16), dtype=numpy.float32)
+    query = embeddings[7] + 0.01
+    store = FlatVectorStore(dir_path, distance_space="l2")
+    store.add(
+      ids=[f"page{i}/0" for i in range(len(embeddings))],
+      embeddings=embeddings,
+      metadatas=[{"owner": f"page{i}", "type": "pdf.page"} for i in range(len(embeddings))],
+      documents=["" for _ in embeddings],
+    )
+    expected = store.query(query, 5, None)
+    self.assertEqual(expected[0][0], "page7/0")
+
+    # quantized rows are built from float32 rows, and distances are re-ranked exactly
+    for quantization in ("int8", "float16"):
+      store = FlatVectorStore(dir_path, distance_space="l2", quantization=quantization)
+      self.assertEqual(store.query(query, 5, None), expected)
+      self.assertEqual(store.embeddings(["page3/0"])[0].tolist(), embeddings[3].tolist())
+
+    store.add(
+      ids=["page300/0"],
+      embeddings=numpy.array([query], dtype=numpy.float32),
+      metadatas=[{"owner": "page300", "type": "pdf.page"}],
+      documents=[""],
+    )
+    self.assertEqual([id for id, _, _ in store.query(query, 2, None)], ["page300/0", "page7/0"])
+
   def test_database_query(self):
     fts5_db = FTS5DB(
       db_path=os.path.abspath(os.path.join(get_temp_path("index-database/database"), "db.sqlite3")),
@@ -153,11 +785,62 @@ class TestIndex(unittest.TestCase):
       ("id2", IndexNodeMatching.Similarity),
     ])
 
+    for results_limit in (1, 3, 100):
+      sequential_results = [
+        (node.id, node.matching)
+        for node in db.query("Transference analysis", results_limit=results_limit)
+      ]
+      concurrent_results = [
+        (node.id, node.matching)
+        for node in db.query("Transference analysis", results_limit=results_limit, concurrent=True)
+      ]
+      self.assertEqual(sequential_results, concurrent_results)
+
+    rrf_results = [
+      (node.id, node.matching)
+      for node in db.query("Transference analysis", results_limit=3, ranking=RRFRanking())
+    ]
+    self.assertEqual(len(rrf_results), 3)
+    self.assertEqual(rrf_results[0], ("id1", IndexNodeMatching.Matched))
+
+  def test_database_query_concurrently(self):
+    vector_db = VectorDB(
+      distance_space="l2",
+      index_dir_path=get_temp_path("index-database/concurrent_vector"),
+      embedding_model_id="fake",
+      backend="flat",
+      embedding_load_model=lambda: _FakeModel(128),
+    )
+    db = IndexDB(
+      fts5_db=FTS5DB(
+        db_path=os.path.abspath(os.path.join(get_temp_path("index-database/concurrent_fts5"), "db.sqlite3")),
+      ),
+      vector_db=vector_db,
+    )
+    for node_id, text in (
+      ("id1", "the transference in the here and now."),
+      ("id2", "the transference is the core of the analytic work."),
+      ("id3", "I am of the opinion that the range of settings."),
+    ):
+      db.save(node_id=node_id, segments=[Segment(start=0, end=100, text=text)], metadata={})
+
+    # the vector tier is only queried when the FTS5 tiers come up short
+    nodes = db.query("transference", results_limit=2, concurrent=True)
+    self.assertEqual(sorted(n.id for n in nodes), ["id1", "id2"])
+    self.assertEqual(vector_db.stats.queries, 0)
+
+    nodes = db.query("transference", results_limit=3, concurrent=True)
+    self.assertEqual(
+      [(n.id, n.matching) for n in nodes],
+      [(n.id, n.matching) for n in db.query("transference", results_limit=3)],
+    )
+    self.assertEqual(nodes[2].matching, IndexNodeMatching.Similarity)
+    self.assertEqual(vector_db.stats.queries, 2)
+
   def test_vector_index_for_pdf(self):
     segmentation = Segmentation()
     parser = PdfParser(
       cache_dir_path=get_temp_path("index_vector/parser_cache"),
-      temp_dir_path=get_temp_path("index_vector/temp"),
     )
     fts5_db = FTS5DB(
       db_path=os.path.abspath(os.path.join(
@@ -199,6 +882,43 @@ class TestIndex(unittest.TestCase):
       [(0, len("Identification"))],
     )
 
+  def test_query_phrase_with_stop_words(self):
+    segmentation = Segmentation()
+    fts5_db = FTS5DB(
+      db_path=os.path.abspath(os.path.join(get_temp_path("index_phrase/fts5_db"), "db.sqlite3")),
+    )
+    vector_db = VectorDB(
+      distance_space="l2",
+      index_dir_path=get_temp_path("index_phrase/vector_db"),
+      embedding_model_id="shibing624/text2vec-base-chinese",
+    )
+    index = Index(
+      pdf_parser=PdfParser(
+        cache_dir_path=get_temp_path("index_phrase/parser_cache"),
+      ),
+      segmentation=segmentation,
+      fts5_db=fts5_db,
+      vector_db=vector_db,
+      index_dir_path=get_temp_path("index_phrase/index"),
+      scope=_Scope({}),
+    )
+    # segments are indexed as pages are, whose text has no stop words
+    for node_id, text in (
+      ("page1", "This technique is the state of the art of the analysis of dreams."),
+      ("page2", "The art of the state is a different matter."),
+    ):
+      segments = segmentation.split(text)
+      fts5_db.save(node_id, segments, metadata={"type": "pdf.page"})
+      vector_db.save(node_id, segments, metadata={"type": "pdf.page"})
+
+    for query_text in ("\"state of the art\"", "NEAR(technique of the analysis, 2)", "\"the analysis of dreams\""):
+      nodes, _ = index.query(query_text, results_limit=10)
+      matched_ids = [n.id for n in nodes if n.matching == IndexNodeMatching.Matched]
+      self.assertEqual(matched_ids, ["page1"], query_text)
+
+    _, keywords = index.query("\"state of the art\" of*", results_limit=10)
+    self.assertEqual(keywords, ["\"state art\"", "of*"])
+
 class _Scope(Scope):
   def __init__(self, sources: dict[str, str]) -> None:
     super().__init__()
@@ -209,4 +929,30 @@ class _Scope(Scope):
     return list(self._sources.keys())
 
   def scope_path(self, scope: str) -> str | None:
-    return self._sources.get(scope, None)
\ No newline at end of file
+    return self._sources.get(scope, None)
+
+class _FakeModel:
+  def __init__(self, max_seq_length: int | None):
+    self.max_seq_length: int | None = max_seq_length
+    self.batches: list[list[int]] = []
+
+  def encode(self, texts: list[str], batch_size: int, convert_to_numpy: bool) -> numpy.ndarray:
+    assert batch_size == len(texts) and convert_to_numpy
+    self.batches.append([len(text) for text in texts])
+    return numpy.array([[float(len(text)), 0.5] for text in texts], dtype=numpy.float32)
+
+# runs in worker processes of EmbeddingPool, so it must be module-level
+def _create_fake_encode():
+  def encode(texts: list[str]) -> numpy.ndarray:
+    return numpy.array([[float(len(text)), 0.5] for text in texts], dtype=numpy.float32).reshape(-1, 2)
+  return encode
+
+def _create_dying_encode():
+  os._exit(3)
+
+def _create_exiting_encode():
+  def encode(texts: list[str]) -> numpy.ndarray:
+    if "exit" in texts:
+      os._exit(3)
+    return numpy.array([[float(len(text)), 0.5] for text in texts], dtype=numpy.float32).reshape(-1, 2)
+  return encode
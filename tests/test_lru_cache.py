@@ -0,0 +1,39 @@
+import unittest
+
+from index_package.utils import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+
+  def test_evict_by_size(self):
+    cache = LRUCache[str, str](max_size=10, sizeof=len)
+    cache.put("a", "1234")
+    cache.put("b", "1234")
+    self.assertEqual(cache.get("a"), "1234")
+
+    # "b" is the least recently used one
+    cache.put("c", "1234")
+    self.assertEqual(cache.get("b"), None)
+    self.assertEqual(cache.get("a"), "1234")
+    self.assertEqual(cache.get("c"), "1234")
+    self.assertEqual(cache.size, 8)
+
+    cache.put("d", "12345678901")
+    self.assertEqual(cache.get("d"), None)
+    self.assertEqual(len(cache), 2)
+
+  def test_invalidate_by_generation(self):
+    cache = LRUCache[str, str](max_size=10, sizeof=len)
+    cache.put("a", "1234", generation=1)
+    self.assertEqual(cache.get("a", generation=1), "1234")
+    self.assertEqual(cache.get("a", generation=2), None)
+    self.assertEqual(cache.get("a", generation=1), None)
+    self.assertEqual(cache.size, 0)
+
+  def test_hits_and_misses(self):
+    cache = LRUCache[str, str](max_size=10, sizeof=len)
+    cache.put("a", "1234")
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    self.assertEqual(cache.hits, 2)
+    self.assertEqual(cache.misses, 1)
@@ -13,7 +13,6 @@ class TestPdfParser(unittest.TestCase):
     removed_page_hashes: list[str] = []
     parser = PdfParser(
       cache_dir_path=get_temp_path("pdf_struct/cache"),
-      temp_dir_path=get_temp_path("pdf_struct/temp"),
       listeners=PdfParserListeners(
         on_page_added=added_page_hashes.append,
         on_page_removed=removed_page_hashes.append,
@@ -115,7 +114,6 @@ class TestPdfParser(unittest.TestCase):
     removed_page_hashes: list[str] = []
     parser = PdfParser(
       cache_dir_path=get_temp_path("pdf_extract/cache"),
-      temp_dir_path=get_temp_path("pdf_extract/temp"),
       listeners=PdfParserListeners(
         on_page_added=added_page_hashes.append,
         on_page_removed=removed_page_hashes.append,
@@ -132,6 +130,41 @@ class TestPdfParser(unittest.TestCase):
       "mSmFG7L5wWaPNS2xfNJwyybeouZE1RwfF7sqmhFshVd6G137gapjXCm2hz1PtxKhIqOAKQ6xV61UsD2xortrRA==",
     ])
 
+  def test_write_page_files_once(self):
+    assets_path = os.path.abspath(os.path.join(__file__, "../assets"))
+    parser = PdfParser(cache_dir_path=get_temp_path("pdf_write_once/cache"))
+    common_page_hash = "l02eglkFC4Yg2S7Gt44MuGne1PxnBgZ3lBgLvZ24GI0fwF-B70Sf4DjCxe_uU4KsZpyzKNasFLuxe_MUiSZXWQ=="
+    file1, file1_hash = self._assets_info(assets_path, "The Sublime Object of Ideology.pdf")
+    file2, file2_hash = self._assets_info(assets_path, "铁证待判.pdf")
+    pdf1 = parser.pdf(file1_hash, file1, lambda _: None)
+    self.assertListEqual(self._read_temp_files(parser.pages_path), [])
+
+    # a page file is replaced by renaming, so that a written file has another inode
+    inodes = self._read_inodes(parser.pages_path)
+    common_page_path = os.path.join(parser.pages_path, f"{common_page_hash}.pdf")
+    with open(common_page_path, "rb") as page_file:
+      common_page_data = page_file.read()
+    os.remove(common_page_path)
+
+    # pages cached by file1 are not written again by file2, but the missing one is written back
+    pdf2 = parser.pdf(file2_hash, file2, lambda _: None)
+    file1_page_hashes = [p.hash for p in pdf1.pages]
+    file2_page_hashes = [p.hash for p in pdf2.pages]
+    self.assertIn(common_page_hash, file2_page_hashes)
+    self.assertListEqual(
+      self._read_hash_of_files(parser.pages_path),
+      sorted(set(file1_page_hashes + file2_page_hashes)),
+    )
+    new_inodes = self._read_inodes(parser.pages_path)
+    for page_hash in file1_page_hashes:
+      if page_hash != common_page_hash:
+        self.assertEqual(new_inodes[page_hash], inodes[page_hash])
+
+    with open(common_page_path, "rb") as page_file:
+      self.assertEqual(page_file.read(), common_page_data)
+    self.assertEqual(hash_sha512(common_page_path), common_page_hash)
+    self.assertListEqual(self._read_temp_files(parser.pages_path), [])
+
   def _assets_info(self, assets_path: str, name: str):
     path = os.path.join(assets_path, name)
     hash = hash_sha512(path)
@@ -146,4 +179,13 @@ class TestPdfParser(unittest.TestCase):
         hash_of_files.append(hash)
 
     hash_of_files.sort()
-    return hash_of_files
\ No newline at end of file
+    return hash_of_files
+
+  def _read_temp_files(self, dir_path: str) -> list[str]:
+    return sorted(name for name in os.listdir(dir_path) if name.endswith(".tmp"))
+
+  def _read_inodes(self, dir_path: str) -> dict[str, int]:
+    return {
+      hash: os.stat(os.path.join(dir_path, f"{hash}.pdf")).st_ino
+      for hash in self._read_hash_of_files(dir_path)
+    }
@@ -0,0 +1,144 @@
+import unittest
+
+from dataclasses import dataclass
+from index_package.index import IndexNode, IndexNodeMatching
+from index_package.service.query_session import QuerySessions, QueryCursor
+from index_package.service.trimmer import PageQueryItem
+
+class TestQuerySession(unittest.TestCase):
+  def test_pages_continuity(self):
+    index = _FakeIndex([_page_node(f"page{i}", i) for i in range(7)])
+    sessions = QuerySessions(index, _FakePdfParser(), ttl=60.0, max_sessions=4)
+    page = sessions.first_page("foobar", page_size=3, ranking=None, query_filter=None)
+    contents: list[str] = []
+
+    while True:
+      contents.extend(_contents(page.items))
+      if page.next_cursor is None:
+        break
+      page = sessions.page(page.next_cursor)
+
+    self.assertEqual(contents, [f"content of page{i}" for i in range(7)])
+    self.assertEqual(page.keywords, ["foobar"])
+
+  def test_pages_exhaustion(self):
+    index = _FakeIndex([_page_node(f"page{i}", i) for i in range(3)])
+    sessions = QuerySessions(index, _FakePdfParser(), ttl=60.0, max_sessions=4)
+    page = sessions.first_page("foobar", page_size=3, ranking=None, query_filter=None)
+    self.assertEqual(len(page.items), 3)
+
+    # whether there is a next page is unknown until the index returns nothing new
+    if page.next_cursor is not None:
+      page = sessions.page(page.next_cursor)
+      self.assertEqual(page.items, [])
+    self.assertIsNone(page.next_cursor)
+
+    page = sessions.first_page("foobar", page_size=10, ranking=None, query_filter=None)
+    self.assertEqual(len(page.items), 3)
+    self.assertIsNone(page.next_cursor)
+
+  def test_pages_expiry(self):
+    index = _FakeIndex([_page_node(f"page{i}", i) for i in range(5)])
+    sessions = QuerySessions(index, _FakePdfParser(), ttl=-1.0, max_sessions=4)
+    page = sessions.first_page("foobar", page_size=2, ranking=None, query_filter=None)
+    self.assertEqual(_contents(page.items), ["content of page0", "content of page1"])
+    self.assertIsNotNone(page.next_cursor)
+
+    # the session expired at once, so that the cursor recomputes from the beginning
+    queries_count = len(index.queries)
+    page = sessions.page(page.next_cursor)
+    self.assertEqual(_contents(page.items), ["content of page2", "content of page3"])
+    self.assertGreater(len(index.queries), queries_count)
+
+    # a cursor of unknown session is still valid
+    page = sessions.page(QueryCursor(
+      session_id="unknown",
+      text="foobar",
+      offset=4,
+      page_size=2,
+      ranking=None,
+      query_filter=None,
+    ))
+    self.assertEqual(_contents(page.items), ["content of page4"])
+
+  def test_pages_stale_generation(self):
+    index = _FakeIndex([_page_node(f"page{i}", i) for i in range(4)])
+    sessions = QuerySessions(index, _FakePdfParser(), ttl=60.0, max_sessions=4)
+    page = sessions.first_page("foobar", page_size=2, ranking=None, query_filter=None)
+    index.nodes = [_page_node(f"new{i}", i) for i in range(4)]
+    index.generation += 1
+
+    page = sessions.page(page.next_cursor)
+    self.assertEqual(_contents(page.items), ["content of new2", "content of new3"])
+
+  def test_pages_not_mutated_by_later_pages(self):
+    # annotation of page0 is ranked after the first fetch, so it is attached by the second page
+    index = _FakeIndex([
+      _page_node("page0", 0),
+      _page_node("page1", 1),
+      _page_node("page2", 2),
+      _anno_node("page0", 0, 3),
+    ])
+    sessions = QuerySessions(index, _FakePdfParser(), ttl=60.0, max_sessions=4)
+    first_page = sessions.first_page("foobar", page_size=2, ranking=None, query_filter=None)
+    self.assertEqual(_contents(first_page.items), ["content of page0", "content of page1"])
+    self.assertEqual([len(item.annotations) for item in first_page.items], [0, 0])
+
+    second_page = sessions.page(first_page.next_cursor)
+    self.assertEqual(_contents(second_page.items)[0], "content of page2")
+    self.assertEqual([len(item.annotations) for item in first_page.items], [0, 0])
+
+    page = sessions.first_page("foobar", page_size=10, ranking=None, query_filter=None)
+    self.assertEqual(len(page.items[0].annotations), 1)
+
+class _FakeIndex:
+  def __init__(self, nodes: list[IndexNode]):
+    self.nodes: list[IndexNode] = nodes
+    self.generation: int = 0
+    self.queries: list[tuple] = []
+
+  def query(self, text: str, results_limit: int, ranking=None, query_filter=None):
+    self.queries.append((text, results_limit, ranking, query_filter))
+    return self.nodes[:results_limit], [text]
+
+  def get_page_relative_to_pdf(self, _page_hash: str):
+    return []
+
+@dataclass
+class _FakeAnnotation:
+  content: str
+
+@dataclass
+class _FakePage:
+  hash: str
+  snapshot: str
+  annotations: list[_FakeAnnotation]
+
+class _FakePdfParser:
+  def page(self, node_id: str) -> _FakePage:
+    page_hash = node_id.split("/", 1)[0]
+    return _FakePage(
+      hash=page_hash,
+      snapshot=f"content of {page_hash}",
+      annotations=[_FakeAnnotation(content=f"annotation of {page_hash}")],
+    )
+
+def _page_node(page_hash: str, rank: int) -> IndexNode:
+  return _node(page_hash, "pdf.page", rank)
+
+def _anno_node(page_hash: str, anno_index: int, rank: int) -> IndexNode:
+  return _node(f"{page_hash}/anno/{anno_index}/content", "pdf.page.anno.content", rank)
+
+def _node(node_id: str, node_type: str, rank: int) -> IndexNode:
+  return IndexNode(
+    id=node_id,
+    type=node_type,
+    matching=IndexNodeMatching.Similarity,
+    metadata={"type": node_type},
+    fts5_rank=0.0,
+    vector_distance=float(rank),
+    segments=[],
+  )
+
+def _contents(items: list) -> list[str]:
+  return [item.content for item in items if isinstance(item, PageQueryItem)]